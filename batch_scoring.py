@@ -0,0 +1,120 @@
+"""Python script designed to score large test sets by chunks.
+
+In this script, we define a score_to_csv function that predicts chunks of rows
+in a thread pool (the model predictions release the GIL) and streams each chunk
+to the submission file as soon as it and all the previous ones are predicted.
+Only a bounded number of chunks are in flight at once, so that the memory used
+does not grow with the size of the scoring horizon, and the rows are written in
+input order with consecutive Ids.
+
+The chunks can be views of a test set already in memory (iter_chunks), or
+batches read lazily, e.g. with load_data_batches:
+
+    batches = load_data_batches(test_set=True, columns=load_selected_columns())
+    score_to_csv(pipeline, batches, "submission.csv", prepare=prepare_features)
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def iter_chunks(dataset, chunk_rows=50_000):
+    """Iterate over consecutive chunks of rows of a dataframe.
+
+    Parameters
+    ----------
+    dataset : pd.dataframe
+        The dataframe to split.
+
+    chunk_rows : int, optional
+        Maximum number of rows of each chunk. 50 000 by default.
+
+    Yields
+    ------
+    chunk : pd.dataframe
+        The next chunk, in row order.
+    """
+    for start in range(0, dataset.shape[0], chunk_rows):
+        yield dataset.iloc[start : start + chunk_rows]
+
+
+def _predict_chunk(model, chunk, prepare):
+    """Prepare a chunk if needed and predict it."""
+    if prepare is not None:
+        chunk = prepare(chunk)
+    return model.predict(chunk)
+
+
+def score_to_csv(
+    model,
+    chunks,
+    path,
+    prepare=None,
+    n_threads=None,
+    max_pending=None,
+    target="log_bike_count",
+):
+    """Predict chunks of rows in a thread pool and stream them to a CSV file.
+
+    Parameters
+    ----------
+    model : fitted estimator
+        The model (e.g. the fitted pipeline) used to predict each chunk.
+
+    chunks : iterable of pd.dataframes
+        The rows to score, by chunks, in the order of the Ids.
+
+    path : str or Path
+        The output CSV file, with an 'Id' column and a prediction column.
+
+    prepare : callable, optional
+        Function applied to each chunk before its prediction (e.g. imputation
+    and feature engineering), run in the thread pool. None by default.
+
+    n_threads : int, optional
+        Number of threads predicting chunks. The number of CPUs by default.
+
+    max_pending : int, optional
+        Maximum number of chunks read but not written yet, which bounds the
+    memory used. Twice the number of threads by default.
+
+    target : str, optional
+        Name of the prediction column. 'log_bike_count' by default.
+
+    Returns
+    -------
+    n_rows : int
+        The number of rows written.
+    """
+    n_threads = n_threads or os.cpu_count()
+    max_pending = max_pending or 2 * n_threads
+    pending = deque()
+    n_rows = 0
+
+    with open(path, "w", newline="") as file, ThreadPoolExecutor(n_threads) as pool:
+        file.write(f"Id,{target}\n")
+
+        def write_next():
+            nonlocal n_rows
+            predictions = pending.popleft().result()
+            pd.DataFrame(
+                {
+                    "Id": np.arange(n_rows, n_rows + predictions.shape[0]),
+                    target: predictions,
+                }
+            ).to_csv(file, header=False, index=False)
+            n_rows += predictions.shape[0]
+
+        for chunk in chunks:
+            pending.append(pool.submit(_predict_chunk, model, chunk, prepare))
+            if len(pending) >= max_pending:
+                write_next()
+
+        while pending:
+            write_next()
+
+    return n_rows
@@ -0,0 +1,526 @@
+"""Python script designed to benchmark each stage of the pipeline on synthetic data.
+
+It generates a synthetic dataset at the requested scale (see synthetic_data.py),
+then runs the pipeline stage by stage: load_data, null_imputer,
+feature_selection, feature_transformer, preprocessor fit/transform, model fit
+and predict. The wall time and the peak memory of each stage are written as
+JSON, so that runs can be compared. Two peaks are measured: the one of the
+Python heap (traced with tracemalloc, NumPy arrays included), and the one of
+the resident memory of the process (sampled during the stage), which also
+counts the pyarrow buffers (most of the memory of the load stages) and the
+other native allocations. The memory held by pyarrow after each stage is
+recorded as well.
+
+With --sharding, it compares instead the monolithic model with one model per
+counter (or per site, see sharded_model.py): total fit time, size of the models
+and predict latency. With --out-of-core SAMPLE_ROWS, it compares the RMSE, fit
+time and peak memory of the out-of-core training (see out_of_core.py) with the
+in-memory one, on a held out period.
+
+Example:
+    python benchmark.py --counters 60 --stations 6 --years 2 --output bench.json
+    python benchmark.py --sharding counter --output sharding.json
+    python benchmark.py --out-of-core 100000 --years 2 --output out_of_core.json
+"""
+
+import json
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import sklearn
+
+from load_data import load_data, parquet_date_range
+from feature_selector import feature_selection, load_selected_columns
+from feature_engineering import feature_transformer
+from preprocessor import preprocessor_generator
+from null_manager import NullImputer, null_imputer
+from out_of_core import fit_out_of_core, streaming_rmse
+from model import make_pipeline, make_regressor
+from sharded_model import ShardedRegressor, site_of_counter
+from synthetic_data import write_dataset
+
+RSS_SAMPLING_S = 0.005  # interval between two samples of the resident memory
+
+
+def _rss_mb():
+    """Current resident memory of the process in MiB (None without /proc)."""
+    try:
+        with open("/proc/self/statm") as file:
+            resident_pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def measure(stages, name, func, *args, **kwargs):
+    """Run func(*args, **kwargs), record its wall time and peak memory and return its result.
+
+    The record holds the peak of the Python heap (peak_memory_mb, tracemalloc
+    does not see the pyarrow buffers), the peak of the resident memory of the
+    process (peak_rss_mb, None where it cannot be read), both relative to the
+    start of the stage, and the change of the memory held by pyarrow.
+
+    Parameters
+    ----------
+    stages : list
+        The list of stage records, to which the new record is appended.
+
+    name : str
+        The name of the stage.
+
+    func : callable
+        The function running the stage.
+
+    Returns
+    -------
+    result :
+        The value returned by func.
+    """
+    tracemalloc.reset_peak()
+    memory_before, _ = tracemalloc.get_traced_memory()
+    arrow_before = pa.total_allocated_bytes()
+
+    # the resident memory is sampled in a thread while the stage runs
+    rss_before = _rss_mb()
+    rss_samples = [rss_before]
+    done = threading.Event()
+
+    def sample_rss():
+        while not done.wait(RSS_SAMPLING_S):
+            rss_samples.append(_rss_mb())
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        wall_time = time.perf_counter() - start
+        done.set()
+        sampler.join()
+
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    rss_samples.append(_rss_mb())
+    stages.append(
+        {
+            "stage": name,
+            "wall_time_s": wall_time,
+            "peak_memory_mb": (memory_peak - memory_before) / 2**20,
+            "memory_delta_mb": (memory_after - memory_before) / 2**20,
+            "peak_rss_mb": (
+                None if rss_before is None else max(rss_samples) - rss_before
+            ),
+            "arrow_memory_delta_mb": (pa.total_allocated_bytes() - arrow_before)
+            / 2**20,
+        }
+    )
+    return result
+
+
+def run_benchmark(n_counters=30, n_stations=5, years=1, max_iter=100, seed=0):
+    """Benchmark every stage of the pipeline on a synthetic dataset.
+
+    Parameters
+    ----------
+    n_counters, n_stations, years : optional
+        Scale of the synthetic dataset (see synthetic_data.write_dataset).
+
+    max_iter : int, optional
+        Number of boosting iterations of the model. 100 by default.
+
+    seed : int, optional
+        Seed of the synthetic data. 0 by default.
+
+    Returns
+    -------
+    report : dict
+        The configuration, the environment, the dataset sizes and one record
+    per stage (see measure, memory in MiB).
+    """
+    stages = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_paths = write_dataset(directory, n_counters, n_stations, years, seed=seed)
+
+        tracemalloc.start()
+
+        train, test = measure(
+            stages,
+            "load_data (cold cache)",
+            load_data,
+            cache_dir=directory,
+            data_paths=data_paths,
+        )
+        del train, test
+        train, test = measure(
+            stages,
+            "load_data (warm cache)",
+            load_data,
+            cache_dir=directory,
+            data_paths=data_paths,
+        )
+        del train, test
+        train, test = measure(
+            stages,
+            "load_data (selected columns)",
+            load_data,
+            cache_dir=directory,
+            data_paths=data_paths,
+            columns=load_selected_columns() + ["log_bike_count"],
+        )
+
+    train = measure(stages, "null_imputer", null_imputer, train)
+    train = measure(stages, "feature_selection", feature_selection, train)
+    train = measure(stages, "feature_transformer", feature_transformer, train)
+
+    x_train = train.drop(columns=["log_bike_count"])
+    y_train = train["log_bike_count"]
+
+    preprocessor = preprocessor_generator(x_train, native_categorical=True)
+    x_matrix = measure(
+        stages, "preprocessor fit_transform", preprocessor.fit_transform, x_train
+    )
+    x_matrix = measure(
+        stages, "preprocessor transform", preprocessor.transform, x_train
+    )
+
+    regressor = make_regressor(
+        x_train, native_categorical=True, max_iter=max_iter, early_stopping=False
+    )
+    measure(stages, "model fit", regressor.fit, x_matrix, y_train)
+    measure(stages, "model predict", regressor.predict, x_matrix)
+
+    tracemalloc.stop()
+
+    return {
+        "config": {
+            "n_counters": n_counters,
+            "n_stations": n_stations,
+            "years": years,
+            "max_iter": max_iter,
+            "seed": seed,
+        },
+        "environment": _environment(),
+        "rows": {"train": int(train.shape[0]), "test": int(test.shape[0])},
+        "stages": stages,
+    }
+
+
+def _environment():
+    """Versions of the Python interpreter and of the main libraries."""
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "scikit-learn": sklearn.__version__,
+    }
+
+
+def _size_mb(model):
+    """Size of a pickled model in MiB."""
+    return len(pickle.dumps(model)) / 2**20
+
+
+def _row_latency_ms(model, x, n_rows=50):
+    """Median time in milliseconds to predict one row, over n_rows rows."""
+    latencies = []
+    for i in np.linspace(0, x.shape[0] - 1, n_rows).astype(int):
+        start = time.perf_counter()
+        model.predict(x.iloc[i : i + 1])
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
+
+
+def run_sharding_benchmark(
+    n_counters=30, n_stations=5, years=1, max_iter=100, seed=0, shard_by="counter"
+):
+    """Compare the monolithic model with one model per counter or per site.
+
+    Parameters
+    ----------
+    n_counters, n_stations, years, max_iter, seed : optional
+        See run_benchmark.
+
+    shard_by : str, optional
+        'counter' or 'site'. 'counter' by default.
+
+    Returns
+    -------
+    report : dict
+        The configuration, the environment and, for each model, its fit time,
+    the size of its model(s) in MiB, its predict time on the test set and its
+    median latency to predict one row.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        data_paths = write_dataset(directory, n_counters, n_stations, years, seed=seed)
+        train, test = load_data(
+            cache=False,
+            data_paths=data_paths,
+            columns=load_selected_columns() + ["log_bike_count"],
+        )
+
+    train = feature_transformer(feature_selection(null_imputer(train)))
+    x_test = feature_transformer(feature_selection(null_imputer(test), test_set=True))
+    x_train = train.drop(columns=["log_bike_count"])
+    y_train = train["log_bike_count"]
+
+    pipeline = make_pipeline(
+        x_train, native_categorical=True, max_iter=max_iter, early_stopping=False
+    )
+    models = {
+        "monolithic": pipeline,
+        f"sharded by {shard_by}": ShardedRegressor(
+            pipeline,
+            shard_by=site_of_counter if shard_by == "site" else "counter_id",
+        ),
+    }
+
+    results = {}
+    for name, model in models.items():
+        start = time.perf_counter()
+        model.fit(x_train, y_train)
+        fit_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        model.predict(x_test)
+        predict_time = time.perf_counter() - start
+
+        sizes = [
+            _size_mb(shard)
+            for shard in getattr(model, "estimators_", {"": model}).values()
+        ]
+        results[name] = {
+            "fit_s": fit_time,
+            "n_models": len(sizes),
+            "total_size_mb": float(np.sum(sizes)),
+            "max_model_size_mb": float(np.max(sizes)),
+            "predict_test_s": predict_time,
+            "predict_row_ms": _row_latency_ms(model, x_test),
+        }
+
+    # refitting the shard of a single counter
+
+    sharded = models[f"sharded by {shard_by}"]
+    shard = next(iter(sharded.estimators_))
+    rows = sharded.shards_of(x_train) == shard
+    start = time.perf_counter()
+    sharded.refit_shard(x_train[rows], y_train[rows])
+    results[f"sharded by {shard_by}"]["refit_one_shard_s"] = time.perf_counter() - start
+
+    return {
+        "config": {
+            "n_counters": n_counters,
+            "n_stations": n_stations,
+            "years": years,
+            "max_iter": max_iter,
+            "seed": seed,
+            "shard_by": shard_by,
+        },
+        "environment": _environment(),
+        "models": results,
+    }
+
+
+def run_out_of_core_benchmark(
+    n_counters=30,
+    n_stations=5,
+    years=1,
+    max_iter=100,
+    seed=0,
+    sample_rows=100_000,
+    batch_rows=20_000,
+):
+    """Compare the out-of-core training with the in-memory one on the last weeks.
+
+    Both models are fitted on the first 80% of the period of the train set and
+    scored on the rest.
+
+    Parameters
+    ----------
+    n_counters, n_stations, years, max_iter, seed : optional
+        See run_benchmark.
+
+    sample_rows, batch_rows : int, optional
+        See out_of_core.fit_out_of_core. 100 000 and 20 000 by default.
+
+    Returns
+    -------
+    report : dict
+        The configuration, the environment and, for each training mode, its
+    fit stage record (see measure, memory in MiB) and
+    its RMSE on the held out period.
+    """
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_paths = write_dataset(directory, n_counters, n_stations, years, seed=seed)
+        first_date, last_date = parquet_date_range(data_paths[0])
+        cutoff = (first_date + 0.8 * (last_date - first_date)).floor("h")
+
+        tracemalloc.start()
+
+        stages = []
+        pipeline, imputer = measure(
+            stages,
+            "out-of-core fit",
+            fit_out_of_core,
+            sample_rows=sample_rows,
+            batch_rows=batch_rows,
+            data_paths=data_paths,
+            native_categorical=True,
+            max_iter=max_iter,
+            until=cutoff,
+        )
+        rmse = streaming_rmse(
+            pipeline, imputer, batch_rows, data_paths=data_paths, since=cutoff
+        )
+        results["out-of-core"] = {**stages[0], "rmse": rmse}
+
+        def fit_in_memory():
+            train, _ = load_data(
+                cache_dir=directory,
+                data_paths=data_paths,
+                columns=load_selected_columns() + ["log_bike_count"],
+            )
+            holdout = train[train["date"] >= cutoff].reset_index(drop=True)
+            train = train[train["date"] < cutoff].reset_index(drop=True)
+
+            imputer = NullImputer().fit(train)
+            train = feature_transformer(feature_selection(imputer.transform(train)))
+            x_train = train.drop(columns=["log_bike_count"])
+            pipeline = make_pipeline(
+                x_train, native_categorical=True, max_iter=max_iter
+            )
+            pipeline.fit(x_train, train["log_bike_count"])
+            return pipeline, imputer, holdout
+
+        stages = []
+        pipeline, imputer, holdout = measure(stages, "in-memory fit", fit_in_memory)
+        holdout = feature_transformer(feature_selection(imputer.transform(holdout)))
+        y_holdout = holdout.pop("log_bike_count")
+        rmse = float(np.sqrt(np.mean((pipeline.predict(holdout) - y_holdout) ** 2)))
+        results["in-memory"] = {**stages[0], "rmse": rmse}
+
+        tracemalloc.stop()
+
+    return {
+        "config": {
+            "n_counters": n_counters,
+            "n_stations": n_stations,
+            "years": years,
+            "max_iter": max_iter,
+            "seed": seed,
+            "sample_rows": sample_rows,
+            "batch_rows": batch_rows,
+            "cutoff": str(cutoff),
+        },
+        "environment": _environment(),
+        "models": results,
+    }
+
+
+def _format_mb(value):
+    """Format a memory size in MiB (n/a if it could not be measured)."""
+    return "n/a" if value is None else f"{value:.1f}"
+
+
+def main(
+    n_counters=30,
+    n_stations=5,
+    years=1,
+    max_iter=100,
+    seed=0,
+    output="benchmark.json",
+    sharding=None,
+    sample_rows=None,
+):
+    """Run a benchmark, write its report as JSON and print a summary.
+
+    Parameters
+    ----------
+    n_counters, n_stations, years, max_iter, seed : optional
+        See run_benchmark.
+
+    output : str or Path, optional
+        The JSON report file. 'benchmark.json' by default.
+
+    sharding : str, optional
+        'counter' or 'site' to run the sharding benchmark (see
+    run_sharding_benchmark) instead of the stage benchmark. None by default.
+
+    sample_rows : int, optional
+        Number of rows of the sample of the out-of-core training, to compare it
+    with the in-memory one (see run_out_of_core_benchmark) instead of running
+    the stage benchmark. None by default.
+
+    Returns
+    -------
+    report : dict
+        The report written.
+    """
+    if sharding:
+        report = run_sharding_benchmark(
+            n_counters, n_stations, years, max_iter, seed, sharding
+        )
+    elif sample_rows:
+        report = run_out_of_core_benchmark(
+            n_counters, n_stations, years, max_iter, seed, sample_rows
+        )
+    else:
+        report = run_benchmark(n_counters, n_stations, years, max_iter, seed)
+
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    if sharding:
+        for name, result in report["models"].items():
+            print(
+                f"{name:<20} fit {result['fit_s']:>8.2f} s,"
+                f" {result['n_models']:>4} model(s) of at most"
+                f" {result['max_model_size_mb']:.2f} MiB,"
+                f" {result['predict_row_ms']:.2f} ms per row"
+            )
+    elif sample_rows:
+        for name, result in report["models"].items():
+            print(
+                f"{name:<12} RMSE {result['rmse']:.5f},"
+                f" fit {result['wall_time_s']:>8.2f} s,"
+                f" peak {result['peak_memory_mb']:>8.1f} MiB (Python heap),"
+                f" {_format_mb(result['peak_rss_mb'])} MiB (RSS)"
+            )
+    else:
+        print(
+            f"{'stage':<28} {'wall time':>10} {'Python heap':>12}"
+            f" {'RSS':>10} {'pyarrow':>10}"
+        )
+        for stage in report["stages"]:
+            print(
+                f"{stage['stage']:<28} {stage['wall_time_s']:>8.3f} s"
+                f" {stage['peak_memory_mb']:>8.1f} MiB"
+                f" {_format_mb(stage['peak_rss_mb']):>6} MiB"
+                f" {stage['arrow_memory_delta_mb']:>6.1f} MiB"
+            )
+        print(
+            "Python heap: peak traced by tracemalloc (without the pyarrow buffers),"
+            " RSS: peak resident memory of the process, pyarrow: memory kept by"
+            " pyarrow after the stage (all relative to the start of the stage)"
+        )
+
+    return report
+
+
+if __name__ == "__main__":
+    # the options are defined with the bench command of cli.py
+    from cli import main as cli_main
+
+    cli_main(["bench", *sys.argv[1:]])
@@ -0,0 +1,250 @@
+"""Python script designed to be the command-line entry point of the project.
+
+It gathers the scripts behind one command with the subcommands:
+    python cli.py train --output artifacts      (fit and save an artifact)
+    python cli.py predict --artifact artifacts  (write submission.csv)
+    python cli.py serve --artifact artifacts    (see prediction_service.py)
+    python cli.py submit --compact              (see kaggle_script.py)
+    python cli.py cv --splits 5                 (see testing_models.py)
+    python cli.py tune --trials 20 --workers 4  (see opt_hg.py)
+    python cli.py bench --counters 60           (see benchmark.py)
+    python cli.py bench --out-of-core 100000    (see out_of_core.py)
+    python cli.py relevance --splits 5          (see feature_relevance.py)
+    python cli.py ingest --store store          (see incremental.py)
+
+Only the argument parser is built at start-up: each subcommand imports the
+modules it needs (and so sklearn, optuna, scipy or holidays) when it runs.
+The scripts themselves do nothing at import time, so that they can be imported
+by worker processes (e.g. with the spawn start method) without running again.
+"""
+
+import argparse
+
+
+def train(args):
+    """Fit the pipeline on the train set and save it as an artifact."""
+    from prediction_service import build_artifact, save_artifact
+
+    artifact = build_artifact(
+        kaggle=args.kaggle,
+        native_categorical=args.native_categorical,
+        max_iter=args.max_iter,
+    )
+    print(f"Artifact saved in {save_artifact(artifact, args.output)}")
+
+
+def predict(args):
+    """Write the predictions of a saved artifact on the test set."""
+    from prediction_service import load_artifact, score_test_set
+
+    n_rows = score_test_set(
+        load_artifact(args.artifact),
+        args.output,
+        kaggle=args.kaggle,
+        batch_rows=args.batch_rows,
+    )
+    print(f"{n_rows} predictions written in {args.output}")
+
+
+def serve(args):
+    """Serve the predictions of a saved artifact over HTTP."""
+    from prediction_service import serve as serve_artifact
+
+    serve_artifact(
+        args.artifact,
+        args.host,
+        args.port,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+
+
+def submit(args):
+    """Fit the model on the train set and write the submission of the test set."""
+    from kaggle_script import main
+
+    main(
+        kaggle=args.kaggle,
+        output=args.output,
+        compact=args.compact,
+        native_categorical=args.native_categorical,
+        history_features=args.history,
+        store_dir=args.store,
+    )
+
+
+def cv(args):
+    """Run the time series cross-validation of the model."""
+    from testing_models import main
+
+    main(
+        n_splits=args.splits,
+        kaggle=args.kaggle,
+        compact=args.compact,
+        native_categorical=args.native_categorical,
+        history_features=args.history,
+        store_dir=args.store,
+    )
+
+
+def tune(args):
+    """Run the optuna study of the hyperparameters."""
+    from opt_hg import main
+
+    main(
+        n_trials=args.trials,
+        n_workers=args.workers,
+        compact=args.compact,
+        native_categorical=args.native_categorical,
+    )
+
+
+def bench(args):
+    """Benchmark the pipeline on synthetic data."""
+    from benchmark import main
+
+    main(
+        n_counters=args.counters,
+        n_stations=args.stations,
+        years=args.years,
+        max_iter=args.max_iter,
+        seed=args.seed,
+        output=args.output,
+        sharding=args.sharding,
+        sample_rows=args.sample_rows,
+    )
+
+
+def relevance(args):
+    """Recompute the selected features and write the selection config."""
+    from feature_relevance import main
+
+    main(
+        kaggle=args.kaggle,
+        n_splits=args.splits,
+        n_repeats=args.repeats,
+        max_iter=args.max_iter,
+    )
+
+
+def ingest(args):
+    """Create the incremental store of the train set, or append new data to it."""
+    from incremental import init_store, store_exists, update_store
+
+    if not store_exists(args.store):
+        init_store(args.store, kaggle=args.kaggle)
+        print(f"Store created in {args.store}")
+
+    if args.counts or args.weather:
+        n_counts, n_weather = update_store(args.store, args.counts, args.weather)
+        print(
+            f"{n_counts} count rows and {n_weather} weather rows appended to"
+            f" {args.store}"
+        )
+
+
+def build_parser():
+    """Return the argument parser of the subcommands (without importing them)."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = commands.add_parser("train", help=train.__doc__)
+    train_parser.add_argument("--output", default="artifacts")
+    train_parser.add_argument("--kaggle", action="store_true")
+    train_parser.add_argument("--native-categorical", action="store_true")
+    train_parser.add_argument("--max-iter", type=int)  # tuned value by default
+    train_parser.set_defaults(run=train)
+
+    predict_parser = commands.add_parser("predict", help=predict.__doc__)
+    predict_parser.add_argument("--artifact", default="artifacts")
+    predict_parser.add_argument("--output", default="submission.csv")
+    predict_parser.add_argument("--kaggle", action="store_true")
+    predict_parser.add_argument("--batch-rows", type=int, default=100_000)
+    predict_parser.set_defaults(run=predict)
+
+    serve_parser = commands.add_parser("serve", help=serve.__doc__)
+    serve_parser.add_argument("--artifact", default="artifacts")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--max-batch-size", type=int, default=256)
+    serve_parser.add_argument("--max-wait-ms", type=float, default=2)
+    serve_parser.set_defaults(run=serve)
+
+    # --compact: float32 measurements, categorical IDs and int8/int16 features
+    # --native-categorical: ordinal-encoded categories handled by the model (the
+    # hyperparameters were tuned with one-hot encoding)
+    # --history: rolling weather features ('weather'), and lags of the target ('all',
+    # only for cv: in the test set, they are unknown beyond its first day or week)
+    submit_parser = commands.add_parser("submit", help=submit.__doc__)
+    submit_parser.add_argument("--output", default="submission.csv")
+    submit_parser.add_argument("--kaggle", action="store_true")
+    submit_parser.add_argument("--compact", action="store_true")
+    submit_parser.add_argument("--native-categorical", action="store_true")
+    submit_parser.add_argument("--history", choices=["weather"])
+    submit_parser.add_argument("--store", help="read the train set from a store")
+    submit_parser.set_defaults(run=submit)
+
+    cv_parser = commands.add_parser("cv", help=cv.__doc__)
+    cv_parser.add_argument("--splits", type=int, default=5)
+    cv_parser.add_argument("--kaggle", action="store_true")
+    cv_parser.add_argument("--compact", action="store_true")
+    cv_parser.add_argument("--native-categorical", action="store_true")
+    cv_parser.add_argument("--history", choices=["weather", "all"])
+    cv_parser.add_argument("--store", help="read the train set from a store")
+    cv_parser.set_defaults(run=cv)
+
+    # the defaults of opt_hg.py (N_TRIALS, N_WORKERS) are repeated here, so that
+    # optuna is not imported to build the parser
+    tune_parser = commands.add_parser("tune", help=tune.__doc__)
+    tune_parser.add_argument("--trials", type=int, default=20)
+    tune_parser.add_argument("--workers", type=int, default=4)
+    tune_parser.add_argument("--compact", action="store_true")
+    tune_parser.add_argument(
+        "--native-categorical",
+        action="store_true",
+        help="tune the native categorical encoding instead of the one-hot one"
+        " (the saved hyperparameters are only used by train, submit and cv"
+        " with the same encoding)",
+    )
+    tune_parser.set_defaults(run=tune)
+
+    bench_parser = commands.add_parser("bench", help=bench.__doc__)
+    bench_parser.add_argument("--counters", type=int, default=30)
+    bench_parser.add_argument("--stations", type=int, default=5)
+    bench_parser.add_argument("--years", type=float, default=1)
+    bench_parser.add_argument("--max-iter", type=int, default=100)
+    bench_parser.add_argument("--seed", type=int, default=0)
+    bench_parser.add_argument("--output", default="benchmark.json")
+    bench_parser.add_argument("--sharding", choices=["counter", "site"])
+    bench_parser.add_argument(
+        "--out-of-core", type=int, metavar="SAMPLE_ROWS", dest="sample_rows"
+    )
+    bench_parser.set_defaults(run=bench)
+
+    relevance_parser = commands.add_parser("relevance", help=relevance.__doc__)
+    relevance_parser.add_argument("--splits", type=int, default=5)
+    relevance_parser.add_argument("--repeats", type=int, default=3)
+    relevance_parser.add_argument("--max-iter", type=int, default=200)
+    relevance_parser.add_argument("--kaggle", action="store_true")
+    relevance_parser.set_defaults(run=relevance)
+
+    # the store is created from the train and weather files the first time,
+    # then only the new counts (parquet) and weather observations (CSV) are added
+    ingest_parser = commands.add_parser("ingest", help=ingest.__doc__)
+    ingest_parser.add_argument("--store", default="store")
+    ingest_parser.add_argument("--counts", help="parquet file of new counts")
+    ingest_parser.add_argument("--weather", help="CSV file of new observations")
+    ingest_parser.add_argument("--kaggle", action="store_true")
+    ingest_parser.set_defaults(run=ingest)
+
+    return parser
+
+
+def main(argv=None):
+    """Parse the command line and run the subcommand."""
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
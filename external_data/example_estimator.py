@@ -2,6 +2,7 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.preprocessing import FunctionTransformer
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.preprocessing import StandardScaler
@@ -23,20 +24,43 @@ def _encode_dates(X):
     return X.drop(columns=["date"])
 
 
-def _merge_external_data(X):
-    file_path = Path(__file__).parent / "external_data.csv"
-    df_ext = pd.read_csv(file_path, parse_dates=["date"])
+class ExternalDataMerger(BaseEstimator, TransformerMixin):
+    """Add the last external observation at or before the date of each row.
 
-    X = X.copy()
-    # When using merge_asof left frame need to be sorted
-    X["orig_index"] = np.arange(X.shape[0])
-    X = pd.merge_asof(
-        X.sort_values("date"), df_ext[["date", "t"]].sort_values("date"), on="date"
-    )
-    # Sort back to the original order
-    X = X.sort_values("orig_index")
-    del X["orig_index"]
-    return X
+    The external table is read and sorted once, at fit time. Each transform
+    is then a binary search of the dates of X in the sorted external dates
+    (as pd.merge_asof does, but without sorting X nor reading the file again).
+    Rows before the first observation get missing values.
+    """
+
+    def __init__(self, file_path=None, columns=("t",)):
+        self.file_path = file_path
+        self.columns = columns
+
+    def fit(self, X=None, y=None):
+        file_path = self.file_path or Path(__file__).parent / "external_data.csv"
+        df_ext = pd.read_csv(
+            file_path, usecols=["date", *self.columns], parse_dates=["date"]
+        )
+        df_ext = df_ext.dropna(subset=["date"]).sort_values("date", kind="stable")
+
+        self.dates_ = df_ext["date"].to_numpy(dtype="datetime64[ns]")
+        # one row of missing values is appended, for the rows without match
+        self.values_ = {
+            col: np.append(df_ext[col].to_numpy(dtype="float64"), np.nan)
+            for col in self.columns
+        }
+        return self
+
+    def transform(self, X):
+        X = X.copy()
+        dates = X["date"].to_numpy(dtype="datetime64[ns]")
+        # position of the last external date <= each date (-1 if none)
+        positions = np.searchsorted(self.dates_, dates, side="right") - 1
+        positions[(positions < 0) | np.isnat(dates)] = self.dates_.shape[0]
+        for col, values in self.values_.items():
+            X[col] = values[positions]
+        return X
 
 
 def get_estimator():
@@ -55,7 +79,7 @@ def get_estimator():
     regressor = Ridge()
 
     pipe = make_pipeline(
-        FunctionTransformer(_merge_external_data, validate=False),
+        ExternalDataMerger(),
         date_encoder,
         preprocessor,
         regressor,
@@ -3,10 +3,28 @@
 In this script, we define a feature_transformer function which performs
 all feature engineering operations (except the ones on datetime features
 which are performed in the date encoder).
+
+We also define a history_features function adding per-counter lags of the target
+and rolling weather aggregates. They are computed on dense (counter x hour)
+arrays, by integer gather and cumulative sums, instead of groupby().apply. A
+HistoryState carries the last hours of each counter, so that the features of new
+rows (e.g. the test set after the train set, or streamed batches) are extended
+without recomputing the history. feature_transformer adds them when given a
+HistoryState (see the history option of kaggle_script.py and testing_models.py).
 """
 
+import numpy as np
+import pandas as pd
+
+from profiling import profiled
+
+LAGS = (24, 168)  # hours of the lags of the target (one day and one week)
+RAIN_WINDOWS = (3, 6, 24)  # hours of the rolling sums of the rain
+TREND_HOURS = 3  # hours of the temperature trend
+
 
-def feature_transformer(dataset):
+@profiled("feature_transformer")
+def feature_transformer(dataset, compact=False, history=None):
     """Apply all feature engineering transformations.
 
     Parameters
@@ -14,18 +32,179 @@ def feature_transformer(dataset):
     dataset : pd.dataframe
         The input dataframe.
 
+    compact : boolean, optional
+        Whether to store the binary features as int8 instead of int64.
+    False by default.
+
+    history : HistoryState, optional
+        If given, the history features are added too (see history_features),
+    and the state is extended with the rows of the dataset, so that the same
+    state can be given for the train set and then for the test set. Not added
+    by default.
+
     Returns
     -------
     dataset : pd.dataframe
         The dataset with newly created features.
     """
+    flag_dtype = "int8" if compact else int
+
     # about rain
-    dataset["no_rain"] = (dataset["precip_1h"] == 0).astype(int)
+    dataset["no_rain"] = (dataset["precip_1h"] == 0).astype(flag_dtype)
     dataset["weak_rain"] = (
         (dataset["precip_1h"] > 0) & (dataset["precip_1h"] < 2)
-    ).astype(int)
+    ).astype(flag_dtype)
     dataset["moderate_rain"] = (
         (dataset["precip_1h"] >= 2) & (dataset["precip_1h"] < 7)
-    ).astype(int)
+    ).astype(flag_dtype)
+
+    # about the previous hours of each counter
+    if history is not None:
+        dataset = history_features(dataset, state=history, compact=compact)
+
+    return dataset
+
+
+def _history_columns(counter_id, date, target, rain, temperature):
+    """Compute the history features of rows given as arrays (see history_features)."""
+    counter_pos, _ = pd.factorize(np.asarray(counter_id, dtype=object))
+    hours = np.asarray(date, dtype="datetime64[h]").astype("int64")
+    hour_pos = hours - hours.min()
+    shape = (counter_pos.max() + 1, hour_pos.max() + 1)
+
+    def dense(values):
+        block = np.full(shape, np.nan)
+        block[counter_pos, hour_pos] = values
+        return block
+
+    def lagged(block, lag, fill=np.nan):
+        positions = hour_pos - lag
+        values = block[counter_pos, np.maximum(positions, 0)]
+        return np.where(positions >= 0, values, fill)
+
+    columns = {}
+
+    # lags of the target
+
+    if target is not None:
+        target_block = dense(target)
+        for lag in LAGS:
+            columns[f"log_bike_count_lag_{lag}h"] = lagged(target_block, lag)
+
+    # rain over the last hours (current one included), from cumulative sums
+
+    rain_block = dense(rain)
+    observed = ~np.isnan(rain_block)
+    rain_sums = np.cumsum(np.where(observed, rain_block, 0), axis=1)
+    rain_counts = np.cumsum(observed, axis=1)
+
+    current_sums = rain_sums[counter_pos, hour_pos]
+    current_counts = rain_counts[counter_pos, hour_pos]
+    for window in RAIN_WINDOWS:
+        window_counts = current_counts - lagged(rain_counts, window, fill=0)
+        columns[f"rain_{window}h"] = np.where(
+            window_counts > 0,
+            current_sums - lagged(rain_sums, window, fill=0),
+            np.nan,
+        )
+
+    # temperature trend
+
+    columns[f"temp_trend_{TREND_HOURS}h"] = np.asarray(
+        temperature, dtype="float64"
+    ) - lagged(dense(temperature), TREND_HOURS)
+
+    return columns
+
+
+class HistoryState:
+    """The last hours of each counter, needed to extend the history features.
+
+    Parameters
+    ----------
+    span : int, optional
+        Number of hours kept before the most recent row. The largest lag or
+    window by default.
+
+    target_lags : boolean, optional
+        Whether to keep the target, for the lags of the target. They are only
+    known where the target of the previous hours is (e.g. in cross-validation,
+    but not in the test set beyond its first day or week), so that a model
+    meant for the test set should be fitted without them. True by default.
+    """
+
+    COLUMNS = ["counter_id", "date", "log_bike_count", "precip_1h", "temp_surface"]
+
+    def __init__(self, span=None, target_lags=True):
+        self.span = max(LAGS + RAIN_WINDOWS + (TREND_HOURS,)) if span is None else span
+        self.target_lags = target_lags
+        self.tail = None
+
+    def extend(self, dataset):
+        """Return the kept rows followed by the rows of the dataset, and keep the last hours."""
+        rows = dataset[
+            [
+                col
+                for col in self.COLUMNS
+                if col in dataset.columns
+                and (self.target_lags or col != "log_bike_count")
+            ]
+        ]
+        if self.tail is not None:
+            rows = pd.concat([self.tail, rows], ignore_index=True)
+
+        recent = rows["date"] >= rows["date"].max() - pd.Timedelta(hours=self.span)
+        self.tail = rows[recent].reset_index(drop=True)
+        return rows
+
+
+@profiled("history_features")
+def history_features(dataset, state=None, compact=False):
+    """Add per-counter lags of the target and rolling weather aggregates.
+
+    - log_bike_count_lag_24h, log_bike_count_lag_168h : the target of the same
+    counter one day and one week before (only if the dataset, or the state, has
+    the target)
+    - rain_3h, rain_6h, rain_24h : the rain over the last 3, 6 and 24 hours
+    - temp_trend_3h : the change of the surface temperature over the last 3 hours
+
+    Missing history (at the start of the data, or for hours without rows) gives
+    missing values, which HistGradientBoostingRegressor handles natively.
+
+    Parameters
+    ----------
+    dataset : pd.dataframe
+        The input dataframe, with 'counter_id', 'date', 'precip_1h' and
+    'temp_surface' columns (and 'log_bike_count' for the lags).
+
+    state : HistoryState, optional
+        The history of the previous rows. It is updated with the rows of the
+    dataset, so that the next call extends the features of the following rows
+    (which should not be older than the ones of the dataset). By default, only
+    the dataset is used.
+
+    compact : boolean, optional
+        Whether to store the features as float32 instead of float64.
+    False by default.
+
+    Returns
+    -------
+    dataset : pd.dataframe
+        The dataset with newly created features.
+    """
+    rows = dataset if state is None else state.extend(dataset)
+
+    columns = _history_columns(
+        rows["counter_id"],
+        rows["date"],
+        rows["log_bike_count"] if "log_bike_count" in rows.columns else None,
+        rows["precip_1h"].to_numpy(dtype="float64"),
+        rows["temp_surface"].to_numpy(dtype="float64"),
+    )
+
+    float_dtype = "float32" if compact else "float64"
+    n_rows = dataset.shape[0]
+    for name, values in columns.items():
+        dataset[name] = values[-n_rows:].astype(float_dtype)
 
     return dataset
@@ -0,0 +1,402 @@
+"""Python script designed to recompute the feature selection from the data.
+
+In this script, we define a relevance_scan function that redoes, on the whole
+train set, the analysis behind the columns kept by feature_selector.py:
+
+1. The Pearson correlations between all the numerical columns (the 41 weather
+attributes and the counter attributes) and the target are accumulated chunk by
+chunk (correlation_matrix), on the rows where both columns are observed.
+Constant columns and the columns almost uncorrelated with the target are
+dropped, and of each group of highly correlated columns only the one the most
+correlated with the target is kept.
+2. The regressor of model.py, with fewer boosting iterations, is fitted on each
+time series fold with the remaining columns (feature_transformer being the
+first step of its pipeline), and the permutation importance of every column is
+computed on the validation part, the folds being run in parallel processes. Only the columns
+that feature_selection can keep are permuted: permuting one also changes the
+features engineered from it. The columns whose permutation does not increase
+the error on average are dropped.
+
+The result is cached as JSON in a file named after a fingerprint of the data
+files and of the parameters, so that running the scan again on the same data
+is immediate, and written as the selection config read by feature_selector.py:
+
+    python cli.py relevance --splits 5
+"""
+
+import json
+from pathlib import Path
+
+import joblib
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.inspection import permutation_importance
+from sklearn.model_selection import TimeSeriesSplit
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+from load_data import load_data, get_data_paths, file_fingerprint
+from feature_selector import selection_config_path
+from feature_engineering import HistoryState, feature_transformer
+from preprocessor import preprocessor_generator
+from null_manager import null_imputer
+from model import make_regressor
+from hyperparameters import load_hyperparameters
+from profiling import stage
+
+# Columns always kept: the keys of the model and the inputs of feature_transformer,
+# the ones of the history features included (counter_id, date, precip_1h and
+# temp_surface)
+REQUIRED_COLUMNS = [col for col in HistoryState.COLUMNS if col != "log_bike_count"]
+
+# Numerical columns which are not features (the targets, the station and site ids)
+NON_FEATURE_COLUMNS = ["bike_count", "log_bike_count", "id_poste", "site_id"]
+
+MIN_TARGET_CORRELATION = 0.01  # below, a column is dropped as irrelevant
+MAX_PAIR_CORRELATION = 0.97  # above, two columns are considered redundant
+
+
+def correlation_matrix(dataset, columns, chunk_rows=100_000):
+    """Compute the Pearson correlations between columns, by chunks of rows.
+
+    Each correlation is computed on the rows where both columns are observed.
+    The sums needed by all the pairs are accumulated with matrix products over
+    chunks of rows, so that only one chunk is converted to float64 at once.
+
+    Parameters
+    ----------
+    dataset : pd.dataframe
+        The input dataframe.
+
+    columns : list
+        The numerical columns to correlate.
+
+    chunk_rows : int, optional
+        Number of rows converted and accumulated at once. 100 000 by default.
+
+    Returns
+    -------
+    correlations : np.ndarray of shape (len(columns), len(columns))
+        The correlations (NaN for the pairs with a constant column, or without
+    common observed rows).
+    """
+    n_columns = len(columns)
+    counts, sums, squares, products = (
+        np.zeros((n_columns, n_columns)) for _ in range(4)
+    )
+    shift = None
+
+    for start in range(0, dataset.shape[0], chunk_rows):
+        values = dataset.iloc[start : start + chunk_rows][columns]
+        values = values.to_numpy(dtype="float64", na_value=np.nan)
+
+        # the values are shifted by the means of the first chunk, to avoid the
+        # cancellation of large sums in the variances
+        if shift is None:
+            shift = np.nan_to_num(np.nanmean(values, axis=0))
+        observed = ~np.isnan(values)
+        values = np.where(observed, values - shift, 0.0)
+        observed = observed.astype("float64")
+
+        # [i, j] is summed over the rows where both the columns i and j are observed
+        counts += observed.T @ observed
+        sums += values.T @ observed
+        squares += (values**2).T @ observed
+        products += values.T @ values
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariances = products - sums * sums.T / counts
+        variances = squares - sums**2 / counts
+        correlations = covariances / np.sqrt(variances * variances.T)
+
+    # the variances of (almost) constant columns are rounding errors
+    constant = variances <= 1e-12 * np.maximum(squares, 1.0)
+    correlations[constant | constant.T] = np.nan
+    return np.clip(correlations, -1.0, 1.0)
+
+
+def correlation_selection(correlations, columns, target="log_bike_count"):
+    """Select the columns from their correlations (step 1 of the scan).
+
+    Parameters
+    ----------
+    correlations : np.ndarray
+        The correlations between the columns (see correlation_matrix).
+
+    columns : list
+        The columns, the target included.
+
+    target : str, optional
+        The target column. 'log_bike_count' by default.
+
+    Returns
+    -------
+    kept : list
+        The selected columns, from the most to the least correlated with the
+    target.
+
+    dropped : dict
+        The reason of the removal of each other column.
+    """
+    target_pos = columns.index(target)
+    target_correlations = np.abs(correlations[target_pos])
+    kept, dropped = [], {}
+
+    # the columns the most correlated with the target are considered first, so
+    # that they are the ones kept among redundant columns
+    order = np.argsort(-np.nan_to_num(target_correlations, nan=-1.0), kind="stable")
+
+    for pos in order.tolist():
+        column = columns[pos]
+        if column == target:
+            continue
+        if np.isnan(correlations[pos, pos]):
+            dropped[column] = "constant"
+        elif not target_correlations[pos] >= MIN_TARGET_CORRELATION:
+            dropped[column] = (
+                f"low correlation (<{MIN_TARGET_CORRELATION}) with {target}"
+            )
+        else:
+            redundant = [
+                other
+                for other in kept
+                if abs(correlations[pos, columns.index(other)]) > MAX_PAIR_CORRELATION
+            ]
+            if redundant:
+                dropped[column] = (
+                    f"high correlation (>{MAX_PAIR_CORRELATION}) with {redundant[0]}"
+                )
+            else:
+                kept.append(column)
+
+    return kept, dropped
+
+
+def _engineered_features(dataset):
+    """Apply feature_transformer to a copy of the dataset (left unchanged)."""
+    return feature_transformer(dataset.copy())
+
+
+def _fold_importance(pipeline, x, y, train_rows, val_rows, n_repeats, seed):
+    """Fit the pipeline on a fold and return the permutation importance of each column."""
+    pipeline.fit(x.iloc[train_rows], y.iloc[train_rows])
+    importance = permutation_importance(
+        pipeline,
+        x.iloc[val_rows],
+        y.iloc[val_rows],
+        scoring="neg_root_mean_squared_error",
+        n_repeats=n_repeats,
+        random_state=seed,
+    )
+    return importance.importances_mean
+
+
+def permutation_scan(dataset, n_splits=5, n_repeats=3, max_iter=200, n_jobs=-1):
+    """Compute the permutation importance of the columns over time series folds.
+
+    Parameters
+    ----------
+    dataset : pd.dataframe
+        The train set (sorted by dates), with the target and the columns to
+    evaluate, before feature_transformer.
+
+    n_splits : int, optional
+        Number of time series folds. 5 by default.
+
+    n_repeats : int, optional
+        Number of permutations of each column. 3 by default.
+
+    max_iter : int, optional
+        Number of boosting iterations of the model. 200 by default.
+
+    n_jobs : int, optional
+        Number of folds evaluated in parallel processes. -1 (one per CPU) by
+    default.
+
+    Returns
+    -------
+    importances : dict
+        The increase of the validation RMSE when permuting each column of the
+    dataset (with the features engineered from it), averaged over the folds.
+    """
+    x = dataset.drop(columns=["log_bike_count"])
+    y = dataset["log_bike_count"]
+
+    # the engineered features are computed inside the pipeline, from the
+    # (permuted) columns, and are not permuted themselves
+    x_engineered = _engineered_features(x.head())
+
+    pipeline = Pipeline(
+        steps=[
+            (
+                "feature_transformer",
+                FunctionTransformer(_engineered_features, validate=False),
+            ),
+            (
+                "preprocessor",
+                preprocessor_generator(x_engineered, native_categorical=True),
+            ),
+            (
+                "regressor",
+                make_regressor(
+                    x_engineered, native_categorical=True, max_iter=max_iter
+                ),
+            ),
+        ]
+    )
+
+    fold_importances = Parallel(n_jobs=n_jobs)(
+        delayed(_fold_importance)(clone(pipeline), x, y, train, val, n_repeats, fold)
+        for fold, (train, val) in enumerate(TimeSeriesSplit(n_splits).split(x))
+    )
+    return dict(zip(x.columns, np.mean(fold_importances, axis=0).tolist()))
+
+
+def relevance_scan(
+    kaggle=False,
+    data_paths=None,
+    n_splits=5,
+    n_repeats=3,
+    max_iter=200,
+    n_jobs=-1,
+    cache_dir=None,
+):
+    """Recompute the selected columns from the train set (see the module docstring).
+
+    Parameters
+    ----------
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. False by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files (see load_data).
+
+    n_splits, n_repeats, max_iter, n_jobs : int, optional
+        The parameters of the permutation importance (see permutation_scan).
+
+    cache_dir : str or Path, optional
+        Directory of the cached results. By default, a 'cache' folder next to
+    the train file locally, and '/kaggle/working/relevance_cache' on Kaggle.
+
+    Returns
+    -------
+    config : dict
+        The selection config: the 'selected_columns', the reason of the removal
+    of the 'dropped' columns, the 'target_correlations' and the
+    'permutation_importances', and the 'fingerprint' of the data and parameters.
+    """
+    train_path, test_path, weather_path = data_paths or get_data_paths(kaggle)
+    if cache_dir is None:
+        cache_dir = (
+            "/kaggle/working/relevance_cache"
+            if kaggle
+            else Path(train_path).parent / "cache"
+        )
+
+    parameters = {
+        "required_columns": REQUIRED_COLUMNS,
+        "min_target_correlation": MIN_TARGET_CORRELATION,
+        "max_pair_correlation": MAX_PAIR_CORRELATION,
+        "n_splits": n_splits,
+        "n_repeats": n_repeats,
+        "max_iter": max_iter,
+        "hyperparameters": load_hyperparameters(native_categorical=True),
+    }
+    fingerprint = joblib.hash(
+        (file_fingerprint(train_path), file_fingerprint(weather_path), parameters)
+    )
+    cache_path = Path(cache_dir) / f"relevance_{fingerprint}.json"
+    if cache_path.exists():
+        with open(cache_path) as file:
+            return json.load(file)
+
+    train, _ = load_data(
+        kaggle=kaggle, data_paths=(train_path, test_path, weather_path)
+    )
+    train = null_imputer(train)
+
+    # 1. correlations between the numerical columns and the target
+
+    columns = [
+        col
+        for col in train.select_dtypes("number").columns
+        if col not in NON_FEATURE_COLUMNS
+    ] + ["log_bike_count"]
+    with stage("correlation_matrix", train):
+        correlations = correlation_matrix(train, columns)
+    kept, dropped = correlation_selection(correlations, columns)
+    dropped.update(
+        (col, "not a numerical column")
+        for col in train.columns
+        if col not in columns + NON_FEATURE_COLUMNS
+    )
+    for col in REQUIRED_COLUMNS:
+        dropped.pop(col, None)
+
+    # 2. permutation importance of the remaining columns
+
+    candidates = [col for col in kept if col not in REQUIRED_COLUMNS]
+    with stage("permutation_scan", train):
+        importances = permutation_scan(
+            train[REQUIRED_COLUMNS + candidates + ["log_bike_count"]],
+            n_splits=n_splits,
+            n_repeats=n_repeats,
+            max_iter=max_iter,
+            n_jobs=n_jobs,
+        )
+    for col in candidates:
+        if importances[col] <= 0:
+            dropped[col] = "no permutation importance (reduce the model's performance)"
+
+    config = {
+        "selected_columns": REQUIRED_COLUMNS
+        + [col for col in candidates if col not in dropped],
+        "dropped": dropped,
+        "target_correlations": dict(
+            zip(columns[:-1], np.nan_to_num(correlations[-1, :-1]).tolist())
+        ),
+        "permutation_importances": importances,
+        "fingerprint": fingerprint,
+        "parameters": parameters,
+    }
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, "w") as file:
+        json.dump(config, file, indent=2)
+    return config
+
+
+def main(kaggle=False, data_paths=None, output=None, **scan_params):
+    """Run the scan and write the selection config read by feature_selector.py.
+
+    Parameters
+    ----------
+    kaggle, data_paths :
+        See relevance_scan.
+
+    output : str or Path, optional
+        The selection config. feature_selector.selection_config_path() by default.
+
+    **scan_params :
+        The other parameters of relevance_scan.
+
+    Returns
+    -------
+    config : dict
+        The selection config (see relevance_scan).
+    """
+    output = output or selection_config_path()
+    config = relevance_scan(kaggle=kaggle, data_paths=data_paths, **scan_params)
+    with open(output, "w") as file:
+        json.dump(config, file, indent=2)
+
+    print(f"Selected columns: {', '.join(config['selected_columns'])}")
+    for col, reason in config["dropped"].items():
+        print(f"  dropped {col}: {reason}")
+    print(f"Selection config written in {output}")
+    return config
+
+
+if __name__ == "__main__":
+    main()
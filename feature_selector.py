@@ -3,9 +3,117 @@
 In this script, we define a feature_selection function that allows us to include or exclude features 
 from the dataset in a SQL-like fashion. This function streamlines the process of feature selection 
 and model testing, making it easier to experiment with different subsets of features.
+
+The selected columns are read from the config written by feature_relevance.py
+when there is one, and are the hand-maintained list below otherwise.
 """
 
+import json
+import os
+from pathlib import Path
+
+from profiling import profiled
+
+
+def selection_config_path():
+    """Return the path of the selection config written by feature_relevance.py.
+
+    The path can be changed with the BIKE_COUNTERS_FEATURES environment variable,
+    read at each call. When the config exists, its columns replace the
+    hand-maintained list below.
+
+    Returns
+    -------
+    path : Path
+        The selection config.
+    """
+    return Path(
+        os.environ.get(
+            "BIKE_COUNTERS_FEATURES",
+            Path(__file__).with_name("feature_selection.json"),
+        )
+    )
+
+
+# Features kept in the dataset when there is no selection config.
+
+DEFAULT_SELECTED_COLUMNS = [
+    "counter_id",
+    ###########"site_name",
+    "date",
+    ###########"counter_installation_date",  --> low correlation (<0.01) with target
+    ###########"latitude_counter",  --> high correlation (>0.97) with counter_id
+    "duree_precip",
+    ###########"vent_moyen_10m",  --> high correlation (>0.97) with vent_inst_max
+    ###########"vent_max",  --> high correlation (>0.97) with vent_inst_max
+    "vent_inst_max",
+    ###########"vent_max_3s",  --> high correlation (>0.97) with vent_inst_max
+    ###########"point_rosée",
+    ###########"temp_min_10cm",  --> high correlation (>0.97) with temp_surface
+    ###########"temp_min_50cm",  --> high correlation (>0.97) with temp_surface
+    "temp_surface",
+    ###########"humidite",  --> reduce the model's performance
+    ###########"humidite_min",  --> high correlation (>0.97) with humidite
+    ###########"humidite_max",  --> high correlation (>0.97) with humidite
+    ###########"duree_humidite_40",  --> high correlation (>0.97) with duree_humidite_80
+    "duree_humidite_80",
+    ###########"pression_station",   --> low correlation (<0.01) with target
+    ###########"visibilite",
+    ###########"code_meteo",
+    "duree_ensoleillement_utc",
+    "precip_1h",
+    ###########"temperature",  --> high correlation (>0.97) with temp_surface
+    ###########"temp_min",  --> high correlation (>0.97) with temp_surface
+    ###########"temp_max",  --> high correlation (>0.97) with temp_surface
+    ###########"duree_gel"
+    # ------------------------#
+    ###########"counter_technical_id",  --> redundant with counter_id
+    ###########"counter_name",  --> redundant with counter_id
+    ###########"site_id",  --> redundant with site_name
+    ###########"coordinates",  --> redundant with latitude_counter and longitude_counter
+    ###########"id_poste",  --> redundant with nom_poste
+    ###########"pression_mer",  --> high correlation (>0.97) with pression_station
+    ###########"nom_poste",  --> constant
+    ###########"latitude_poste",  --> constant
+    ###########"longitude_poste",  --> constant
+    ###########"altitude",  --> constant
+    ###########"longitude_counter",  --> low correlation (<0.01) with target
+    ###########"direction_vent_10m",  --> low correlation (<0.01) with target
+    ###########"direction_vent_max",  --> low correlation (<0.01) with target
+    ###########"heure_vent_max",  --> low correlation (<0.01) with target
+    ###########"direction_vent_inst_max",  --> low correlation (<0.01) with target
+    ###########"heure_vent_inst_max",  --> low correlation (<0.01) with target
+    ###########"heure_vent_max_3s",  --> low correlation (<0.01) with target
+    ###########"heure_humidite_min",  --> low correlation (<0.01) with target
+    ###########"heure_humidite_max",  --> low correlation (<0.01) with target
+    ###########"heure_temp_min",  --> low correlation (<0.01) with target
+    ###########"heure_temp_max",  --> low correlation (<0.01) with target
+]
+
+
+def load_selected_columns(path=None):
+    """Return the columns of the selection config, or the default ones without it.
+
+    Parameters
+    ----------
+    path : str or Path, optional
+        The selection config written by feature_relevance.py.
+    selection_config_path() by default.
+
+    Returns
+    -------
+    columns : list
+        The selected columns (also given to load_data, so that the other
+    columns are never read).
+    """
+    path = Path(path or selection_config_path())
+    if not path.exists():
+        return list(DEFAULT_SELECTED_COLUMNS)
+    with open(path) as file:
+        return json.load(file)["selected_columns"]
+
 
+@profiled("feature_selection")
 def feature_selection(dataset, test_set=False):
     """Filter the input dataset to include only the selected features.
 
@@ -25,58 +133,7 @@ def feature_selection(dataset, test_set=False):
     dataset : pd.dataframe
         The dataset reduced ton the chosen features.
     """
-    selected_columns = [
-        "counter_id",
-        ###########"site_name",
-        "date",
-        ###########"counter_installation_date",  --> low correlation (<0.01) with target
-        ###########"latitude_counter",  --> high correlation (>0.97) with counter_id
-        "duree_precip",
-        ###########"vent_moyen_10m",  --> high correlation (>0.97) with vent_inst_max
-        ###########"vent_max",  --> high correlation (>0.97) with vent_inst_max
-        "vent_inst_max",
-        ###########"vent_max_3s",  --> high correlation (>0.97) with vent_inst_max
-        ###########"point_rosée",
-        ###########"temp_min_10cm",  --> high correlation (>0.97) with temp_surface
-        ###########"temp_min_50cm",  --> high correlation (>0.97) with temp_surface
-        "temp_surface",
-        ###########"humidite",  --> reduce the model's performance
-        ###########"humidite_min",  --> high correlation (>0.97) with humidite
-        ###########"humidite_max",  --> high correlation (>0.97) with humidite
-        ###########"duree_humidite_40",  --> high correlation (>0.97) with duree_humidite_80
-        "duree_humidite_80",
-        ###########"pression_station",   --> low correlation (<0.01) with target
-        ###########"visibilite",
-        ###########"code_meteo",
-        "duree_ensoleillement_utc",
-        "precip_1h",
-        ###########"temperature",  --> high correlation (>0.97) with temp_surface
-        ###########"temp_min",  --> high correlation (>0.97) with temp_surface
-        ###########"temp_max",  --> high correlation (>0.97) with temp_surface
-        ###########"duree_gel"
-        # ------------------------#
-        ###########"counter_technical_id",  --> redundant with counter_id
-        ###########"counter_name",  --> redundant with counter_id
-        ###########"site_id",  --> redundant with site_name
-        ###########"coordinates",  --> redundant with latitude_counter and longitude_counter
-        ###########"id_poste",  --> redundant with nom_poste
-        ###########"pression_mer",  --> high correlation (>0.97) with pression_station
-        ###########"nom_poste",  --> constant
-        ###########"latitude_poste",  --> constant
-        ###########"longitude_poste",  --> constant
-        ###########"altitude",  --> constant
-        ###########"longitude_counter",  --> low correlation (<0.01) with target
-        ###########"direction_vent_10m",  --> low correlation (<0.01) with target
-        ###########"direction_vent_max",  --> low correlation (<0.01) with target
-        ###########"heure_vent_max",  --> low correlation (<0.01) with target
-        ###########"direction_vent_inst_max",  --> low correlation (<0.01) with target
-        ###########"heure_vent_inst_max",  --> low correlation (<0.01) with target
-        ###########"heure_vent_max_3s",  --> low correlation (<0.01) with target
-        ###########"heure_humidite_min",  --> low correlation (<0.01) with target
-        ###########"heure_humidite_max",  --> low correlation (<0.01) with target
-        ###########"heure_temp_min",  --> low correlation (<0.01) with target
-        ###########"heure_temp_max",  --> low correlation (<0.01) with target
-    ]
+    selected_columns = load_selected_columns()
 
     if not test_set:
         selected_columns = selected_columns + [
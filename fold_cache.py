@@ -0,0 +1,173 @@
+"""Python script designed to cache the preprocessed cross-validation folds.
+
+In this script, we define a build_fold_cache function that fits the preprocessor
+once per cross-validation fold and stores the resulting train and validation
+matrices, in memory or on disk. During a hyperparameter search only the model
+changes between trials, so every trial can reuse these matrices and spend its
+time fitting the model instead of preprocessing the same data again.
+"""
+
+from pathlib import Path
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+
+_FOLD_ARRAYS = ["X_train", "y_train", "X_val", "y_val"]
+
+
+def to_dense(matrix):
+    """Convert a sparse matrix into a dense array (dense inputs are returned as is)."""
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
+
+
+def build_fold_cache(preprocessor, x, y, cv, cache_dir=None):
+    """Preprocess each cross-validation fold once and return the resulting matrices.
+
+    For each fold, a clone of the preprocessor is fitted on the train part and
+    used to transform both the train and the validation parts, exactly as a
+    Pipeline would do when fitted on the fold.
+
+    Parameters
+    ----------
+    preprocessor : sklearn transformer
+        The (unfitted) preprocessor, e.g. from preprocessor_generator.
+
+    x : pd.DataFrame
+        The features.
+
+    y : pd.Series
+        The target.
+
+    cv : cross-validation generator
+        The splitter, e.g. TimeSeriesSplit(n_splits=5).
+
+    cache_dir : str or Path, optional
+        If given, the matrices are saved in this directory as .npy files, to be
+    memory-mapped with load_fold_cache, and are reused by later runs on the same
+    data, preprocessor and splitter. Each fold is saved and released as soon as
+    it is built, so that only the matrices of one fold are in memory at once.
+    Kept in memory by default.
+
+    Returns
+    -------
+    folds : list of tuples, or Path
+        (X_train_fold, y_train_fold, X_val_fold, y_val_fold) for each fold, as
+    dense NumPy arrays. With a cache_dir, the directory of the saved matrices
+    instead (see load_fold_cache), so that the key of the cache is computed
+    once and given as is to the processes loading the folds.
+    """
+    if cache_dir is not None:
+        fold_dir = fold_cache_path(preprocessor, x, y, cv, cache_dir)
+        if (fold_dir / "done").exists():
+            return fold_dir
+        fold_dir.mkdir(parents=True, exist_ok=True)
+
+    folds = []
+    for i, (train_index, val_index) in enumerate(cv.split(x)):
+        X_train_fold, X_val_fold = x.iloc[train_index], x.iloc[val_index]
+        y_train_fold, y_val_fold = y.iloc[train_index], y.iloc[val_index]
+
+        fold_preprocessor = clone(preprocessor)
+        fold = (
+            to_dense(fold_preprocessor.fit_transform(X_train_fold)),
+            y_train_fold.to_numpy(),
+            to_dense(fold_preprocessor.transform(X_val_fold)),
+            y_val_fold.to_numpy(),
+        )
+        del X_train_fold, X_val_fold
+
+        if cache_dir is None:
+            folds.append(fold)
+        else:
+            for name, array in zip(_FOLD_ARRAYS, fold):
+                np.save(fold_dir / f"fold{i}_{name}.npy", array)
+        del fold  # (released before the next fold is built, once saved)
+
+    if cache_dir is None:
+        return folds
+
+    # the folds are only reused once all of them are saved
+    (fold_dir / "done").write_text(str(cv.get_n_splits(x)))
+
+    return fold_dir
+
+
+def data_fingerprint(data):
+    """Compute a fingerprint of the content of a dataframe or a series.
+
+    The values are hashed row by row with pd.util.hash_pandas_object, with the
+    column names and dtypes, and not through a pickle of the object: the pickle
+    of a dataframe also depends on its internal state (e.g. cached blocks after
+    an iloc), so that equal dataframes could get different fingerprints.
+
+    Parameters
+    ----------
+    data : pd.DataFrame or pd.Series
+        The data.
+
+    Returns
+    -------
+    fingerprint : str
+        The hex digest of the content.
+    """
+    frame = data.to_frame() if isinstance(data, pd.Series) else data
+    row_hashes = pd.util.hash_pandas_object(frame, index=True).to_numpy()
+    return joblib.hash(
+        (row_hashes, list(frame.columns), frame.dtypes.astype(str).tolist())
+    )
+
+
+def fold_cache_path(preprocessor, x, y, cv, cache_dir):
+    """Return the directory where build_fold_cache stores the folds of these inputs.
+
+    Parameters
+    ----------
+    preprocessor, x, y, cv :
+        See build_fold_cache.
+
+    cache_dir : str or Path
+        The cache directory given to build_fold_cache.
+
+    Returns
+    -------
+    fold_dir : Path
+        The directory of the fold matrices, named after a hash of the inputs.
+    """
+    key = joblib.hash(
+        (
+            data_fingerprint(x),
+            data_fingerprint(y),
+            preprocessor.get_params(),
+            repr(cv),
+        )
+    )
+    return Path(cache_dir) / key
+
+
+def load_fold_cache(fold_dir):
+    """Memory-map the fold matrices saved by build_fold_cache in fold_dir.
+
+    Several processes can load the same folds this way without copying them.
+
+    Parameters
+    ----------
+    fold_dir : str or Path
+        The directory of the fold matrices (see fold_cache_path).
+
+    Returns
+    -------
+    folds : list of tuples
+        (X_train_fold, y_train_fold, X_val_fold, y_val_fold) for each fold, as
+    read-only memory-mapped arrays.
+    """
+    fold_dir = Path(fold_dir)
+    n_folds = int((fold_dir / "done").read_text())
+    return [
+        tuple(
+            np.load(fold_dir / f"fold{i}_{name}.npy", mmap_mode="r")
+            for name in _FOLD_ARRAYS
+        )
+        for i in range(n_folds)
+    ]
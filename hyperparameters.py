@@ -0,0 +1,87 @@
+"""Python script designed to share the hyperparameters of the model.
+
+The hyperparameters found by opt_hg.py, with the number of boosting iterations
+chosen by early stopping, are saved in a JSON file and read back by
+kaggle_script.py and testing_models.py. The hand-tuned values below are used
+when there is no such file, or when it was tuned for the other encoding of the
+categorical features (one-hot or native, see preprocessor_generator).
+"""
+
+import json
+import os
+from pathlib import Path
+
+# Hand-tuned values (with one-hot encoded categorical features)
+
+DEFAULT_HYPERPARAMETERS = {
+    "max_iter": 1855,
+    "max_depth": 14,
+    "learning_rate": 0.07364924738942269,
+}
+
+# File written by opt_hg.py (the path can be changed with the
+# BIKE_COUNTERS_HYPERPARAMETERS environment variable)
+
+HYPERPARAMETERS_PATH = Path(
+    os.environ.get("BIKE_COUNTERS_HYPERPARAMETERS", "best_hyperparameters.json")
+)
+
+
+def save_hyperparameters(hyperparameters, native_categorical, path=None):
+    """Save tuned hyperparameters of the HistGradientBoostingRegressor.
+
+    Parameters
+    ----------
+    hyperparameters : dict
+        The hyperparameters, including 'max_iter'.
+
+    native_categorical : boolean
+        Whether they were tuned with natively handled categorical features.
+
+    path : str or Path, optional
+        The JSON file. HYPERPARAMETERS_PATH by default.
+
+    Returns
+    -------
+    path : Path
+        The JSON file.
+    """
+    path = Path(path or HYPERPARAMETERS_PATH)
+    with open(path, "w") as file:
+        json.dump(
+            {
+                "hyperparameters": hyperparameters,
+                "native_categorical": native_categorical,
+            },
+            file,
+            indent=2,
+        )
+    return path
+
+
+def load_hyperparameters(native_categorical=False, path=None):
+    """Return the hyperparameters of the HistGradientBoostingRegressor.
+
+    Parameters
+    ----------
+    native_categorical : boolean, optional
+        Whether the categorical features are handled natively by the model.
+    False by default.
+
+    path : str or Path, optional
+        The JSON file written by opt_hg.py. HYPERPARAMETERS_PATH by default.
+
+    Returns
+    -------
+    hyperparameters : dict
+        The tuned hyperparameters if they were tuned with the same handling of
+    the categorical features, DEFAULT_HYPERPARAMETERS otherwise.
+    """
+    path = Path(path or HYPERPARAMETERS_PATH)
+    hyperparameters = dict(DEFAULT_HYPERPARAMETERS)
+    if path.exists():
+        with open(path) as file:
+            saved = json.load(file)
+        if saved["native_categorical"] == native_categorical:
+            hyperparameters.update(saved["hyperparameters"])
+    return hyperparameters
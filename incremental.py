@@ -0,0 +1,315 @@
+"""Python script designed to update the enriched train set incrementally.
+
+In this script, we define an init_store function that builds the enriched train
+set once (as load_data does) and keeps it on disk, with the cleaned weather data,
+and an update_store function that appends new hourly counts and weather
+observations to it. Only the new rows are parsed and joined, so that a nightly
+refresh costs in proportion to the new data, not to the whole history.
+
+The store is a directory holding:
+- 'counts/part-*.parquet' : the enriched counts, one file per update
+- 'weather/part-*.parquet' : the cleaned weather data, one file per update
+- 'stations.parquet' : the nearest weather station of each counter
+- 'state.json' : the last count and weather dates ingested
+
+The weather of the new counts should be ingested in the same update or before:
+counts more recent than the last weather observation get missing weather values.
+
+The store is created and updated with "python cli.py ingest", and read instead
+of the train and weather files by load_data and load_data_batches (store_dir),
+e.g. with "python cli.py cv --store store".
+"""
+
+import json
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from load_data import (
+    GLOBAL_WEATHER_COLUMNS,
+    LOCAL_WEATHER_COLUMNS,
+    clean_weather,
+    get_data_paths,
+    load_weather,
+    prepare_weather,
+)
+from weather_join import join_weather
+
+# weather measurements are stored as float64, so that a missing value in an
+# update does not change the schema of the store
+MEASURE_COLUMNS = [
+    col
+    for col in GLOBAL_WEATHER_COLUMNS + LOCAL_WEATHER_COLUMNS
+    if col not in ["id_poste", "nom_poste", "date"]
+]
+
+
+def _float_measures(dataset):
+    """Cast the integer weather measurements of a dataframe to float64."""
+    return dataset.astype(
+        {
+            col: "float64"
+            for col in dataset.columns
+            if col in MEASURE_COLUMNS and dataset[col].dtype.kind in "iub"
+        }
+    )
+
+
+def _append_part(directory, dataset):
+    """Write a dataframe as a new parquet file of a directory."""
+    directory.mkdir(parents=True, exist_ok=True)
+    n_parts = len(list(directory.glob("part-*.parquet")))
+    dataset.to_parquet(directory / f"part-{n_parts:05d}.parquet", index=False)
+
+
+def _read_state(store_dir):
+    """Read the state of a store, with its dates as Timestamps."""
+    state = json.loads((Path(store_dir) / "state.json").read_text())
+    return {key: pd.Timestamp(value) for key, value in state.items()}
+
+
+def _write_state(store_dir, last_count_date, last_weather_date):
+    """Write the state of a store."""
+    (Path(store_dir) / "state.json").write_text(
+        json.dumps(
+            {
+                "last_count_date": str(last_count_date),
+                "last_weather_date": str(last_weather_date),
+            }
+        )
+    )
+
+
+def _enrich(counts, weather_filtered, stations):
+    """Sort counts by dates and join the weather to them (see load_data).
+
+    Returns the enriched counts and the updated nearest station of each counter
+    (the stations of already known counters are kept).
+    """
+    counts = counts.reset_index(drop=True)
+    if not counts["date"].is_monotonic_increasing:
+        counts = counts.sort_values("date")
+
+    weather_index, nearest_station_by_counter = prepare_weather(
+        weather_filtered, counts
+    )
+    if stations is not None:
+        new_counters = ~nearest_station_by_counter["counter_id"].isin(
+            stations["counter_id"]
+        )
+        nearest_station_by_counter = pd.concat(
+            [stations, nearest_station_by_counter[new_counters]], ignore_index=True
+        )
+
+    counts = join_weather(counts, weather_index, nearest_station_by_counter)
+    return _float_measures(counts), nearest_station_by_counter
+
+
+def init_store(store_dir, kaggle=False, data_paths=None, cache=True):
+    """Build the enriched train set and save it as a store for incremental updates.
+
+    Parameters
+    ----------
+    store_dir : str or Path
+        The directory of the store (it should not exist yet).
+
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. False by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files (see load_data).
+
+    cache : boolean, optional
+        Whether to use the Parquet cache of the cleaned weather data.
+    True by default.
+    """
+    store_dir = Path(store_dir)
+    train_path, _, weather_path = data_paths or get_data_paths(kaggle)
+
+    weather_filtered = _float_measures(load_weather(weather_path, cache=cache))
+    train, stations = _enrich(pd.read_parquet(train_path), weather_filtered, None)
+
+    _append_part(store_dir / "weather", weather_filtered)
+    _append_part(store_dir / "counts", train)
+    stations.to_parquet(store_dir / "stations.parquet", index=False)
+    _write_state(store_dir, train["date"].max(), weather_filtered["date"].max())
+
+
+def update_store(store_dir, new_counts=None, new_weather=None):
+    """Append new counts and weather observations to a store.
+
+    Only the rows more recent than the last ingested ones are kept, so that
+    overlapping files can be given. The new counts are joined with the stored
+    weather of their period only.
+
+    Parameters
+    ----------
+    store_dir : str or Path
+        The directory of the store (see init_store).
+
+    new_counts : pd.dataframe or str or Path, optional
+        New hourly counts, with the columns of 'train.parquet', or the path of a
+    parquet file holding them.
+
+    new_weather : pd.dataframe or str or Path, optional
+        New raw Météo-France observations, or the path of a CSV file holding
+    them (with the same format as the full weather file).
+
+    Returns
+    -------
+    n_counts, n_weather : tuple of two ints
+        The numbers of count and weather rows appended.
+    """
+    store_dir = Path(store_dir)
+    state = _read_state(store_dir)
+    n_counts, n_weather = 0, 0
+
+    # new weather: only the new rows are cleaned and stored
+
+    if new_weather is not None:
+        if not isinstance(new_weather, pd.DataFrame):
+            new_weather = pd.read_csv(new_weather, sep=";")
+        new_weather = _float_measures(clean_weather(new_weather))
+        new_weather = new_weather[new_weather["date"] > state["last_weather_date"]]
+
+        if not new_weather.empty:
+            _append_part(store_dir / "weather", new_weather)
+            state["last_weather_date"] = new_weather["date"].max()
+            n_weather = new_weather.shape[0]
+
+    # new counts: joined with the stored weather of their period
+
+    if new_counts is not None:
+        if not isinstance(new_counts, pd.DataFrame):
+            new_counts = pd.read_parquet(new_counts)
+        new_counts = new_counts[new_counts["date"] > state["last_count_date"]]
+
+        if not new_counts.empty:
+            weather_filtered = pd.read_parquet(
+                store_dir / "weather",
+                filters=[("date", ">=", new_counts["date"].min())],
+            )
+            if weather_filtered.empty:  # no weather yet: the stations are needed
+                weather_filtered = pd.read_parquet(
+                    sorted((store_dir / "weather").glob("part-*.parquet"))[-1]
+                )
+            weather_filtered["date"] = weather_filtered["date"].astype("datetime64[us]")
+
+            stations = pd.read_parquet(store_dir / "stations.parquet")
+            new_counts, stations = _enrich(new_counts, weather_filtered, stations)
+
+            _append_part(store_dir / "counts", new_counts)
+            stations.to_parquet(store_dir / "stations.parquet", index=False)
+            state["last_count_date"] = new_counts["date"].max()
+            n_counts = new_counts.shape[0]
+
+    _write_state(store_dir, state["last_count_date"], state["last_weather_date"])
+
+    return n_counts, n_weather
+
+
+def _count_parts(store_dir):
+    """Return the parquet files of the counts of a store, oldest first."""
+    return sorted((Path(store_dir) / "counts").glob("part-*.parquet"))
+
+
+def _store_columns(path, columns):
+    """Return the requested columns present in a parquet file (all if None)."""
+    if columns is None:
+        return None
+    names = pq.read_schema(path).names
+    return [col for col in columns if col in names]
+
+
+def _dates_as_us(dataset):
+    """Cast the date column of a dataframe read from the store to datetime64[us]."""
+    if "date" in dataset.columns:
+        dataset["date"] = dataset["date"].astype("datetime64[us]")
+    return dataset
+
+
+def store_exists(store_dir):
+    """Return whether a store was created in a directory (see init_store)."""
+    return (Path(store_dir) / "state.json").exists()
+
+
+def read_store(store_dir, columns=None):
+    """Read the enriched train set of a store.
+
+    Parameters
+    ----------
+    store_dir : str or Path
+        The directory of the store (see init_store).
+
+    columns : list, optional
+        The columns to read, the ones absent from the store being ignored (as
+    in load_data). All of them by default.
+
+    Returns
+    -------
+    train : pd.dataframe
+        The enriched counts, sorted by dates (as returned by load_data).
+    """
+    columns = _store_columns(_count_parts(store_dir)[0], columns)
+    return _dates_as_us(pd.read_parquet(Path(store_dir) / "counts", columns=columns))
+
+
+def iter_store(store_dir, batch_rows=100_000, columns=None):
+    """Iterate over the enriched train set of a store by batches.
+
+    Parameters
+    ----------
+    store_dir : str or Path
+        The directory of the store (see init_store).
+
+    batch_rows : int, optional
+        Maximum number of rows of each batch. 100 000 by default.
+
+    columns : list, optional
+        The columns to read (see read_store). All of them by default.
+
+    Yields
+    ------
+    batch : pd.dataframe
+        A batch of at most batch_rows enriched counts, in the order of the
+    updates.
+    """
+    for path in _count_parts(store_dir):
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(
+            batch_size=batch_rows, columns=_store_columns(path, columns)
+        ):
+            yield _dates_as_us(batch.to_pandas())
+
+
+def read_store_weather(store_dir, columns=None, dates=None):
+    """Read the cleaned weather data of a store (as load_weather reads its cache).
+
+    Parameters
+    ----------
+    store_dir : str or Path
+        The directory of the store (see init_store).
+
+    columns : list, optional
+        The cleaned weather columns to read. All of them by default.
+
+    dates : tuple, optional
+        The first and last dates (Timestamps) to read. All of them by default.
+
+    Returns
+    -------
+    weather_filtered : pd.dataframe
+        The cleaned weather data (see load_data.clean_weather).
+    """
+    filters = None
+    if dates is not None:
+        filters = [("date", ">=", dates[0]), ("date", "<=", dates[1])]
+    return _dates_as_us(
+        pd.read_parquet(Path(store_dir) / "weather", columns=columns, filters=filters)
+    )
+
+
+def read_store_stations(store_dir):
+    """Read the nearest weather station ('id_poste') of each 'counter_id' of a store."""
+    return pd.read_parquet(Path(store_dir) / "stations.parquet")
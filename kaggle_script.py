@@ -5,66 +5,105 @@ fit the model, do predictions on test set and write a CSV file for
 submission.
 """
 
-import pandas as pd
-import numpy as np
-from sklearn.ensemble import HistGradientBoostingRegressor
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import FunctionTransformer
-
 from load_data import load_data
-from feature_selector import feature_selection
-from feature_engineering import feature_transformer
-from preprocessor import preprocessor_generator
-from null_manager import null_imputer
-
-# Running all the scripts to prepare data
-
-train, test = load_data(kaggle=True)
-train = null_imputer(train)
-test = null_imputer(test)
-x_test = feature_selection(test, test_set=True)
-train = feature_selection(train)
-train = feature_transformer(train)
-x_test = feature_transformer(x_test)
-x_train = train.drop(columns=["log_bike_count"])
-y_train = train["log_bike_count"]
-preprocessor = preprocessor_generator(x_train)
-
-# Defining our regressor and our pipeline
-
-regressor = HistGradientBoostingRegressor(
-    max_iter=1855,
-    max_depth=14,
-    learning_rate=0.07364924738942269,
-    random_state=8,  # fixing a random state to avoid random variations
-)
-
-pipeline = Pipeline(
-    steps=[
-        ("preprocessor", preprocessor),
-        (
-            "to_dense",
-            FunctionTransformer(lambda x: x.toarray() if hasattr(x, "toarray") else x),
-        ),
-        ("regressor", regressor),
-    ]
-)
-
-# Fitting the pipeline
-
-pipeline.fit(x_train, y_train)
-
-# Predicting target values for test dataset
-
-test_pred = pipeline.predict(x_test)
-
-# Writing predictions in the appropriate CSV file for submission
-
-results = pd.DataFrame(
-    dict(
-        Id=np.arange(test_pred.shape[0]),
-        log_bike_count=test_pred,
+from feature_selector import feature_selection, load_selected_columns
+from feature_engineering import HistoryState, feature_transformer
+from null_manager import NullImputer
+from batch_scoring import iter_chunks, score_to_csv
+from model import make_pipeline
+
+CHUNK_ROWS = 50_000  # rows predicted at once by each scoring thread
+
+
+def main(
+    kaggle=True,
+    data_paths=None,
+    output="submission.csv",
+    compact=False,
+    native_categorical=False,
+    history_features=None,
+    store_dir=None,
+):
+    """Fit the model on the train set and write the predictions of the test set.
+
+    Parameters
+    ----------
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. True by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files (see load_data).
+
+    output : str or Path, optional
+        The submission CSV file. 'submission.csv' by default.
+
+    compact : boolean, optional
+        Whether to use compact dtypes (float32 measurements, categorical IDs and
+    int8/int16 encoded features) to reduce the memory used. False by default.
+
+    native_categorical : boolean, optional
+        Whether to ordinal-encode the categorical features and let the model
+    handle them natively, instead of one-hot encoding them and scaling the
+    numerical ones. The hyperparameters were tuned for the one-hot encoding,
+    so False by default.
+
+    history_features : str, optional
+        'weather' to add the rolling rain and temperature trend features (see
+    feature_engineering.history_features). The lags of the target are never
+    added: in the test set, they are only known in its first day or week.
+    None (no history features) by default.
+
+    store_dir : str or Path, optional
+        An incremental store to read the train set and the weather data from
+    (see load_data). None by default.
+    """
+    if history_features not in (None, "weather"):
+        raise ValueError(
+            f"history_features should be None or 'weather', got {history_features!r}"
+            " (the lags of the target are unknown in the test set)"
+        )
+
+    # Running all the scripts to prepare data
+
+    train, test = load_data(
+        kaggle=kaggle,
+        data_paths=data_paths,
+        columns=load_selected_columns() + ["log_bike_count"],
+        compact=compact,
+        store_dir=store_dir,
+    )
+    null_imputer = NullImputer().fit(train)  # test is imputed with train statistics
+    train = null_imputer.transform(train)
+    test = null_imputer.transform(test)
+    x_test = feature_selection(test, test_set=True)
+    train = feature_selection(train)
+    # (the history of the last train hours is carried to the test set, which
+    # follows it)
+    history = HistoryState(target_lags=False) if history_features else None
+    train = feature_transformer(train, compact=compact, history=history)
+    x_test = feature_transformer(x_test, compact=compact, history=history)
+    x_train = train.drop(columns=["log_bike_count"])
+    y_train = train["log_bike_count"]
+
+    # Defining our pipeline (with the hyperparameters saved by opt_hg.py, if
+    # tuned for the same encoding, see model.py)
+    # (with native_categorical, categorical features are ordinal-encoded and
+    # handled natively by the model, and no densification is needed)
+
+    pipeline = make_pipeline(
+        x_train, compact=compact, native_categorical=native_categorical
     )
-)
-results.to_csv("submission.csv", index=False)
-print("Done")
+
+    # Fitting the pipeline
+
+    pipeline.fit(x_train, y_train)
+
+    # Predicting target values for test dataset by chunks, in a thread pool, and
+    # writing them in the appropriate CSV file for submission as they complete
+
+    score_to_csv(pipeline, iter_chunks(x_test, CHUNK_ROWS), output)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
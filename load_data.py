@@ -8,147 +8,178 @@ the weather dataset sourced externally by us with meteorological observations
 To run this script locally, ensure you have downloaded the required data files. 
 Update the paths in the else section of the load_data function to point to your 
 local files.
+
+The cleaned weather table is cached as a Parquet file (see load_weather), so the
+raw CSV is only parsed again when its content changes.
 """
 
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import pandas as pd
+import pyarrow.parquet as pq
 from pathlib import Path
-import numpy as np
-from scipy.spatial import cKDTree
 
+from profiling import profiled, stage
+from weather_join import build_weather_index, join_weather
 
-def load_data(kaggle=False):
-    """Load all data files, merge them appropriately and return the train and test dataframe.
+# Bump this when the cleaning steps of load_weather change, so that stale caches
+# are not reused.
+WEATHER_CACHE_VERSION = 1
+
+# Météo-France column codes kept from the raw weather file and their new names.
+WEATHER_COLUMNS = {
+    "NUM_POSTE": "id_poste",
+    "NOM_USUEL": "nom_poste",
+    "LAT": "latitude",
+    "LON": "longitude",
+    "ALTI": "altitude",
+    "AAAAMMJJHH": "date",
+    "RR1": "precip_1h",
+    "DRR1": "duree_precip",
+    "FF": "vent_moyen_10m",
+    "DD": "direction_vent_10m",
+    "FXY": "vent_max",
+    "DXY": "direction_vent_max",
+    "HXY": "heure_vent_max",
+    "FXI": "vent_inst_max",
+    "DXI": "direction_vent_inst_max",
+    "HXI": "heure_vent_inst_max",
+    "FXI3S": "vent_max_3s",
+    "HFXI3S": "heure_vent_max_3s",
+    "T": "temperature",
+    "TD": "point_rosée",
+    "TN": "temp_min",
+    "HTN": "heure_temp_min",
+    "TX": "temp_max",
+    "HTX": "heure_temp_max",
+    "DG": "duree_gel",
+    "TNSOL": "temp_min_10cm",
+    "TN50": "temp_min_50cm",
+    "TCHAUSSEE": "temp_surface",
+    "U": "humidite",
+    "UN": "humidite_min",
+    "HUN": "heure_humidite_min",
+    "UX": "humidite_max",
+    "HUX": "heure_humidite_max",
+    "DHUMI40": "duree_humidite_40",
+    "DHUMI80": "duree_humidite_80",
+    "PMER": "pression_mer",
+    "PSTAT": "pression_station",
+    "VV": "visibilite",
+    "WW": "code_meteo",
+    "INS": "duree_ensoleillement_utc",
+    "INS2": "duree_ensoleillement_tsv",
+}
+
+# The weather dataset is split into two parts (based on null analysis):
+# - Attributes that can be taken from the nearest station to each counter.
+# - Attributes that are only available from a single station (null in the others)
+#   and therefore cannot be analyzed on a local scale.
+
+GLOBAL_STATION = 75114001
+
+GLOBAL_WEATHER_COLUMNS = [
+    "nom_poste",
+    "latitude",
+    "longitude",
+    "altitude",
+    "date",
+    "duree_precip",
+    "vent_moyen_10m",
+    "direction_vent_10m",
+    "vent_max",
+    "direction_vent_max",
+    "heure_vent_max",
+    "vent_inst_max",
+    "direction_vent_inst_max",
+    "heure_vent_inst_max",
+    "vent_max_3s",
+    "heure_vent_max_3s",
+    "point_rosée",
+    "temp_min_10cm",
+    "temp_min_50cm",
+    "temp_surface",
+    "humidite",
+    "humidite_min",
+    "heure_humidite_min",
+    "humidite_max",
+    "heure_humidite_max",
+    "duree_humidite_40",
+    "duree_humidite_80",
+    "pression_mer",
+    "pression_station",
+    "visibilite",
+    "code_meteo",
+    "duree_ensoleillement_utc",
+]
+
+LOCAL_WEATHER_COLUMNS = [
+    "id_poste",
+    "date",
+    "precip_1h",
+    "temperature",
+    "temp_min",
+    "heure_temp_min",
+    "temp_max",
+    "heure_temp_max",
+    "duree_gel",
+]
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """Compute a fingerprint of the content of a file.
 
     Parameters
     ----------
-    kaggle : boolean, optional
-        Whether to use Kaggle paths for accessing the data. If False, local paths
-    are used. False by default.
+    path : str or Path
+        Path of the file.
+
+    chunk_size : int, optional
+        Number of bytes read at once. 1 MiB by default.
 
     Returns
     -------
-    train, test : tuple of two pd.dataframes
-        Train and test dataset available on the competition dataset enriched with the
-    weather data (including precipitation, temperature, wind information, etc.). Train
-    is sorted by dates.
+    fingerprint : str
+        The SHA-256 hex digest of the file content.
     """
-    # downloading the data
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    if kaggle:
-        train_path = "/kaggle/input/msdb-2024/train.parquet"
-        test_path = "/kaggle/input/msdb-2024/final_test.parquet"
-        weather_path = (
-            "/kaggle/input/weather-data-self-sourced/H_75_previous-2020-2022.csv"
-        )
-        weather_data = pd.read_csv(weather_path, sep=";")
-    else:
-        train_path = Path("data") / "train.parquet"
-        test_path = Path("data") / "final_test.parquet"
-        weather_path = Path("weather_data") / "H_75_previous-2020-2022.csv.gz"
-        weather_data = pd.read_csv(weather_path, compression="gzip", sep=";")
 
-    train = pd.read_parquet(train_path)
-    test = pd.read_parquet(test_path)
+def clean_weather(weather_data, dates=None):
+    """Clean and format the raw Météo-France weather dataframe.
+
+    The excluded stations and the dates out of range are filtered out before the
+    dates are parsed.
+
+    Parameters
+    ----------
+    weather_data : pd.dataframe
+        The weather data as read from the Météo-France CSV file (possibly with
+    only some of its columns).
 
-    # weather data cleaning and formatting
+    dates : tuple, optional
+        The first and last dates (Timestamps) to keep. All of them by default.
 
+    Returns
+    -------
+    weather_filtered : pd.dataframe
+        The weather data reduced to the useful columns, renamed, with parsed dates
+    and without the stations we decided to exclude.
+    """
     weather_data = weather_data.dropna(axis=1, how="all")
 
     weather_filtered = weather_data[
-        [
-            "NUM_POSTE",
-            "NOM_USUEL",
-            "LAT",
-            "LON",
-            "ALTI",
-            "AAAAMMJJHH",
-            "RR1",
-            "DRR1",
-            "FF",
-            "DD",
-            "FXY",
-            "DXY",
-            "HXY",
-            "FXI",
-            "DXI",
-            "HXI",
-            "FXI3S",
-            "HFXI3S",
-            "T",
-            "TD",
-            "TN",
-            "HTN",
-            "TX",
-            "HTX",
-            "DG",
-            "TNSOL",
-            "TN50",
-            "TCHAUSSEE",
-            "U",
-            "UN",
-            "HUN",
-            "UX",
-            "HUX",
-            "DHUMI40",
-            "DHUMI80",
-            "PMER",
-            "PSTAT",
-            "VV",
-            "WW",
-            "INS",
-            "INS2",
-        ]
+        [code for code in WEATHER_COLUMNS if code in weather_data.columns]
     ]
+    weather_filtered = weather_filtered.rename(columns=WEATHER_COLUMNS)
 
-    weather_filtered = weather_filtered.rename(
-        columns={
-            "NUM_POSTE": "id_poste",
-            "NOM_USUEL": "nom_poste",
-            "LAT": "latitude",
-            "LON": "longitude",
-            "ALTI": "altitude",
-            "AAAAMMJJHH": "date",
-            "RR1": "precip_1h",
-            "DRR1": "duree_precip",
-            "FF": "vent_moyen_10m",
-            "DD": "direction_vent_10m",
-            "FXY": "vent_max",
-            "DXY": "direction_vent_max",
-            "HXY": "heure_vent_max",
-            "FXI": "vent_inst_max",
-            "DXI": "direction_vent_inst_max",
-            "HXI": "heure_vent_inst_max",
-            "FXI3S": "vent_max_3s",
-            "HFXI3S": "heure_vent_max_3s",
-            "T": "temperature",
-            "TD": "point_rosée",
-            "TN": "temp_min",
-            "HTN": "heure_temp_min",
-            "TX": "temp_max",
-            "HTX": "heure_temp_max",
-            "DG": "duree_gel",
-            "TNSOL": "temp_min_10cm",
-            "TN50": "temp_min_50cm",
-            "TCHAUSSEE": "temp_surface",
-            "U": "humidite",
-            "UN": "humidite_min",
-            "HUN": "heure_humidite_min",
-            "UX": "humidite_max",
-            "HUX": "heure_humidite_max",
-            "DHUMI40": "duree_humidite_40",
-            "DHUMI80": "duree_humidite_80",
-            "PMER": "pression_mer",
-            "PSTAT": "pression_station",
-            "VV": "visibilite",
-            "WW": "code_meteo",
-            "INS": "duree_ensoleillement_utc",
-            "INS2": "duree_ensoleillement_tsv",
-        }
-    )
-
-    weather_filtered["date"] = pd.to_datetime(
-        weather_filtered["date"], format="%Y%m%d%H"
-    ).astype("datetime64[us]")
     weather_filtered = weather_filtered[
         weather_filtered["id_poste"] != 75114007
     ]  # 75114007 double of 75114001
@@ -159,103 +190,608 @@ def load_data(kaggle=False):
         weather_filtered["id_poste"] != 75116008
     ]  # 75116008 too far away from most counter
 
-    # The weather dataset is split into two parts (based on null analysis):
-    # - Attributes that can be taken from the nearest station to each counter.
-    # - Attributes that are only available from a single station (null in the others)
-    #   and therefore cannot be analyzed on a local scale.
-
-    weather_global = weather_filtered[weather_filtered["id_poste"] == 75114001]
-    weather_global = weather_global[
-        [
-            "nom_poste",
-            "latitude",
-            "longitude",
-            "altitude",
-            "date",
-            "duree_precip",
-            "vent_moyen_10m",
-            "direction_vent_10m",
-            "vent_max",
-            "direction_vent_max",
-            "heure_vent_max",
-            "vent_inst_max",
-            "direction_vent_inst_max",
-            "heure_vent_inst_max",
-            "vent_max_3s",
-            "heure_vent_max_3s",
-            "point_rosée",
-            "temp_min_10cm",
-            "temp_min_50cm",
-            "temp_surface",
-            "humidite",
-            "humidite_min",
-            "heure_humidite_min",
-            "humidite_max",
-            "heure_humidite_max",
-            "duree_humidite_40",
-            "duree_humidite_80",
-            "pression_mer",
-            "pression_station",
-            "visibilite",
-            "code_meteo",
-            "duree_ensoleillement_utc",
+    if dates is not None:
+        first, last = (int(date.strftime("%Y%m%d%H")) for date in dates)
+        weather_filtered = weather_filtered[
+            weather_filtered["date"].between(first, last)
         ]
+
+    weather_filtered["date"] = pd.to_datetime(
+        weather_filtered["date"], format="%Y%m%d%H"
+    ).astype("datetime64[us]")
+
+    return weather_filtered.reset_index(drop=True)
+
+
+def _weather_read_columns(columns):
+    """Return the weather columns to read: the requested ones and the join keys."""
+    if columns is None:
+        return None
+    return [
+        name
+        for name in WEATHER_COLUMNS.values()
+        if name in columns or name in ["id_poste", "latitude", "longitude", "date"]
     ]
 
-    weather_local = weather_filtered[
-        [
-            "id_poste",
-            "date",
-            "precip_1h",
-            "temperature",
-            "temp_min",
-            "heure_temp_min",
-            "temp_max",
-            "heure_temp_max",
-            "duree_gel",
+
+@profiled("load_weather")
+def load_weather(weather_path, cache=True, cache_dir=None, columns=None, dates=None):
+    """Load the cleaned weather data, using a Parquet cache when possible.
+
+    The cache file is keyed by a fingerprint of the raw CSV file, so that it is
+    rebuilt automatically whenever the source file changes. The requested columns
+    and dates are pushed down to the read: only they are read from the cache
+    (column projection and row group filters), or parsed from the CSV file.
+
+    Parameters
+    ----------
+    weather_path : str or Path
+        Path of the raw Météo-France CSV file (possibly gzipped).
+
+    cache : boolean, optional
+        Whether to read from and write to the Parquet cache. True by default.
+
+    cache_dir : str or Path, optional
+        Directory holding the cache files. By default, a 'cache' folder next to
+    the raw weather file.
+
+    columns : list, optional
+        The weather attributes to load (the 'id_poste', 'latitude', 'longitude'
+    and 'date' columns are always loaded). All of them by default.
+
+    dates : tuple, optional
+        The first and last dates (Timestamps) to load. All of them by default.
+
+    Returns
+    -------
+    weather_filtered : pd.dataframe
+        The cleaned weather data (see clean_weather).
+    """
+    read_columns = _weather_read_columns(columns)
+
+    if not cache:
+        usecols = None
+        if read_columns is not None:
+            usecols = [
+                code for code, name in WEATHER_COLUMNS.items() if name in read_columns
+            ]
+        return clean_weather(
+            pd.read_csv(weather_path, sep=";", usecols=usecols), dates=dates
+        )
+
+    cache_dir = Path(weather_path).parent / "cache" if cache_dir is None else cache_dir
+    cache_path = Path(cache_dir) / (
+        f"weather_v{WEATHER_CACHE_VERSION}_{file_fingerprint(weather_path)[:16]}"
+        ".parquet"
+    )
+
+    if cache_path.exists():
+        filters = None
+        if dates is not None:
+            filters = [("date", ">=", dates[0]), ("date", "<=", dates[1])]
+        weather_filtered = pd.read_parquet(
+            cache_path, columns=read_columns, filters=filters
+        )
+        weather_filtered["date"] = weather_filtered["date"].astype("datetime64[us]")
+        return weather_filtered
+
+    weather_filtered = clean_weather(pd.read_csv(weather_path, sep=";"))
+
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        weather_filtered.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)  # atomic, in case of concurrent runs
+    except OSError:
+        pass  # read-only location: the cache is only an optimization
+
+    # the whole table is cached for later runs, and only then reduced
+
+    if read_columns is not None:
+        weather_filtered = weather_filtered[
+            [col for col in read_columns if col in weather_filtered.columns]
         ]
+    if dates is not None:
+        weather_filtered = weather_filtered[
+            weather_filtered["date"].between(*dates)
+        ].reset_index(drop=True)
+
+    return weather_filtered
+
+
+def compact_dtypes(dataset, exclude=("bike_count", "log_bike_count")):
+    """Downcast a dataframe to compact dtypes to reduce its memory footprint.
+
+    float64 columns become float32, int64 columns become the smallest integer
+    type holding their values and object columns become categorical.
+
+    Parameters
+    ----------
+    dataset : pd.dataframe
+        The input dataframe.
+
+    exclude : iterable, optional
+        Columns to leave untouched. By default, the target columns.
+
+    Returns
+    -------
+    dataset : pd.dataframe
+        The dataset with compact dtypes.
+    """
+    dtypes = {}
+    for col in dataset.columns:
+        if col in exclude:
+            continue
+        if dataset[col].dtype == "float64":
+            dtypes[col] = "float32"
+        elif dataset[col].dtype == "int64":
+            dtypes[col] = pd.to_numeric(dataset[col], downcast="integer").dtype
+        elif dataset[col].dtype == "object":
+            dtypes[col] = "category"
+    return dataset.astype(dtypes) if dtypes else dataset
+
+
+def get_data_paths(kaggle=False):
+    """Return the paths of the data files.
+
+    Parameters
+    ----------
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. If False, local paths
+    are used. False by default.
+
+    Returns
+    -------
+    train_path, test_path, weather_path : tuple of three paths
+        Paths of the train and test parquet files and of the weather CSV file.
+    """
+    if kaggle:
+        train_path = "/kaggle/input/msdb-2024/train.parquet"
+        test_path = "/kaggle/input/msdb-2024/final_test.parquet"
+        weather_path = (
+            "/kaggle/input/weather-data-self-sourced/H_75_previous-2020-2022.csv"
+        )
+    else:
+        train_path = Path("data") / "train.parquet"
+        test_path = Path("data") / "final_test.parquet"
+        weather_path = Path("weather_data") / "H_75_previous-2020-2022.csv.gz"
+
+    return train_path, test_path, weather_path
+
+
+@profiled("build_weather_tables")
+def build_weather_tables(weather_filtered):
+    """Build the weather index and the table of the station coordinates.
+
+    Only the weather data is needed, so that this can run while the counts are
+    being read.
+
+    Parameters
+    ----------
+    weather_filtered : pd.dataframe
+        The cleaned weather data (see load_weather), possibly with only some of
+    the weather attributes.
+
+    Returns
+    -------
+    weather_index : dict
+        The weather blocks used by weather_join.join_weather.
+
+    station_coords : pd.dataframe
+        The distinct 'id_poste', 'latitude' and 'longitude' of the stations.
+    """
+    weather_global = weather_filtered[weather_filtered["id_poste"] == GLOBAL_STATION]
+    weather_global = weather_global[
+        [col for col in GLOBAL_WEATHER_COLUMNS if col in weather_filtered.columns]
     ]
+    weather_local = weather_filtered[
+        [col for col in LOCAL_WEATHER_COLUMNS if col in weather_filtered.columns]
+    ]
+
+    station_coords = weather_filtered[
+        ["id_poste", "latitude", "longitude"]
+    ].drop_duplicates()
+
+    return build_weather_index(weather_local, weather_global), station_coords
+
+
+def nearest_stations(station_coords, counter_coords):
+    """Associate each counter to its nearest weather station.
+
+    Parameters
+    ----------
+    station_coords : pd.dataframe
+        The 'id_poste', 'latitude' and 'longitude' of each station (see
+    build_weather_tables).
+
+    counter_coords : pd.dataframe
+        The 'counter_id', 'latitude' and 'longitude' of each counter.
+
+    Returns
+    -------
+    nearest_station_by_counter : pd.dataframe
+        The station id ('id_poste') associated to each 'counter_id'.
+    """
+    from scipy.spatial import cKDTree  # scipy is only needed here
 
     # Using a sklearn K-D-Tree to build a panda dataframe which to each counter
     # associates the corresponding nearest weather station.
 
-    unique_weather_coords = weather_filtered[
-        ["id_poste", "latitude", "longitude"]
-    ].drop_duplicates()
-    unique_train_coords = train[
+    unique_counter_coords = counter_coords[
         ["counter_id", "latitude", "longitude"]
     ].drop_duplicates()
 
-    weather_tree = cKDTree(unique_weather_coords[["latitude", "longitude"]].values)
+    weather_tree = cKDTree(station_coords[["latitude", "longitude"]].values)
 
     _, nearest_indices = weather_tree.query(
-        unique_train_coords[["latitude", "longitude"]].values, workers=-1
+        unique_counter_coords[["latitude", "longitude"]].values, workers=-1
     )
 
-    nearest_station_by_counter = pd.DataFrame(
+    return pd.DataFrame(
         {
-            "counter_id": unique_train_coords["counter_id"].values,
-            "id_poste": unique_weather_coords.iloc[nearest_indices]["id_poste"].values,
+            "counter_id": unique_counter_coords["counter_id"].values,
+            "id_poste": station_coords.iloc[nearest_indices]["id_poste"].values,
         }
     )
 
-    # merging weather_global and weather_local to the train and test dataframes.
 
-    train = pd.merge(train, nearest_station_by_counter, on="counter_id", how="left")
-    train = pd.merge(
-        train, weather_global, on="date", how="left", suffixes=["_counter", "_poste"]
+@profiled("prepare_weather")
+def prepare_weather(weather_filtered, counter_coords):
+    """Build the weather index and the nearest weather station of each counter.
+
+    Parameters
+    ----------
+    weather_filtered : pd.dataframe
+        The cleaned weather data (see load_weather), possibly with only some of
+    the weather attributes.
+
+    counter_coords : pd.dataframe
+        The 'counter_id', 'latitude' and 'longitude' of each counter.
+
+    Returns
+    -------
+    weather_index : dict
+        The weather blocks used by weather_join.join_weather.
+
+    nearest_station_by_counter : pd.dataframe
+        The station id ('id_poste') associated to each 'counter_id'.
+    """
+    weather_index, station_coords = build_weather_tables(weather_filtered)
+    return weather_index, nearest_stations(station_coords, counter_coords)
+
+
+def parquet_date_range(path, column="date"):
+    """Return the first and last dates of a parquet file from its metadata.
+
+    Only the statistics of the row groups are read, not the data.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the parquet file.
+
+    column : str, optional
+        The date column. 'date' by default.
+
+    Returns
+    -------
+    dates : tuple or None
+        The first and last dates (Timestamps), or None if the file has no
+    statistics for the column.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    position = metadata.schema.names.index(column)
+    statistics = [
+        metadata.row_group(i).column(position).statistics
+        for i in range(metadata.num_row_groups)
+    ]
+    if not statistics or any(
+        stats is None or not stats.has_min_max for stats in statistics
+    ):
+        return None
+    return (
+        pd.Timestamp(min(stats.min for stats in statistics)),
+        pd.Timestamp(max(stats.max for stats in statistics)),
     )
-    train = pd.merge(train, weather_local, on=["date", "id_poste"], how="left")
-    train.sort_values("date", inplace=True)
 
-    test["orig_index"] = np.arange(test.shape[0])  # for safety matter
-    test = pd.merge(test, nearest_station_by_counter, on="counter_id", how="left")
-    test = pd.merge(
-        test, weather_global, on="date", how="left", suffixes=["_counter", "_poste"]
+
+def _date_range(path):
+    """Return the first and last dates of a counts file (see parquet_date_range)."""
+    dates = parquet_date_range(path)
+    if dates is None:  # no statistics: only the date column is read
+        date = pd.read_parquet(path, columns=["date"])["date"]
+        dates = (date.min(), date.max())
+    return dates
+
+
+def _count_read_columns(path, columns):
+    """Return the columns of a counts file to read: the requested ones and the join keys."""
+    if columns is None:
+        return None
+    return [
+        name
+        for name in pq.read_schema(path).names
+        if name in columns
+        or f"{name}_counter" in columns
+        or name in ["counter_id", "date", "latitude", "longitude"]
+    ]
+
+
+def _load_weather_tables(weather_path, cache, cache_dir, columns, dates, compact):
+    """Load the cleaned weather data and build its tables (see build_weather_tables)."""
+    weather_filtered = load_weather(
+        weather_path, cache=cache, cache_dir=cache_dir, columns=columns, dates=dates
     )
-    test = pd.merge(test, weather_local, on=["date", "id_poste"], how="left")
+    if compact:
+        weather_filtered = compact_dtypes(weather_filtered)
+    return build_weather_tables(weather_filtered)
+
+
+def _read_counts(path, columns, compact):
+    """Read a counts parquet file (multi-threaded by pyarrow)."""
+    with stage("read_counts", path=str(path)) as record:
+        counts = pd.read_parquet(path, columns=_count_read_columns(path, columns))
+        record["output"] = counts
+    return compact_dtypes(counts) if compact else counts
 
-    test = test.sort_values("orig_index")  # for safety matter
-    del test["orig_index"]
+
+def _load_store(store_dir, test_path, columns, compact):
+    """Read the train set of a store, and enrich the test set with its weather data.
+
+    The test counters go through the stations of the store, as in load_data.
+    """
+    # (lazy import: incremental.py imports this module)
+    from incremental import read_store, read_store_stations, read_store_weather
+
+    train = read_store(store_dir, columns)
+    if compact:
+        train = compact_dtypes(train)
+
+    test = _read_counts(test_path, columns, compact)
+    weather_filtered = read_store_weather(
+        store_dir, _weather_read_columns(columns), dates=_date_range(test_path)
+    )
+    if compact:
+        weather_filtered = compact_dtypes(weather_filtered)
+    weather_index, _ = build_weather_tables(weather_filtered)
+    test = _enrich_counts(test, weather_index, read_store_stations(store_dir), columns)
 
     return train, test
+
+
+def _enrich_counts(
+    counts, weather_index, nearest_station_by_counter, columns, sort=False
+):
+    """Join the weather data to counts and keep the requested columns.
+
+    The counts are sorted by dates first if sort is True, while still narrow
+    (see weather_join.py for the join by integer gather in dense blocks).
+    """
+    counts = counts.reset_index(drop=True)
+    if sort and not counts["date"].is_monotonic_increasing:
+        counts = counts.sort_values("date")
+    counts = join_weather(counts, weather_index, nearest_station_by_counter, columns)
+
+    if columns is not None:
+        counts = counts[[col for col in columns if col in counts.columns]]
+    return counts
+
+
+@profiled("load_data")
+def load_data(
+    kaggle=False,
+    cache=True,
+    cache_dir=None,
+    compact=False,
+    data_paths=None,
+    columns=None,
+    store_dir=None,
+):
+    """Load all data files, merge them appropriately and return the train and test dataframe.
+
+    Parameters
+    ----------
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. If False, local paths
+    are used. False by default.
+
+    cache : boolean, optional
+        Whether to use the Parquet cache of the cleaned weather data (see
+    load_weather). True by default.
+
+    cache_dir : str or Path, optional
+        Directory of the weather cache. By default, a 'cache' folder next to the
+    weather file locally, and '/kaggle/working/weather_cache' on Kaggle.
+
+    compact : boolean, optional
+        Whether to use compact dtypes (see compact_dtypes): float32 weather
+    measurements and categorical IDs. False by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files, used instead of the ones of
+    get_data_paths (e.g. to load synthetic data).
+
+    columns : list, optional
+        The columns to return (e.g. feature_selector.load_selected_columns() and the
+    target), named as in the full output. Only these columns and the join keys
+    are read from the files, only the weather of the period of the counts is
+    read, and only the requested weather attributes are joined. All the columns
+    by default.
+
+    store_dir : str or Path, optional
+        The directory of an incremental store (see incremental.py). If given,
+    the enriched train set and the weather data are read from the store instead
+    of the train and weather files, so that the counts and weather ingested
+    since its creation are included. The test set is still read from its file.
+    None by default.
+
+    Returns
+    -------
+    train, test : tuple of two pd.dataframes
+        Train and test dataset available on the competition dataset enriched with the
+    weather data (including precipitation, temperature, wind information, etc.). Train
+    is sorted by dates.
+    """
+    # downloading the data
+
+    train_path, test_path, weather_path = data_paths or get_data_paths(kaggle)
+    if kaggle and cache_dir is None:
+        cache_dir = "/kaggle/working/weather_cache"  # inputs are read-only
+
+    if store_dir is not None:
+        return _load_store(store_dir, test_path, columns, compact)
+
+    # the counts and the weather data are read concurrently, and the weather
+    # tables are built while the counts are still being read (pyarrow and the
+    # NumPy operations release the GIL). Only the weather of the period of the
+    # counts is needed: the period is taken from the parquet statistics.
+
+    dates = None
+    if columns is not None:
+        date_ranges = [_date_range(path) for path in (train_path, test_path)]
+        dates = (
+            min(first for first, _ in date_ranges),
+            max(last for _, last in date_ranges),
+        )
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        weather_tables = pool.submit(
+            _load_weather_tables,
+            weather_path,
+            cache=cache,
+            cache_dir=cache_dir,
+            columns=columns,
+            dates=dates,
+            compact=compact,
+        )
+        train, test = pool.map(
+            partial(_read_counts, columns=columns, compact=compact),
+            [train_path, test_path],
+        )
+        weather_index, station_coords = weather_tables.result()
+
+    # the station lookup is built once, from the train counters, and train and
+    # test go through the same enrichment (train being sorted by dates)
+
+    nearest_station_by_counter = nearest_stations(station_coords, train)
+
+    train = _enrich_counts(
+        train, weather_index, nearest_station_by_counter, columns, sort=True
+    )
+    test = _enrich_counts(test, weather_index, nearest_station_by_counter, columns)
+
+    return train, test
+
+
+def load_data_batches(
+    batch_rows=100_000,
+    kaggle=False,
+    test_set=False,
+    cache=True,
+    cache_dir=None,
+    compact=False,
+    data_paths=None,
+    columns=None,
+    store_dir=None,
+):
+    """Iterate over the train (or test) set by batches enriched with the weather data.
+
+    The parquet file is read row group by row group with pyarrow, so that the
+    memory used stays bounded whatever the size of the counts history. Only the
+    weather data and the counter coordinates are fully loaded. Each batch goes
+    through the same enrichment as in load_data, so that the downstream steps
+    (a NullImputer fitted beforehand, feature_selection, feature_transformer...)
+    can be applied to it. Unlike in load_data, batches are yielded in file order,
+    not sorted by dates.
+
+    Parameters
+    ----------
+    batch_rows : int, optional
+        Maximum number of rows of each batch. 100 000 by default.
+
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. False by default.
+
+    test_set : boolean, optional
+        Whether to iterate over the test set instead of the train set.
+    False by default.
+
+    cache : boolean, optional
+        Whether to use the Parquet cache of the cleaned weather data.
+    True by default.
+
+    cache_dir : str or Path, optional
+        Directory of the weather cache (see load_data).
+
+    compact : boolean, optional
+        Whether to use compact dtypes (see load_data). False by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files (see load_data).
+
+    columns : list, optional
+        The columns to return, only read from the files (see load_data).
+    All the columns by default.
+
+    store_dir : str or Path, optional
+        The directory of an incremental store to read the train set and the
+    weather data from (see load_data). The train batches are then read as
+    stored, already enriched, in the order of the updates. None by default.
+
+    Yields
+    ------
+    batch : pd.dataframe
+        A batch of at most batch_rows rows enriched with the weather data.
+    """
+    train_path, test_path, weather_path = data_paths or get_data_paths(kaggle)
+    if kaggle and cache_dir is None:
+        cache_dir = "/kaggle/working/weather_cache"  # inputs are read-only
+
+    if store_dir is not None:
+        # (lazy import: incremental.py imports this module)
+        from incremental import iter_store, read_store_stations, read_store_weather
+
+        if not test_set:
+            for batch in iter_store(store_dir, batch_rows, columns):
+                yield compact_dtypes(batch) if compact else batch
+            return
+
+        weather_filtered = read_store_weather(store_dir, _weather_read_columns(columns))
+        if compact:
+            weather_filtered = compact_dtypes(weather_filtered)
+        weather_index, _ = build_weather_tables(weather_filtered)
+        nearest_station_by_counter = read_store_stations(store_dir)
+        del weather_filtered
+    else:
+        weather_filtered = load_weather(
+            weather_path, cache=cache, cache_dir=cache_dir, columns=columns
+        )
+        if compact:
+            weather_filtered = compact_dtypes(weather_filtered)
+
+        # the nearest stations are computed from the train counters, as in
+        # load_data, reading only their coordinates batch by batch
+
+        counter_coords = pd.concat(
+            [
+                batch.to_pandas().drop_duplicates()
+                for batch in pq.ParquetFile(train_path).iter_batches(
+                    batch_size=batch_rows,
+                    columns=["counter_id", "latitude", "longitude"],
+                )
+            ]
+        )
+        weather_index, nearest_station_by_counter = prepare_weather(
+            weather_filtered, counter_coords
+        )
+        del weather_filtered, counter_coords
+
+    counts_path = test_path if test_set else train_path
+    parquet_file = pq.ParquetFile(counts_path)
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_rows, columns=_count_read_columns(counts_path, columns)
+    ):
+        batch = batch.to_pandas()
+        if compact:
+            batch = compact_dtypes(batch)
+        yield _enrich_counts(batch, weather_index, nearest_station_by_counter, columns)
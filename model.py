@@ -0,0 +1,93 @@
+"""Python script designed to build the model pipeline shared by the other scripts.
+
+In this script, we define a make_regressor function returning the
+HistGradientBoostingRegressor with the hyperparameters of hyperparameters.py
+(the ones saved by opt_hg.py, if tuned for the same encoding of the categorical
+features), and a make_pipeline function putting it after the preprocessor, so
+that kaggle_script.py, the saved artifacts of prediction_service.py and the
+other scripts fit the same model.
+"""
+
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer
+
+from preprocessor import preprocessor_generator, categorical_feature_indices
+from fold_cache import to_dense
+from hyperparameters import load_hyperparameters
+
+
+def make_regressor(x_train, native_categorical=False, **params):
+    """Return the regressor of the project, with the shared hyperparameters.
+
+    Parameters
+    ----------
+    x_train : pd.DataFrame
+        The features given to the preprocessor (to locate the categorical ones).
+
+    native_categorical : boolean, optional
+        Whether the categorical features are ordinal-encoded and handled natively
+    by the model (see preprocessor_generator). False by default.
+
+    **params :
+        Parameters of the regressor replacing the shared ones (e.g. a smaller
+    max_iter, or early_stopping).
+
+    Returns
+    -------
+    regressor : HistGradientBoostingRegressor
+        The unfitted regressor.
+    """
+    return HistGradientBoostingRegressor(
+        **{
+            **load_hyperparameters(native_categorical),
+            "categorical_features": (
+                categorical_feature_indices(x_train) if native_categorical else None
+            ),
+            "random_state": 8,  # fixing a random state to avoid random variations
+            **params,
+        }
+    )
+
+
+def make_pipeline(x_train, compact=False, native_categorical=False, **params):
+    """Return the pipeline of the project: the preprocessor and the regressor.
+
+    Without native_categorical, the one-hot encoded output of the preprocessor
+    is densified before the regressor.
+
+    Parameters
+    ----------
+    x_train : pd.DataFrame
+        The features given to the preprocessor.
+
+    compact : boolean, optional
+        Whether the preprocessor produces compact outputs (see
+    preprocessor_generator). False by default.
+
+    native_categorical : boolean, optional
+        Whether the categorical features are ordinal-encoded and handled natively
+    by the model. False by default.
+
+    **params :
+        Parameters of the regressor replacing the shared ones (see
+    make_regressor).
+
+    Returns
+    -------
+    pipeline : sklearn.pipeline.Pipeline
+        The unfitted pipeline, whose first step is the preprocessor and last step
+    the regressor.
+    """
+    steps = [
+        (
+            "preprocessor",
+            preprocessor_generator(
+                x_train, compact=compact, native_categorical=native_categorical
+            ),
+        )
+    ]
+    if not native_categorical:
+        steps.append(("to_dense", FunctionTransformer(to_dense)))
+    steps.append(("regressor", make_regressor(x_train, native_categorical, **params)))
+    return Pipeline(steps=steps)
@@ -3,12 +3,166 @@
 In this script, we define a null_imputer function that applies various methods to manage 
 missing data in both train and test datasets, such as imputing values with the mean or 
 median, or removing rows based on prior analysis and experimentation.
+
+The NullImputer class applies the same rules with statistics fitted once (on the
+train set), optionally per weather station and/or hour of the day, so that the
+test set and streamed batches are imputed with the train statistics.
 """
 
+import joblib
+import numpy as np
+import pandas as pd
+
+from profiling import profiled
+
+# Imputation rules: attributes imputed with their mean, and with their median.
+
+MEAN_COLUMNS = [
+    "temp_surface",
+    "temp_min",
+    "heure_temp_min",
+    "temp_max",
+    "heure_temp_max",
+]
+
+MEDIAN_COLUMNS = [
+    "precip_1h",
+    "vent_inst_max",
+    "duree_precip",
+    "duree_gel",
+]
+
+
+class NullImputer:
+    """Impute missing values with statistics fitted once, with the null_imputer rules.
+
+    Parameters
+    ----------
+    group_by : str or list, optional
+        None to use one statistic per attribute, or 'station' (per 'id_poste')
+    and/or 'hour' (per hour of the 'date') to use one statistic per group. The
+    global statistics are used for the groups unseen at fit time. None by
+    default.
+    """
+
+    def __init__(self, group_by=None):
+        self.group_by = group_by
+
+    def _group_keys(self, dataset):
+        """Return the index of the group of each row (None if not grouped)."""
+        if self.group_by is None:
+            return None
+        group_by = [self.group_by] if isinstance(self.group_by, str) else self.group_by
+
+        keys = []
+        for key in group_by:
+            if key == "station":
+                keys.append(dataset["id_poste"].to_numpy())
+            elif key == "hour":
+                keys.append(dataset["date"].dt.hour.to_numpy())
+            else:
+                raise ValueError(f"Unknown group_by key: {key!r}")
+
+        return pd.Index(keys[0]) if len(keys) == 1 else pd.MultiIndex.from_arrays(keys)
+
+    def fit(self, dataset):
+        """Compute the means and medians of the attributes of the dataset.
+
+        All the means, then all the medians, are computed by one vectorized
+        reduction over a 2D array (medians by partial sort, not full sort).
 
+        Parameters
+        ----------
+        dataset : pd.dataframe
+            The train set. Only the attributes it contains are imputed.
+
+        Returns
+        -------
+        self : NullImputer
+            The fitted imputer.
+        """
+        self.mean_columns_ = [col for col in MEAN_COLUMNS if col in dataset.columns]
+        self.median_columns_ = [col for col in MEDIAN_COLUMNS if col in dataset.columns]
+
+        means = dataset[self.mean_columns_].to_numpy(dtype="float64")
+        medians = dataset[self.median_columns_].to_numpy(dtype="float64")
+        self.statistics_ = pd.Series(
+            np.concatenate([np.nanmean(means, axis=0), np.nanmedian(medians, axis=0)]),
+            index=self.mean_columns_ + self.median_columns_,
+        )
+
+        keys = self._group_keys(dataset)
+        if keys is None:
+            self.group_statistics_ = None
+        else:
+            grouped = dataset[self.statistics_.index].groupby(keys, observed=True)
+            self.group_statistics_ = pd.concat(
+                [
+                    grouped[self.mean_columns_].mean(),
+                    grouped[self.median_columns_].median(),
+                ],
+                axis=1,
+            )
+
+        return self
+
+    def transform(self, dataset):
+        """Fill the missing values of the dataset with the fitted statistics.
+
+        Parameters
+        ----------
+        dataset : pd.dataframe
+            The dataset to impute (train, test or a batch of them).
+
+        Returns
+        -------
+        dataset : pd.dataframe
+            The dataset appropriately handled (modified in place).
+        """
+        keys = self._group_keys(dataset)
+        if keys is not None:
+            group_pos = self.group_statistics_.index.get_indexer(keys)
+            group_found = group_pos >= 0
+            group_pos = np.where(group_found, group_pos, 0)
+
+        for col, statistic in self.statistics_.items():
+            if col not in dataset.columns:
+                continue
+            values = dataset[col].to_numpy()
+            missing = np.isnan(values)
+            if not missing.any():
+                continue
+
+            fill = statistic
+            if keys is not None:
+                fill = self.group_statistics_[col].to_numpy()[group_pos]
+                fill = np.where(group_found & ~np.isnan(fill), fill, statistic)
+
+            dataset[col] = np.where(missing, fill, values).astype(values.dtype)
+
+        return dataset
+
+    def fit_transform(self, dataset):
+        """Fit the imputer on the dataset and impute it."""
+        return self.fit(dataset).transform(dataset)
+
+    def save(self, path):
+        """Save the fitted imputer in a file."""
+        joblib.dump(self, path)
+
+    @staticmethod
+    def load(path):
+        """Load an imputer saved with save."""
+        return joblib.load(path)
+
+
+@profiled("null_imputer")
 def null_imputer(dataset):
     """Manage missing values in the input dataset by applying imputation methods.
 
+    The statistics are computed on the input dataset itself (see NullImputer to
+    reuse the train statistics on other datasets).
+
     Parameters
     ----------
     dataset : pd.dataframe
@@ -22,25 +176,4 @@ def null_imputer(dataset):
     """
     # Imputing missing values of several attributes
 
-    dataset["temp_surface"] = dataset["temp_surface"].fillna(
-        dataset["temp_surface"].mean()
-    )
-    dataset["precip_1h"] = dataset["precip_1h"].fillna(dataset["precip_1h"].median())
-    dataset["vent_inst_max"] = dataset["vent_inst_max"].fillna(
-        dataset["vent_inst_max"].median()
-    )
-    dataset["duree_precip"] = dataset["duree_precip"].fillna(
-        dataset["duree_precip"].median()
-    )
-
-    dataset["temp_min"] = dataset["temp_min"].fillna(dataset["temp_min"].mean())
-    dataset["heure_temp_min"] = dataset["heure_temp_min"].fillna(
-        dataset["heure_temp_min"].mean()
-    )
-    dataset["temp_max"] = dataset["temp_max"].fillna(dataset["temp_max"].mean())
-    dataset["heure_temp_max"] = dataset["heure_temp_max"].fillna(
-        dataset["heure_temp_max"].mean()
-    )
-    dataset["duree_gel"] = dataset["duree_gel"].fillna(dataset["duree_gel"].median())
-
-    return dataset
+    return NullImputer().fit_transform(dataset)
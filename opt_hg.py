@@ -1,96 +1,339 @@
 """Python script designed to run optuna studies.
 Made to do hyperparameter tuning of HistGradientBoostingRegressor.
 
+The study is stored in a local journal file, shared by several worker processes
+running trials in parallel. Running the script again resumes the same study
+(for instance after a crash) until N_TRIALS trials are finished.
+
+The data is prepared once by the main process: the preprocessed folds are saved
+on disk (see fold_cache.py) and memory-mapped by every worker.
+
+The number of boosting iterations is not searched: each fit stops early when
+its score on the last rows of the train part of the fold (the most recent
+hours, the rows being sorted by dates) stops improving, up to MAX_ITER
+iterations. The best hyperparameters and the iterations used on the last fold
+are saved (see hyperparameters.py) for kaggle_script.py and testing_models.py,
+which only use them with the same encoding of the categorical features: the
+default one-hot encoding, or the native one (native_categorical).
+The RMSE is reported to optuna after each fold, so that a pruner can stop the
+trials that are already worse than the median of the previous ones.
 """
 
+import multiprocessing
+from functools import partial
+
 import optuna
 import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
 from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.model_selection import TimeSeriesSplit
 from sklearn.metrics import mean_squared_error
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import FunctionTransformer
 
 from load_data import load_data
-from feature_selector import feature_selection
+from feature_selector import feature_selection, load_selected_columns
 from null_manager import null_imputer
 from feature_engineering import feature_transformer
-from preprocessor import preprocessor_generator
+from preprocessor import preprocessor_generator, categorical_feature_indices
+from fold_cache import build_fold_cache, load_fold_cache
+from hyperparameters import save_hyperparameters
+
+N_TRIALS = 20  # total number of finished trials, across all workers and runs
+N_WORKERS = 4  # number of processes running trials in parallel
+N_FOLD_JOBS = 1  # number of folds evaluated concurrently inside a trial
+MAX_ITER = 3000  # upper bound of boosting iterations, reached without early stop
+N_ITER_NO_CHANGE = 20  # iterations without improvement before stopping early
+EARLY_STOPPING_FRACTION = 0.1  # last rows of a train fold used to stop early
+STUDY_NAME = "hist_gradient_boosting"  # suffixed with the encoding (see study_name)
+STORAGE_PATH = "opt_hg.log"
+FOLD_CACHE_DIR = "fold_cache"
+FINISHED_STATES = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+
+
+def get_storage(path=STORAGE_PATH):
+    """Return the optuna journal storage saved in a local file.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path of the journal file. STORAGE_PATH by default.
+
+    Returns
+    -------
+    storage : optuna.storages.JournalStorage
+        A storage that several processes can share.
+    """
+    try:
+        from optuna.storages.journal import JournalFileBackend
+    except ImportError:  # optuna < 4.0
+        from optuna.storages import JournalFileStorage as JournalFileBackend
+
+    return optuna.storages.JournalStorage(JournalFileBackend(path))
+
+
+def study_name(native_categorical=False):
+    """Return the name of the study of an encoding of the categorical features.
+
+    The trials of the one-hot and native encodings are kept in separate studies
+    of the same journal, as their best hyperparameters differ.
+    """
+    return f"{STUDY_NAME}_{'native' if native_categorical else 'one_hot'}"
+
+
+def get_pruner():
+    """Return the pruner stopping unpromising trials after any fold.
+
+    Returns
+    -------
+    pruner : optuna.pruners.MedianPruner
+        A pruner comparing the running mean RMSE of a trial to the median of the
+    previous trials at the same fold, once 5 trials are finished.
+    """
+    return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=0)
+
+
+def prepare_folds(compact=False, native_categorical=False):
+    """Run all the scripts to prepare data, and save the preprocessed folds on disk.
+
+    Parameters
+    ----------
+    compact : boolean, optional
+        Whether to use compact dtypes (see load_data), which also makes the
+    cached folds float32. False by default.
+
+    native_categorical : boolean, optional
+        Whether to ordinal-encode the categorical features for the native
+    categorical support of the model, instead of one-hot encoding them (see
+    preprocessor_generator). False by default.
+
+    Returns
+    -------
+    fold_dir : Path
+        The directory of the preprocessed folds (see fold_cache.load_fold_cache).
+
+    categorical_features : list or None
+        The column indices of the categorical features (None with one-hot
+    encoding).
+    """
+    # Applying a time series cross validation split
+
+    tscv = TimeSeriesSplit(n_splits=5)
+
+    # Running all the scripts
+
+    train, test = load_data(
+        columns=load_selected_columns() + ["log_bike_count"], compact=compact
+    )
+    train = null_imputer(train)
+    train = feature_selection(train)
+    train = feature_transformer(train, compact=compact)
+    x_train = train.drop(columns=["log_bike_count"])
+    y_train = train["log_bike_count"]  # defining target
+    preprocessor = preprocessor_generator(
+        x_train, compact=compact, native_categorical=native_categorical
+    )
+
+    # Preprocessing each fold once: only the regressor changes between trials
+    # (the directory of the folds is the one they were saved in, given as is to
+    # the workers)
+
+    fold_dir = build_fold_cache(
+        preprocessor, x_train, y_train, tscv, cache_dir=FOLD_CACHE_DIR
+    )
+
+    return fold_dir, (
+        categorical_feature_indices(x_train) if native_categorical else None
+    )
 
-# Applying a time series cross validation split
 
-tscv = TimeSeriesSplit(n_splits=5)
+def fold_rmse(regressor, fold):
+    """Fit the regressor on the train part of a fold.
 
-# Running all the scripts
+    The last EARLY_STOPPING_FRACTION of the train rows (the most recent ones) are
+    held out to stop early, rather than a random split of the rows, which would
+    stop on hours interleaved with the training ones.
+
+    Return its validation RMSE and the number of iterations it used.
+    """
+    X_train_fold, y_train_fold, X_val_fold, y_val_fold = fold
+    n_fit = int(X_train_fold.shape[0] * (1 - EARLY_STOPPING_FRACTION))
+
+    regressor.fit(
+        X_train_fold[:n_fit],
+        y_train_fold[:n_fit],
+        X_val=X_train_fold[n_fit:],
+        y_val=y_train_fold[n_fit:],
+    )
+
+    y_pred = regressor.predict(X_val_fold)
+
+    return np.sqrt(mean_squared_error(y_val_fold, y_pred)), regressor.n_iter_
 
-train, test = load_data()
-train = null_imputer(train)
-train = feature_selection(train)
-train = feature_transformer(train)
-x_train = train.drop(columns=["log_bike_count"])
-y_train = train["log_bike_count"]  # defining target
-preprocessor = preprocessor_generator(x_train)
 
 # Defining the objective function for the optuna study
 
 
-def objective(trial):
+def objective(trial, folds, categorical_features, n_fold_jobs=N_FOLD_JOBS):
 
     # Setting the hyperparameter ranges to explore
 
-    max_iter = trial.suggest_int("max_iter", 1100, 1900)
     max_depth = trial.suggest_int("max_depth", 10, 17)
-    learning_rate = trial.suggest_loguniform("learning_rate", 0.02, 0.12)
+    learning_rate = trial.suggest_float("learning_rate", 0.02, 0.12, log=True)
 
-    # Defining our regressor and our pipeline
+    # Defining our regressor (the preprocessing is already done in folds),
+    # stopping early instead of searching the number of iterations
 
     regressor = HistGradientBoostingRegressor(
-        max_iter=max_iter,
+        max_iter=MAX_ITER,
         max_depth=max_depth,
         learning_rate=learning_rate,
+        categorical_features=categorical_features,
+        early_stopping=True,
+        n_iter_no_change=N_ITER_NO_CHANGE,
         random_state=8,  # fixing a random state to avoid random variations
     )
 
-    pipeline = Pipeline(
-        steps=[
-            ("preprocessor", preprocessor),
-            (
-                "to_dense",
-                FunctionTransformer(
-                    lambda x: x.toarray() if hasattr(x, "toarray") else x
-                ),
-            ),  # to avoid "sparse matrix" issues
-            ("model", regressor),
-        ]
+    # Setting the cross validation system (folds can be evaluated concurrently,
+    # the model fitting releasing the GIL), reporting the mean RMSE after each
+    # group of folds so that the trial can be pruned
+
+    rmse_scores = []
+    n_iters = []
+
+    with Parallel(n_jobs=n_fold_jobs, prefer="threads") as parallel:
+        for start in range(0, len(folds), n_fold_jobs):
+            results = parallel(
+                delayed(fold_rmse)(clone(regressor), fold)
+                for fold in folds[start : start + n_fold_jobs]
+            )
+            rmse_scores.extend(rmse for rmse, _ in results)
+            n_iters.extend(int(n_iter) for _, n_iter in results)
+
+            trial.report(np.mean(rmse_scores), step=len(rmse_scores))
+            if trial.should_prune():
+                raise optuna.TrialPruned()
+
+    trial.set_user_attr("n_iter", n_iters)
+
+    return np.mean(rmse_scores)
+
+
+def run_worker(fold_dir, categorical_features, n_trials=N_TRIALS):
+    """Run trials of the shared study until n_trials trials are finished.
+
+    Parameters
+    ----------
+    fold_dir : Path
+        The directory of the preprocessed folds, memory-mapped once per worker.
+
+    categorical_features : list or None
+        The column indices of the categorical features (see prepare_folds).
+
+    n_trials : int, optional
+        Total number of complete or pruned trials of the study. N_TRIALS by
+    default.
+    """
+    study = optuna.load_study(
+        study_name=study_name(categorical_features is not None),
+        storage=get_storage(),
+        pruner=get_pruner(),
+    )
+    if len(study.get_trials(states=FINISHED_STATES)) >= n_trials:
+        return
+
+    folds = load_fold_cache(fold_dir)
+    study.optimize(
+        partial(
+            objective,
+            folds=folds,
+            categorical_features=categorical_features,
+        ),
+        callbacks=[optuna.study.MaxTrialsCallback(n_trials, states=FINISHED_STATES)],
     )
 
-    # Setting the cross validation system
 
-    rmse_scores = []
+def main(
+    n_trials=N_TRIALS, n_workers=N_WORKERS, compact=False, native_categorical=False
+):
+    """Run the optuna study with worker processes and print its best trial.
 
-    for train_index, val_index in tscv.split(x_train):
-        X_train_fold, X_val_fold = x_train.iloc[train_index], x_train.iloc[val_index]
-        y_train_fold, y_val_fold = y_train.iloc[train_index], y_train.iloc[val_index]
+    Parameters
+    ----------
+    n_trials : int, optional
+        Total number of complete or pruned trials of the study. N_TRIALS by
+    default.
 
-        pipeline.fit(X_train_fold, y_train_fold)
+    n_workers : int, optional
+        Number of processes running trials in parallel. N_WORKERS by default.
 
-        y_pred = pipeline.predict(X_val_fold)
+    compact : boolean, optional
+        Whether to prepare the folds with compact dtypes (see prepare_folds).
+    False by default.
 
-        rmse = np.sqrt(mean_squared_error(y_val_fold, y_pred))
-        rmse_scores.append(rmse)
+    native_categorical : boolean, optional
+        Whether to tune the model with natively handled categorical features
+    instead of the default one-hot encoding (see prepare_folds). The
+    hyperparameters are saved for this encoding only. False by default.
 
-    return np.mean(rmse_scores)
+    Returns
+    -------
+    study : optuna.study.Study
+        The study, with the trials of this run and of the previous ones.
+    """
+    fold_dir, categorical_features = prepare_folds(
+        compact=compact, native_categorical=native_categorical
+    )
 
+    # Creating (or resuming) the optuna study that will try to minimize RMSE with
+    # n_trials trials, run by n_workers processes
 
-# Creating optuna study that will try to minimize RMSE with 20 trials
+    study = optuna.create_study(
+        study_name=study_name(native_categorical),
+        storage=get_storage(),
+        direction="minimize",
+        pruner=get_pruner(),
+        load_if_exists=True,
+    )
+
+    workers = [
+        multiprocessing.Process(
+            target=run_worker, args=(fold_dir, categorical_features, n_trials)
+        )
+        for _ in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # Displaying the best parameters found (if any trial completed: the trials
+    # fail if the workers could not load the folds, for instance)
+
+    if not study.get_trials(states=(optuna.trial.TrialState.COMPLETE,)):
+        states = [trial.state.name for trial in study.trials]
+        raise RuntimeError(
+            f"No trial of the study completed (trial states: {states}), see the"
+            " errors of the workers above"
+        )
+
+    print(f"Best hyperparameters : {study.best_params}")
+    print(f"Iterations used on each fold : {study.best_trial.user_attrs['n_iter']}")
+    print(f"Best RMSE : {study.best_value}")
+
+    # Saving them with the iterations used on the last fold (the largest one),
+    # as max_iter of the model fitted on the whole train set
+
+    path = save_hyperparameters(
+        {**study.best_params, "max_iter": study.best_trial.user_attrs["n_iter"][-1]},
+        native_categorical=native_categorical,
+    )
+    print(f"Best hyperparameters saved in {path}")
 
-study = optuna.create_study(direction="minimize")
-study.optimize(objective, n_trials=20)
+    return study
 
-# Displaying the best parameters found
 
-print(f"Best hyperparameters : {study.best_params}")
-print(f"Best RMSE : {study.best_value}")
+if __name__ == "__main__":
+    main()
 
 
 # best parameters found     max_iter=1170, max_depth=12, learning_rate=0.11958816320752756
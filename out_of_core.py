@@ -0,0 +1,213 @@
+"""Python script designed to train the model on counts histories larger than memory.
+
+In this script, we define a fit_out_of_core function that streams the train set
+by batches from the Parquet and weather sources (see load_data_batches), keeps
+only the selected features of each batch, and draws a uniform sample of bounded
+size of the rows (reservoir sampling). The null imputer, the preprocessor and the
+HistGradientBoostingRegressor are then fitted on the sample only: the peak
+memory depends on the sample and batch sizes, not on the length of the history.
+As the model bins every feature into at most 255 bins, a sample of a few million
+rows is usually enough to estimate its splits.
+
+The model is evaluated batch by batch as well (streaming_rmse), and compared
+with the in-memory baseline by "python cli.py bench --out-of-core".
+"""
+
+import numpy as np
+import pandas as pd
+
+from load_data import load_data_batches
+from feature_selector import feature_selection, load_selected_columns
+from feature_engineering import feature_transformer
+from null_manager import NullImputer
+from model import make_pipeline
+
+
+def reservoir_sample(batches, n_rows, seed=0):
+    """Draw a uniform sample of rows from batches, without holding them all.
+
+    Each row gets a uniform random key, and the n_rows rows with the smallest
+    keys seen so far are kept, so that at most n_rows plus one batch of rows are
+    in memory at once.
+
+    Parameters
+    ----------
+    batches : iterable of pd.dataframes
+        The batches of rows, with the same columns.
+
+    n_rows : int
+        The size of the sample (all the rows if there are fewer).
+
+    seed : int, optional
+        Seed of the random keys. 0 by default.
+
+    Returns
+    -------
+    sample : pd.dataframe
+        The sampled rows, in the order in which they were read.
+    """
+    rng = np.random.default_rng(seed)
+    sample, keys, order = None, np.empty(0), np.empty(0, dtype="int64")
+    n_read = 0
+
+    for batch in batches:
+        batch = batch.reset_index(drop=True)
+        batch_keys = rng.random(batch.shape[0])
+        batch_order = np.arange(n_read, n_read + batch.shape[0])
+        n_read += batch.shape[0]
+
+        if sample is not None and sample.shape[0] == n_rows:
+            # once the sample is full, only the rows with smaller keys can enter
+            entering = batch_keys < keys.max()
+            batch = batch[entering]
+            batch_keys, batch_order = batch_keys[entering], batch_order[entering]
+
+        if sample is not None:
+            batch = pd.concat([sample, batch], ignore_index=True)
+            batch_keys = np.concatenate([keys, batch_keys])
+            batch_order = np.concatenate([order, batch_order])
+
+        kept = np.arange(batch.shape[0])
+        if kept.shape[0] > n_rows:
+            kept = np.argpartition(batch_keys, n_rows - 1)[:n_rows]
+        sample = batch.take(kept).reset_index(drop=True)
+        keys, order = batch_keys[kept], batch_order[kept]
+
+    if sample is None:
+        raise ValueError("No rows to sample")
+    return sample.take(np.argsort(order)).reset_index(drop=True)
+
+
+def _train_batches(batch_rows, kaggle, data_paths, until):
+    """Iterate over the train set by batches of selected features (before until)."""
+    for batch in load_data_batches(
+        batch_rows=batch_rows,
+        kaggle=kaggle,
+        data_paths=data_paths,
+        columns=load_selected_columns() + ["log_bike_count"],
+    ):
+        if until is not None:
+            batch = batch[batch["date"] < until].reset_index(drop=True)
+        if batch.shape[0]:
+            yield feature_selection(batch)
+
+
+def fit_out_of_core(
+    sample_rows=2_000_000,
+    batch_rows=100_000,
+    kaggle=False,
+    data_paths=None,
+    native_categorical=False,
+    max_iter=None,
+    until=None,
+    seed=0,
+):
+    """Fit the pipeline of kaggle_script.py on a bounded sample of the train set.
+
+    Parameters
+    ----------
+    sample_rows : int, optional
+        Number of rows of the sample the model is fitted on. 2 000 000 by
+    default.
+
+    batch_rows : int, optional
+        Number of rows read at once. 100 000 by default.
+
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. False by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files (see load_data).
+
+    native_categorical : boolean, optional
+        Whether to ordinal-encode the categorical features and let the model
+    handle them natively, instead of one-hot encoding them (see
+    kaggle_script.main). False by default.
+
+    max_iter : int, optional
+        Number of boosting iterations. The one of the shared hyperparameters by
+    default (see hyperparameters.load_hyperparameters).
+
+    until : Timestamp, optional
+        Only the rows before this date are used (e.g. to hold out the last
+    weeks). All the rows by default.
+
+    seed : int, optional
+        Seed of the sample. 0 by default.
+
+    Returns
+    -------
+    pipeline : sklearn.pipeline.Pipeline
+        The fitted preprocessor and regressor.
+
+    null_imputer : NullImputer
+        The imputer fitted on the sample, to apply before feature_transformer.
+    """
+    train = reservoir_sample(
+        _train_batches(batch_rows, kaggle, data_paths, until), sample_rows, seed
+    )
+
+    # the counters absent from the sample are unknown to the preprocessor, and
+    # treated as missing values by the model (or as all-zero one-hot columns)
+
+    null_imputer = NullImputer().fit(train)
+    train = feature_transformer(null_imputer.transform(train))
+    x_train = train.drop(columns=["log_bike_count"])
+    y_train = train["log_bike_count"]
+
+    pipeline = make_pipeline(
+        x_train,
+        native_categorical=native_categorical,
+        **({} if max_iter is None else {"max_iter": max_iter}),
+    )
+    pipeline.fit(x_train, y_train)
+
+    return pipeline, null_imputer
+
+
+def streaming_rmse(
+    pipeline,
+    null_imputer,
+    batch_rows=100_000,
+    kaggle=False,
+    data_paths=None,
+    since=None,
+):
+    """Compute the RMSE of a fitted pipeline on the train set, batch by batch.
+
+    Parameters
+    ----------
+    pipeline, null_imputer :
+        The fitted pipeline and imputer (see fit_out_of_core).
+
+    batch_rows, kaggle, data_paths : optional
+        See fit_out_of_core.
+
+    since : Timestamp, optional
+        Only the rows from this date are scored (e.g. the held out weeks). All
+    the rows by default.
+
+    Returns
+    -------
+    rmse : float
+        The root mean squared error on the scored rows.
+    """
+    squared_error, n_rows = 0.0, 0
+
+    for batch in load_data_batches(
+        batch_rows=batch_rows,
+        kaggle=kaggle,
+        data_paths=data_paths,
+        columns=load_selected_columns() + ["log_bike_count"],
+    ):
+        if since is not None:
+            batch = batch[batch["date"] >= since].reset_index(drop=True)
+        if not batch.shape[0]:
+            continue
+
+        batch = feature_transformer(feature_selection(null_imputer.transform(batch)))
+        y_true = batch.pop("log_bike_count").to_numpy()
+        squared_error += np.sum((pipeline.predict(batch) - y_true) ** 2)
+        n_rows += y_true.shape[0]
+
+    return float(np.sqrt(squared_error / n_rows))
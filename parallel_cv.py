@@ -0,0 +1,183 @@
+"""Python script designed to run the cross-validation folds in parallel processes.
+
+In this script, we define a cross_validate function that evaluates a regressor
+on each fold of a splitter in parallel worker processes. The preprocessed
+feature matrix and the target are saved once as .npy files and memory-mapped, so
+that the workers share them through the page cache instead of receiving pickled
+copies. As the train set is sorted by dates, the TimeSeriesSplit folds are
+contiguous ranges of rows, which are taken as slices (views, not copies) of the
+memory-mapped arrays.
+
+The cross_validate_folds function evaluates it instead on folds preprocessed
+separately (see fold_cache.py), each with a preprocessor fitted on its train
+part only, and memory-mapped the same way.
+"""
+
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.metrics import mean_squared_error
+
+
+def share_arrays(directory, **arrays):
+    """Save arrays as .npy files and memory-map them back (read-only).
+
+    Memory-mapped arrays are sent to joblib workers as a file name and an
+    offset, not as their content.
+
+    Parameters
+    ----------
+    directory : str or Path
+        The directory of the .npy files.
+
+    **arrays :
+        The arrays to share (anything np.asarray accepts), by name.
+
+    Returns
+    -------
+    shared : dict
+        The memory-mapped arrays, by name.
+    """
+    shared = {}
+    for name, array in arrays.items():
+        path = Path(directory) / f"{name}.npy"
+        np.save(path, np.ascontiguousarray(array))
+        shared[name] = np.load(path, mmap_mode="r")
+    return shared
+
+
+def as_slice(indices):
+    """Return a slice equivalent to sorted consecutive indices (else the indices)."""
+    if indices.shape[0] and indices[-1] - indices[0] + 1 == indices.shape[0]:
+        if np.all(np.diff(indices) == 1):
+            return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+def fit_fold(regressor, X, y, fold, train_rows, val_rows):
+    """Fit the regressor on the train rows and score it on the validation rows.
+
+    Returns
+    -------
+    result : dict
+        The fold number, its sizes, the start time of the fit (as time.time()),
+    the fit and predict times in seconds, the validation RMSE and the id of the
+    process which ran it.
+    """
+    return _fit_and_score(
+        regressor, fold, X[train_rows], y[train_rows], X[val_rows], y[val_rows]
+    )
+
+
+def _fit_and_score(regressor, fold, X_train_fold, y_train_fold, X_val_fold, y_val_fold):
+    """Fit the regressor on a train part and score it on a validation part (see fit_fold)."""
+    start_time = time.time()
+    start = time.perf_counter()
+    regressor.fit(X_train_fold, y_train_fold)
+    fitted = time.perf_counter()
+    y_pred = regressor.predict(X_val_fold)
+    predicted = time.perf_counter()
+
+    return {
+        "fold": fold,
+        "train_rows": int(y_train_fold.shape[0]),
+        "val_rows": int(y_val_fold.shape[0]),
+        "start_time": start_time,
+        "fit_s": fitted - start,
+        "predict_s": predicted - fitted,
+        "rmse": float(np.sqrt(mean_squared_error(y_val_fold, y_pred))),
+        "pid": os.getpid(),
+    }
+
+
+def cross_validate(regressor, X, y, cv, n_jobs=-1, mmap_dir=None):
+    """Evaluate a regressor on every cross-validation fold in parallel processes.
+
+    Parameters
+    ----------
+    regressor : sklearn regressor
+        The (unfitted) regressor. A clone of it is fitted on each fold.
+
+    X : array-like
+        The preprocessed features (e.g. the output of the preprocessor), with
+    rows sorted as the splitter expects (by dates for TimeSeriesSplit).
+
+    y : array-like
+        The target.
+
+    cv : cross-validation generator
+        The splitter, e.g. TimeSeriesSplit(n_splits=5).
+
+    n_jobs : int, optional
+        Number of worker processes (-1 for one per CPU, capped by the number of
+    folds). -1 by default.
+
+    mmap_dir : str or Path, optional
+        Directory of the memory-mapped arrays. A temporary directory, removed
+    at the end, by default.
+
+    Returns
+    -------
+    results : list of dicts
+        One result per fold (see fit_fold), in the order of the folds.
+    """
+    n_folds = cv.get_n_splits(X)
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() + 1 + n_jobs
+    n_jobs = max(min(n_jobs, n_folds), 1)
+
+    with tempfile.TemporaryDirectory(dir=mmap_dir) as directory:
+        shared = share_arrays(
+            directory, X=X, y=np.asarray(y, dtype="float64").reshape(-1)
+        )
+        folds = [
+            (fold, as_slice(train_index), as_slice(val_index))
+            for fold, (train_index, val_index) in enumerate(cv.split(shared["X"]))
+        ]
+
+        # the longest folds (the last ones) are started first
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(fit_fold)(clone(regressor), shared["X"], shared["y"], *fold)
+            for fold in reversed(folds)
+        )
+
+    return sorted(results, key=lambda result: result["fold"])
+
+
+def cross_validate_folds(regressor, folds, n_jobs=-1):
+    """Evaluate a regressor on preprocessed folds in parallel processes.
+
+    Parameters
+    ----------
+    regressor : sklearn regressor
+        The (unfitted) regressor. A clone of it is fitted on each fold.
+
+    folds : list of tuples
+        (X_train_fold, y_train_fold, X_val_fold, y_val_fold) for each fold,
+    ideally memory-mapped (see fold_cache.load_fold_cache), so that the workers
+    receive their file names instead of their content.
+
+    n_jobs : int, optional
+        Number of worker processes (see cross_validate). -1 by default.
+
+    Returns
+    -------
+    results : list of dicts
+        One result per fold (see fit_fold), in the order of the folds.
+    """
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() + 1 + n_jobs
+    n_jobs = max(min(n_jobs, len(folds)), 1)
+
+    # the longest folds (the last ones) are started first
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_fit_and_score)(clone(regressor), fold, *arrays)
+        for fold, arrays in reversed(list(enumerate(folds)))
+    )
+
+    return sorted(results, key=lambda result: result["fold"])
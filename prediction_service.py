@@ -0,0 +1,760 @@
+"""Python script designed to serve predictions of a fitted pipeline on demand.
+
+In this script, we define functions to fit the pipeline of kaggle_script.py once
+and save it as a versioned artifact (with the weather index, the nearest station
+and the attributes of each counter), and a PredictionService class answering
+"expected count for counter X at hour H" from this artifact.
+
+The service loads the artifact once and preprocesses the whole (station x hour)
+grid of weather and calendar features, and the features of each counter, at
+start-up, so that a request only costs a row lookup, the copy of the features
+of its counter and the model prediction. Concurrent requests are grouped into
+micro-batches (one model call per batch), predicted with the flat export of the
+regressor (see tree_export.py), which answers small batches much faster than
+the regressor, and the latency percentiles of the answered requests are kept.
+
+The service can be used in-process (PredictionService.predict) or over HTTP:
+    python cli.py train --output artifacts
+    python cli.py serve --artifact artifacts --port 8000
+    curl "localhost:8000/predict?counter_id=100007-12&date=2021-05-03T08:00"
+    curl "localhost:8000/stats"
+"""
+
+import json
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.preprocessing import OneHotEncoder
+
+from load_data import (
+    get_data_paths,
+    load_data,
+    load_data_batches,
+    load_weather,
+    prepare_weather,
+)
+from feature_selector import feature_selection, load_selected_columns
+from feature_engineering import feature_transformer
+from null_manager import NullImputer
+from model import make_pipeline
+from weather_join import HOUR_US, join_weather
+from batch_scoring import score_to_csv
+from tree_export import export_ensemble
+
+# Bump this when the content of the artifact changes, so that old artifacts are
+# refused instead of being misread.
+ARTIFACT_FORMAT = 3
+
+# Largest batch predicted with the flat ensemble rather than the regressor (whose
+# fixed cost per call is larger, but which is faster beyond a few hundred rows)
+FLAT_MAX_ROWS = 256
+
+# ---------------------------------------------------------------------------- #
+# Fitted pipeline artifact
+# ---------------------------------------------------------------------------- #
+
+
+def build_artifact(
+    kaggle=False, data_paths=None, native_categorical=False, max_iter=None
+):
+    """Fit the pipeline of kaggle_script.py on the whole train set.
+
+    Parameters
+    ----------
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. False by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files (see load_data).
+
+    native_categorical : boolean, optional
+        Whether to ordinal-encode the categorical features and let the model
+    handle them natively, instead of one-hot encoding them (see
+    kaggle_script.main). False by default.
+
+    max_iter : int, optional
+        Number of boosting iterations. The one of the shared hyperparameters by
+    default (see hyperparameters.load_hyperparameters).
+
+    Returns
+    -------
+    artifact : dict
+        - 'pipeline' : the fitted preprocessor and regressor
+        - 'null_imputer' : the NullImputer fitted on the train set
+        - 'weather_index' : the weather blocks (see weather_join.build_weather_index)
+        - 'nearest_station_by_counter' : the station id of each counter
+        - 'counter_attributes' : the selected columns constant for each counter
+    (see counter_attributes)
+        - 'metadata' : the artifact format, version, creation date, library
+    versions and training period
+    """
+    train, _ = load_data(
+        kaggle=kaggle,
+        data_paths=data_paths,
+        columns=load_selected_columns() + ["log_bike_count"],
+    )
+
+    # the weather index is rebuilt from the (cached) cleaned weather data, as
+    # load_data only returns the enriched counts
+
+    train_path, _, weather_path = data_paths or get_data_paths(kaggle)
+    weather_index, nearest_station_by_counter = prepare_weather(
+        load_weather(weather_path),
+        pd.read_parquet(train_path, columns=["counter_id", "latitude", "longitude"]),
+    )
+
+    first_date, last_date = train["date"].min(), train["date"].max()
+    n_rows = train.shape[0]
+
+    null_imputer = NullImputer().fit(train)
+    train = null_imputer.transform(train)
+    train = feature_selection(train)
+    attributes = counter_attributes(train)
+    train = feature_transformer(train)
+    x_train = train.drop(columns=["log_bike_count"])
+    y_train = train["log_bike_count"]
+
+    pipeline = make_pipeline(
+        x_train,
+        native_categorical=native_categorical,
+        **({} if max_iter is None else {"max_iter": max_iter}),
+    )
+    pipeline.fit(x_train, y_train)
+    regressor = pipeline[-1]
+
+    created = datetime.now(timezone.utc)
+    return {
+        "pipeline": pipeline,
+        "null_imputer": null_imputer,
+        "weather_index": weather_index,
+        "nearest_station_by_counter": nearest_station_by_counter,
+        "counter_attributes": attributes,
+        "metadata": {
+            "format": ARTIFACT_FORMAT,
+            "version": created.strftime("%Y%m%dT%H%M%SZ"),
+            "created": created.isoformat(),
+            "sklearn": sklearn.__version__,
+            "native_categorical": native_categorical,
+            "max_iter": regressor.max_iter,
+            "max_depth": regressor.max_depth,
+            "learning_rate": regressor.learning_rate,
+            "train_rows": n_rows,
+            "train_first_date": str(first_date),
+            "train_last_date": str(last_date),
+        },
+    }
+
+
+def counter_attributes(dataset):
+    """Return the columns of a dataset that have one value per counter.
+
+    These are the attributes of the counter itself (e.g. 'latitude_counter', or
+    'counter_id'), and the constant attributes of its weather station, which
+    the prediction service fills per request instead of per (station, hour).
+
+    Parameters
+    ----------
+    dataset : pd.dataframe
+        The selected train set, with a 'counter_id' column.
+
+    Returns
+    -------
+    attributes : pd.dataframe
+        One row per counter, with 'counter_id' and its constant columns.
+    """
+    per_counter = dataset.drop(columns=["date", "log_bike_count"]).groupby(
+        "counter_id", observed=True
+    )
+    constant = per_counter.nunique(dropna=False).le(1).all()
+    return per_counter.first()[constant.index[constant]].reset_index()
+
+
+def save_artifact(artifact, directory):
+    """Save an artifact as 'model-<version>.joblib' in a directory.
+
+    Parameters
+    ----------
+    artifact : dict
+        The artifact returned by build_artifact.
+
+    directory : str or Path
+        The output directory (several versions can be kept in it).
+
+    Returns
+    -------
+    path : Path
+        The path of the saved artifact.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"model-{artifact['metadata']['version']}.joblib"
+    joblib.dump(artifact, path)
+    return path
+
+
+def load_artifact(path):
+    """Load an artifact, or the most recent one of a directory.
+
+    Parameters
+    ----------
+    path : str or Path
+        An artifact file, or a directory of artifacts saved by save_artifact.
+
+    Returns
+    -------
+    artifact : dict
+        The artifact (see build_artifact).
+    """
+    path = Path(path)
+    if path.is_dir():
+        versions = sorted(path.glob("model-*.joblib"))
+        if not versions:
+            raise FileNotFoundError(f"No model artifact in {path}")
+        path = versions[-1]  # versions are UTC timestamps, sorted by name
+
+    artifact = joblib.load(path)
+    if artifact["metadata"]["format"] != ARTIFACT_FORMAT:
+        raise ValueError(
+            f"{path} has artifact format {artifact['metadata']['format']}, "
+            f"expected {ARTIFACT_FORMAT}: build it again"
+        )
+    return artifact
+
+
+def score_test_set(
+    artifact, path, kaggle=False, data_paths=None, batch_rows=100_000, n_threads=None
+):
+    """Write the predictions of an artifact on the test set in a submission file.
+
+    The test set is read by batches (see load_data.load_data_batches), imputed
+    with the train statistics of the artifact and scored in a thread pool (see
+    batch_scoring.score_to_csv).
+
+    Parameters
+    ----------
+    artifact : dict
+        The artifact (see build_artifact).
+
+    path : str or Path
+        The output CSV file.
+
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. False by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files (see load_data).
+
+    batch_rows : int, optional
+        Number of rows read and predicted at once. 100 000 by default.
+
+    n_threads : int, optional
+        Number of scoring threads. The number of CPUs by default.
+
+    Returns
+    -------
+    n_rows : int
+        The number of rows written.
+    """
+
+    def prepare(batch):
+        batch = artifact["null_imputer"].transform(batch)
+        return feature_transformer(feature_selection(batch, test_set=True))
+
+    batches = load_data_batches(
+        batch_rows=batch_rows,
+        kaggle=kaggle,
+        test_set=True,
+        data_paths=data_paths,
+        columns=load_selected_columns(),
+    )
+    return score_to_csv(
+        artifact["pipeline"], batches, path, prepare=prepare, n_threads=n_threads
+    )
+
+
+# ---------------------------------------------------------------------------- #
+# Prediction service
+# ---------------------------------------------------------------------------- #
+
+
+def _preprocess(artifact, dataset):
+    """Compute the regressor inputs of enriched rows, as for the test set."""
+    dataset = artifact["null_imputer"].transform(dataset)
+    dataset = feature_selection(dataset, test_set=True)
+    dataset = feature_transformer(dataset)
+    return artifact["pipeline"][:-1].transform(dataset)
+
+
+def counter_output_columns(preprocessor, columns):
+    """Return the positions of the preprocessor outputs computed from some columns.
+
+    Parameters
+    ----------
+    preprocessor : sklearn.compose.ColumnTransformer
+        The fitted preprocessor (see preprocessor_generator). Each of its
+    transformers computes its outputs column by column: one per category for
+    the one-hot encoder, and the same number per column for the others.
+
+    columns : list
+        The input columns (e.g. the counter attributes).
+
+    Returns
+    -------
+    positions : np.ndarray
+        The output columns computed from these input columns.
+    """
+    positions = []
+    for name, transformer, transformer_columns in preprocessor.transformers_:
+        if transformer == "drop" or not len(transformer_columns):
+            continue
+        output = preprocessor.output_indices_[name]
+        if isinstance(transformer, OneHotEncoder):
+            sizes = [len(categories) for categories in transformer.categories_]
+        else:
+            sizes = [(output.stop - output.start) // len(transformer_columns)] * len(
+                transformer_columns
+            )
+
+        start = output.start
+        for col, size in zip(transformer_columns, sizes):
+            if col in columns:
+                positions.extend(range(start, start + size))
+            start += size
+    return np.array(positions, dtype=int)
+
+
+def counter_features(artifact):
+    """Preprocess the counter attributes of every counter.
+
+    Each counter gets a row at the first hour of the weather index (the weather
+    and calendar outputs of these rows are ignored), preprocessed like the test
+    set.
+
+    Parameters
+    ----------
+    artifact : dict
+        The artifact returned by build_artifact or load_artifact.
+
+    Returns
+    -------
+    columns : np.ndarray
+        The positions of the regressor inputs computed from the counter
+    attributes (see counter_output_columns).
+
+    features : np.ndarray
+        A (n_counters, n_columns) array of these inputs, in the order of the
+    rows of artifact['counter_attributes'].
+    """
+    attributes = artifact["counter_attributes"]
+    weather_index = artifact["weather_index"]
+
+    counters = pd.DataFrame(
+        {
+            "counter_id": attributes["counter_id"],
+            "date": pd.Series(
+                pd.to_datetime(weather_index["start"], unit="us"),
+                index=attributes.index,
+            ).astype("datetime64[us]"),
+        }
+    )
+    counters = join_weather(
+        counters, weather_index, artifact["nearest_station_by_counter"]
+    )
+    counters[attributes.columns] = attributes
+
+    columns = counter_output_columns(artifact["pipeline"][0], list(attributes.columns))
+    return columns, _preprocess(artifact, counters)[:, columns]
+
+
+def feature_grid(artifact):
+    """Preprocess the weather and calendar features of every (station, hour).
+
+    The columns given by the preprocessor to the regressor are computed for one
+    row per station and hour covered by the weather index, with the same
+    functions as for the test set (missing values are imputed with the train
+    statistics). The counter attributes of the grid are the ones of the first
+    counter: the outputs computed from them are replaced per request (see
+    counter_features).
+
+    Parameters
+    ----------
+    artifact : dict
+        The artifact returned by build_artifact or load_artifact.
+
+    Returns
+    -------
+    grid : np.ndarray
+        A (n_stations * n_hours, n_features) array, with the row of station
+    position s and hour position h at s * n_hours + h.
+    """
+    weather_index = artifact["weather_index"]
+    stations = weather_index["stations"]
+    n_hours = weather_index["n_hours"]
+
+    # one pseudo counter per station, located at the station itself
+
+    hours = pd.to_datetime(
+        weather_index["start"] + HOUR_US * np.arange(n_hours), unit="us"
+    ).astype("datetime64[us]")
+    grid = pd.DataFrame(
+        {
+            "counter_id": np.repeat(stations, n_hours).astype(str),
+            "date": np.tile(hours, stations.shape[0]),
+        }
+    )
+    grid = join_weather(
+        grid,
+        weather_index,
+        pd.DataFrame({"counter_id": stations.astype(str), "id_poste": stations}),
+    )
+
+    attributes = artifact["counter_attributes"]
+    for col in attributes.columns:
+        grid[col] = attributes[col].iloc[np.zeros(grid.shape[0], dtype=int)].values
+
+    return _preprocess(artifact, grid)
+
+
+class PredictionService:
+    """Answer predictions for (counter, hour) requests from a fitted artifact.
+
+    Parameters
+    ----------
+    artifact : dict or str or Path
+        The artifact, or its path (see load_artifact).
+
+    max_batch_size : int, optional
+        Maximum number of requests predicted by one model call. 256 by default.
+
+    max_wait_ms : float, optional
+        Time waited for other requests to join a batch after the first one.
+    2 ms by default.
+
+    n_latencies : int, optional
+        Number of most recent request latencies kept for the percentiles.
+    10000 by default.
+    """
+
+    def __init__(self, artifact, max_batch_size=256, max_wait_ms=2, n_latencies=10000):
+        if not isinstance(artifact, dict):
+            artifact = load_artifact(artifact)
+
+        self.metadata = artifact["metadata"]
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        pipeline = artifact["pipeline"]
+        self._regressor = pipeline[-1]
+        self._flat = export_ensemble(self._regressor)
+        self._grid = feature_grid(artifact)
+
+        self._counter_columns, self._counter_features = counter_features(artifact)
+
+        # counter -> (position of its station in the grid, position of its
+        # features)
+
+        weather_index = artifact["weather_index"]
+        self._start = weather_index["start"]
+        self._n_hours = weather_index["n_hours"]
+
+        positions = {
+            counter: position
+            for position, counter in enumerate(
+                artifact["counter_attributes"]["counter_id"]
+            )
+        }
+        nearest = artifact["nearest_station_by_counter"]
+        station_pos = np.searchsorted(
+            weather_index["stations"], nearest["id_poste"].to_numpy()
+        )
+        self._counters = {
+            counter: (int(pos), positions[counter])
+            for counter, pos in zip(nearest["counter_id"], station_pos)
+            if counter in positions
+        }
+
+        # micro-batching worker and latency records
+
+        self._requests = queue.Queue()
+        self._latencies = deque(maxlen=n_latencies)
+        self._batch_sizes = deque(maxlen=n_latencies)
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock()  # no request queued once closed
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def counters(self):
+        """The counter ids the service can predict."""
+        return list(self._counters)
+
+    def _row(self, counter_id, date):
+        """Return the grid row and the counter features position of a request."""
+        try:
+            station_pos, counter_pos = self._counters[counter_id]
+        except KeyError:
+            raise KeyError(f"Unknown counter_id: {counter_id!r}") from None
+
+        offset = np.datetime64(pd.Timestamp(date), "us").astype("int64") - self._start
+        hour_pos = offset // HOUR_US
+        if offset % HOUR_US or not 0 <= hour_pos < self._n_hours:
+            raise ValueError(f"No weather data for the hour {date!r}")
+
+        return station_pos * self._n_hours + hour_pos, counter_pos
+
+    def _predict_rows(self, rows, counters):
+        """Predict the log counts of grid rows for counters (feature positions)."""
+        x = self._grid[rows]
+        x[:, self._counter_columns] = self._counter_features[counters]
+        if x.shape[0] <= FLAT_MAX_ROWS:
+            return self._flat.predict(x, n_threads=1)
+        return self._regressor.predict(x)
+
+    def predict_batch(self, counter_ids, dates):
+        """Predict the log counts of several (counter, hour) pairs in one call.
+
+        Parameters
+        ----------
+        counter_ids : iterable
+            The counter ids.
+
+        dates : iterable
+            The hours, as anything pd.Timestamp accepts.
+
+        Returns
+        -------
+        log_bike_count : np.ndarray
+            The predicted log counts (empty without pairs).
+        """
+        requests = list(map(self._row, counter_ids, dates))
+        if not requests:
+            return np.empty(0)
+        rows, counters = zip(*requests)
+        return self._predict_rows(np.array(rows), np.array(counters))
+
+    def submit(self, counter_id, date):
+        """Queue a request for the next micro-batch.
+
+        Invalid requests (unknown counter, hour out of the weather data) raise
+        immediately, so that they never fail a whole batch.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Future of the predicted log count.
+        """
+        row, counter = self._row(counter_id, date)
+        future = Future()
+        with self._submit_lock:
+            if self._stop.is_set():
+                raise RuntimeError("The prediction service is closed")
+            self._requests.put((time.perf_counter(), row, counter, future))
+        return future
+
+    def predict(self, counter_id, date, timeout=None):
+        """Predict the log count of a counter at an hour (micro-batched).
+
+        Parameters
+        ----------
+        counter_id : str
+            The counter id.
+
+        date : str or datetime
+            The hour, as anything pd.Timestamp accepts.
+
+        timeout : float, optional
+            Seconds to wait for the answer. No limit by default.
+
+        Returns
+        -------
+        log_bike_count : float
+            The predicted log count (np.expm1 gives the bike count).
+        """
+        return self.submit(counter_id, date).result(timeout)
+
+    def _run(self):
+        """Group the queued requests into batches and predict them."""
+        while not self._stop.is_set():
+            try:
+                batch = [self._requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(
+                        self._requests.get(
+                            timeout=max(deadline - time.perf_counter(), 0)
+                        )
+                    )
+                except queue.Empty:
+                    break
+
+            submitted, rows, counters, futures = zip(*batch)
+            try:
+                predictions = self._predict_rows(np.array(rows), np.array(counters))
+            except Exception as error:  # reported to every caller of the batch
+                for future in futures:
+                    future.set_exception(error)
+                continue
+
+            end = time.perf_counter()
+            with self._lock:
+                self._latencies.extend(end - start for start in submitted)
+                self._batch_sizes.append(len(batch))
+            for future, prediction in zip(futures, predictions):
+                future.set_result(float(prediction))
+
+    def stats(self):
+        """Return the latency percentiles of the most recent requests.
+
+        Returns
+        -------
+        stats : dict
+            Number of requests and batches recorded, mean batch size, and the
+        50th, 90th, 99th percentiles and maximum of the latencies in milliseconds
+        (from the submission of a request to its answer).
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            batch_sizes = np.array(self._batch_sizes)
+
+        stats = {
+            "version": self.metadata["version"],
+            "requests": int(latencies.shape[0]),
+            "batches": int(batch_sizes.shape[0]),
+        }
+        if latencies.shape[0]:
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            stats.update(
+                {
+                    "mean_batch_size": float(batch_sizes.mean()),
+                    "p50_ms": float(p50),
+                    "p90_ms": float(p90),
+                    "p99_ms": float(p99),
+                    "max_ms": float(latencies.max()),
+                }
+            )
+        return stats
+
+    def close(self):
+        """Stop the micro-batching worker.
+
+        The batch being predicted is answered, and the requests still queued
+        fail with a RuntimeError, so that no caller waits forever.
+        """
+        with self._submit_lock:
+            self._stop.set()
+        self._worker.join()
+
+        error = RuntimeError("The prediction service was closed before answering")
+        while True:
+            try:
+                *_, future = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            future.set_exception(error)
+
+
+# ---------------------------------------------------------------------------- #
+# HTTP interface
+# ---------------------------------------------------------------------------- #
+
+
+def make_handler(service):
+    """Return an HTTP request handler class answering with the given service.
+
+    Routes:
+    - GET /predict?counter_id=...&date=... : the predicted log and bike counts
+    - GET /stats : the latency percentiles (see PredictionService.stats)
+    - GET /health : the artifact metadata
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/stats":
+                return self._send(200, service.stats())
+            if url.path == "/health":
+                return self._send(200, service.metadata)
+            if url.path != "/predict":
+                return self._send(404, {"error": f"Unknown route {url.path}"})
+
+            query = parse_qs(url.query)
+            try:
+                counter_id, date = query["counter_id"][0], query["date"][0]
+                log_bike_count = service.predict(counter_id, date)
+            except (KeyError, ValueError) as error:
+                return self._send(400, {"error": str(error.args[0])})
+
+            self._send(
+                200,
+                {
+                    "counter_id": counter_id,
+                    "date": str(pd.Timestamp(date)),
+                    "log_bike_count": log_bike_count,
+                    "bike_count": float(np.expm1(log_bike_count)),
+                },
+            )
+
+        def log_message(self, format, *args):
+            pass  # one line per request would cost more than the prediction
+
+    return Handler
+
+
+def serve(artifact_path, host="127.0.0.1", port=8000, **service_kwargs):
+    """Serve predictions over HTTP until interrupted.
+
+    Parameters
+    ----------
+    artifact_path : str or Path
+        An artifact file or directory (see load_artifact).
+
+    host, port : optional
+        Address to listen on. 127.0.0.1:8000 by default.
+
+    **service_kwargs :
+        Other arguments of PredictionService (max_batch_size, max_wait_ms).
+    """
+    service = PredictionService(artifact_path, **service_kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Serving model {service.metadata['version']} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    # the options are defined with the train (artifact build) and serve commands
+    # of cli.py
+    from cli import main as cli_main
+
+    command, *options = sys.argv[1:] or ["serve"]
+    cli_main(["train" if command == "build" else command, *options])
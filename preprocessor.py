@@ -5,10 +5,13 @@ It is designed to simplify the feature preprocessing "process" in our pipeline.
 This script includes functions that:
 1. Classify features into categorical, numerical, and date types.
 2. Encode date features into multiple components such as year, month, etc.
-3. Generate a preprocessor that can be used to transform the dataset.
+3. Generate a preprocessor that can be used to transform the dataset (with one-hot
+encoding, or with ordinal encoding for models handling categorical features natively).
 
 """
 
+import numpy as np
+import pandas as pd
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import (
     StandardScaler,
@@ -16,7 +19,8 @@ from sklearn.preprocessing import (
     OrdinalEncoder,
     OneHotEncoder,
 )
-import holidays
+
+from profiling import profiled
 
 
 def get_features_type(dataset):
@@ -35,7 +39,8 @@ def get_features_type(dataset):
 
     numerical_features : list
         A list of column names corresponding to numerical features.
-    Corresponding to 'float' and 'int' dtypes.
+    Corresponding to 'float' and 'int' dtypes (including the compact
+    'float32', 'int8' and 'int16' ones).
 
     date_features : list
         A list of column names corresponding to date features.
@@ -47,7 +52,8 @@ def get_features_type(dataset):
     numerical_features = [
         col
         for col in dataset.columns
-        if dataset[col].dtype in ["float64", "int64", "int32"]
+        if dataset[col].dtype
+        in ["float64", "float32", "int64", "int32", "int16", "int8"]
     ]
     date_features = [
         col for col in dataset.columns if dataset[col].dtype == "datetime64[us]"
@@ -56,88 +62,205 @@ def get_features_type(dataset):
     return categorical_features, numerical_features, date_features
 
 
-def date_encoder(dataset):
+def _cast(values, dtype):
+    """Cast values to dtype, or leave them unchanged if dtype is None."""
+    return values if dtype is None else values.astype(dtype)
+
+
+def calendar_table(timestamps, prefix="date", compact=False):
+    """Compute the calendar features of a set of timestamps.
+
+    Meant to be called on unique timestamps: the holidays are resolved once per
+    year and every feature is computed once per timestamp.
+
+    Parameters
+    ----------
+    timestamps : pd.DatetimeIndex
+        The timestamps to encode (ideally without duplicates).
+
+    prefix : str, optional
+        Prefix of the names of the year, month, day, hour, weekday, weekend and
+    holiday features. 'date' by default.
+
+    compact : boolean, optional
+        Whether to store the features as int16 (year) and int8 (others) instead
+    of int32/int64. False by default.
+
+    Returns
+    -------
+    calendar : pd.DataFrame
+        One row per timestamp, in the same order, with the calendar features
+    (see date_encoder).
+    """
+    flag_dtype = "int8" if compact else int
+    year_dtype, component_dtype = ("int16", "int8") if compact else (None, None)
+
+    import holidays  # lazy import: loading the holiday calendars is slow
+
+    years = timestamps.year.dropna().unique().astype(int).tolist()
+    holiday_days = np.array(
+        list(holidays.France(years=years).keys()), dtype="datetime64[D]"
+    )
+
+    hour = timestamps.hour
+    weekday = timestamps.weekday
+    is_weekend = weekday.isin([5, 6])
+
+    return pd.DataFrame(
+        {
+            f"{prefix}_year": _cast(timestamps.year, year_dtype),
+            f"{prefix}_month": _cast(timestamps.month, component_dtype),
+            f"{prefix}_day": _cast(timestamps.day, component_dtype),
+            f"{prefix}_hour": _cast(hour, component_dtype),
+            f"{prefix}_weekday": _cast(weekday, component_dtype),
+            f"{prefix}_is_weekend": is_weekend.astype(flag_dtype),
+            f"{prefix}_is_holiday": np.isin(
+                timestamps.values.astype("datetime64[D]"), holiday_days
+            ).astype(flag_dtype),
+            "is_night": ((hour >= 23) & (hour <= 4)).astype(flag_dtype),
+            "is_morning_peak_hours_working_day": (
+                (hour >= 6) & (hour <= 7) & ~is_weekend
+            ).astype(flag_dtype),
+            "is_afternoon_peak_hours_working_day": (
+                (hour >= 15) & (hour <= 18) & ~is_weekend
+            ).astype(flag_dtype),
+            "is_afternoon_peak_hours_week_end": (
+                (hour >= 13) & (hour <= 16) & is_weekend
+            ).astype(flag_dtype),
+        }
+    )
+
+
+@profiled("date_encoder")
+def date_encoder(dataset, compact=False):
     """Encode date features into multiple components.
-    
+
     - year, month, day, hour, weekday
     - binary features indicating whether the date is a weekend or a holiday
     - binary features indicating whether the date corresponds to peak hours during the working days or weekend.
 
+    The features are computed once per distinct timestamp with calendar_table
+    (the data only covers a few thousand distinct hours, shared by all counters),
+    and each row picks them up through its factorized timestamp code.
+
     Parameters
     ----------
     dataset : pd.DataFrame
         The input dataframe containing the date features to be encoded.
 
+    compact : boolean, optional
+        Whether to store the encoded features as int16 (year) and int8 (others)
+    instead of int32/int64. False by default.
+
     Returns
     -------
     dataset : pd.DataFrame
         The dataset with the additional date-related features and the original date features removed.
     """
-    fr_holidays = holidays.France(years=dataset["date"].dt.year.unique().tolist())
-
     for col in dataset.columns:
-        dataset[f"{col}_year"] = dataset[col].dt.year
-        dataset[f"{col}_month"] = dataset[col].dt.month
-        dataset[f"{col}_day"] = dataset[col].dt.day
-        dataset[f"{col}_hour"] = dataset[col].dt.hour
-        dataset[f"{col}_weekday"] = dataset[col].dt.weekday
-        dataset[f"{col}_is_weekend"] = (
-            dataset[f"{col}_weekday"].isin([5, 6]).astype(int)
+        codes, uniques = pd.factorize(dataset[col], use_na_sentinel=False)
+        calendar = calendar_table(
+            pd.DatetimeIndex(uniques), prefix=col, compact=compact
         )
-        dataset[f"{col}_is_holiday"] = (
-            dataset[col].dt.date.isin(fr_holidays).astype(int)
-        )
-        dataset["is_night"] = (
-            (dataset[col].dt.hour >= 23) & (dataset[col].dt.hour <= 4)
-        ).astype(int)
-        dataset["is_morning_peak_hours_working_day"] = (
-            (dataset[col].dt.hour >= 6)
-            & (dataset[col].dt.hour <= 7)
-            & (dataset[f"{col}_is_weekend"] == 0)
-        ).astype(int)
-        dataset["is_afternoon_peak_hours_working_day"] = (
-            (dataset[col].dt.hour >= 15)
-            & (dataset[col].dt.hour <= 18)
-            & (dataset[f"{col}_is_weekend"] == 0)
-        ).astype(int)
-        dataset["is_afternoon_peak_hours_week_end"] = (
-            (dataset[col].dt.hour >= 13)
-            & (dataset[col].dt.hour <= 16)
-            & (dataset[f"{col}_is_weekend"] == 1)
-        ).astype(int)
+
+        for name, values in calendar.items():
+            dataset[name] = values.to_numpy()[codes]
 
         dataset.drop(columns=[col], inplace=True)
 
     return dataset
 
 
-def preprocessor_generator(dataset):
+def preprocessor_generator(dataset, compact=False, native_categorical=False):
     """Generate a preprocessor for the input dataset that applies various transformations.
 
     - OneHotEncoder for categorical features
     - StandardScaler for numerical features
     - Date encoding for date features (using the date_encoder function)
 
+    With native_categorical=True, the preprocessor is meant for tree models
+    handling categorical features natively (such as HistGradientBoostingRegressor
+    with categorical_features=categorical_feature_indices(dataset)):
+
+    - OrdinalEncoder for categorical features (unknown categories become NaN)
+    - numerical features are passed through, as trees do not need scaling
+    - Date encoding for date features (using the date_encoder function)
+
+    Its output is a dense matrix with one column per categorical feature instead
+    of one per category, so no densification step is needed.
+
     Parameters
     ----------
     dataset : pd.DataFrame
         The input dataframe containing the features to be preprocessed.
 
+    compact : boolean, optional
+        Whether to produce compact outputs: float32 encoded categorical columns and
+    int8/int16 date features (see date_encoder). False by default.
+
+    native_categorical : boolean, optional
+        Whether to ordinal-encode categorical features for native categorical
+    support instead of one-hot encoding them. False by default.
+
     Returns
     -------
     preprocessor : sklearn.compose._column_transformer.ColumnTransformer
         A ColumnTransformer to use in our pipeline.
     """
     categorical_features, numerical_features, date_features = get_features_type(dataset)
+    float_dtype = np.float32 if compact else np.float64
+
+    if native_categorical:
+        categorical_transformer = (
+            "cat_to_ordinal",
+            OrdinalEncoder(
+                handle_unknown="use_encoded_value",
+                unknown_value=np.nan,
+                dtype=float_dtype,
+            ),
+            categorical_features,
+        )
+        numerical_transformer = ("num", "passthrough", numerical_features)
+    else:
+        categorical_transformer = (
+            "cat_to_OHE",
+            OneHotEncoder(handle_unknown="ignore", dtype=float_dtype),
+            categorical_features,
+        )
+        numerical_transformer = ("num", StandardScaler(), numerical_features)
+
     preprocessor = ColumnTransformer(
         transformers=[
+            categorical_transformer,
+            numerical_transformer,
             (
-                "cat_to_OHE",
-                OneHotEncoder(handle_unknown="ignore"),
-                categorical_features,
+                "date",
+                FunctionTransformer(
+                    date_encoder, validate=False, kw_args={"compact": compact}
+                ),
+                date_features,
             ),
-            ("num", StandardScaler(), numerical_features),
-            ("date", FunctionTransformer(date_encoder, validate=False), date_features),
         ]
     )
     return preprocessor
+
+
+def categorical_feature_indices(dataset):
+    """Return the positions of the categorical features in the preprocessor output.
+
+    Meant to be given as categorical_features to HistGradientBoostingRegressor,
+    when using preprocessor_generator(dataset, native_categorical=True), which
+    puts the encoded categorical features first.
+
+    Parameters
+    ----------
+    dataset : pd.DataFrame
+        The input dataframe given to preprocessor_generator.
+
+    Returns
+    -------
+    indices : list
+        The column indices of the categorical features.
+    """
+    categorical_features, _, _ = get_features_type(dataset)
+    return list(range(len(categorical_features)))
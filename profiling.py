@@ -0,0 +1,264 @@
+"""Python script designed to profile the stages of the pipeline.
+
+In this script, we define a stage context manager and a profiled decorator that
+record, for each stage of the pipeline (and each cross-validation fold), its wall
+time, CPU time, number of rows in and out, DataFrame memory footprint and the
+peak resident memory of the process. The records can be exported as JSON or as
+a Chrome trace (to open in chrome://tracing or https://ui.perfetto.dev).
+
+Profiling is off by default and costs nothing then. It is switched on with
+enable(), for all stages or only some of them, or with the BIKE_COUNTERS_PROFILE
+environment variable ('all', or a comma-separated list of stage names).
+"""
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_enabled_stages = None  # None: disabled, "all": every stage, or a set of names
+_records = []
+_origin = time.perf_counter()
+
+
+def enable(stages="all"):
+    """Switch profiling on.
+
+    Parameters
+    ----------
+    stages : str or iterable, optional
+        'all' to profile every stage, or the names of the stages to profile.
+    'all' by default.
+    """
+    global _enabled_stages
+    _enabled_stages = stages if stages == "all" else set(stages)
+
+
+def disable():
+    """Switch profiling off (the records are kept)."""
+    global _enabled_stages
+    _enabled_stages = None
+
+
+def is_enabled(name=None):
+    """Return whether profiling is on, for the given stage if a name is given."""
+    if _enabled_stages is None:
+        return False
+    return name is None or _enabled_stages == "all" or name in _enabled_stages
+
+
+def reset():
+    """Remove all the records."""
+    _records.clear()
+
+
+def records():
+    """Return the list of records (one dict per profiled stage run)."""
+    return list(_records)
+
+
+def _rows(data):
+    """Number of rows of a dataframe/array, or of a tuple of them (None otherwise)."""
+    if isinstance(data, (tuple, list)):
+        rows = [_rows(item) for item in data]
+        return None if None in rows else sum(rows)
+    shape = getattr(data, "shape", None)
+    return int(shape[0]) if shape else None
+
+
+def _memory_mb(data):
+    """Memory footprint in MiB of a dataframe/array, or of a tuple of them (None otherwise)."""
+    if isinstance(data, (tuple, list)):
+        memory = [_memory_mb(item) for item in data]
+        return None if None in memory else sum(memory)
+    if hasattr(data, "memory_usage"):  # pandas dataframe or series
+        memory = data.memory_usage(deep=True)
+        return float(memory.sum() if hasattr(memory, "sum") else memory) / 2**20
+    if hasattr(data, "nbytes"):
+        return data.nbytes / 2**20
+    if hasattr(data, "data") and hasattr(data.data, "nbytes"):  # sparse matrix
+        return data.data.nbytes / 2**20
+    return None
+
+
+def _peak_rss_mb():
+    """Peak resident memory of the process in MiB (None if unavailable)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10  # bytes/KiB
+
+
+@contextmanager
+def stage(name, data=None, **attributes):
+    """Profile the code run inside the with block as a stage of the pipeline.
+
+    The yielded dict can receive the output of the stage under the 'output' key,
+    to record its number of rows and memory footprint.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage.
+
+    data : optional
+        The input of the stage (dataframe, array or tuple of them).
+
+    **attributes :
+        Other information to record (e.g. fold=2).
+
+    Yields
+    ------
+    record : dict
+        The record of the stage.
+    """
+    record = {"stage": name, **attributes}
+    if not is_enabled(name):
+        yield record
+        return
+
+    record["rows_in"] = _rows(data)
+    record["memory_in_mb"] = _memory_mb(data)
+
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        end = time.perf_counter()
+        output = record.pop("output", None)
+        record.update(
+            {
+                "start_s": start - _origin,
+                "wall_time_s": end - start,
+                "cpu_time_s": time.process_time() - start_cpu,
+                "rows_out": _rows(output),
+                "memory_out_mb": _memory_mb(output),
+                "peak_rss_mb": _peak_rss_mb(),
+                "pid": os.getpid(),
+                "thread": threading.get_ident(),
+            }
+        )
+        _records.append(record)
+
+
+def record_stage(name, start_time, wall_time_s, pid=None, **attributes):
+    """Record a stage timed elsewhere, e.g. in a worker process.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage.
+
+    start_time : float
+        The start of the stage, as given by time.time() (comparable between
+    processes, unlike time.perf_counter()).
+
+    wall_time_s : float
+        The duration of the stage in seconds.
+
+    pid : int, optional
+        The id of the process which ran the stage. This process by default.
+
+    **attributes :
+        Other information to record (e.g. fold=2, rows_in=1000).
+    """
+    if not is_enabled(name):
+        return
+
+    origin_time = time.time() - (time.perf_counter() - _origin)
+    pid = os.getpid() if pid is None else pid
+    _records.append(
+        {
+            "stage": name,
+            **attributes,
+            "start_s": start_time - origin_time,
+            "wall_time_s": wall_time_s,
+            "pid": pid,
+            "thread": pid,
+        }
+    )
+
+
+def profiled(name):
+    """Decorator profiling each call of a function as a stage.
+
+    The first argument of the function is taken as the input of the stage and
+    its return value as the output.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled(name):
+                return func(*args, **kwargs)
+            with stage(name, args[0] if args else None) as record:
+                result = func(*args, **kwargs)
+                record["output"] = result
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def export_json(path):
+    """Write the records as a JSON list.
+
+    Parameters
+    ----------
+    path : str or Path
+        The output file.
+    """
+    with open(path, "w") as file:
+        json.dump(_records, file, indent=2)
+
+
+def export_chrome_trace(path):
+    """Write the records as a Chrome trace (one complete event per stage run).
+
+    Parameters
+    ----------
+    path : str or Path
+        The output file.
+    """
+    events = []
+    for record in _records:
+        name = record["stage"]
+        if "fold" in record:
+            name = f"{name} (fold {record['fold']})"
+        events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": record["start_s"] * 1e6,
+                "dur": record["wall_time_s"] * 1e6,
+                "pid": record["pid"],
+                "tid": record["thread"],
+                "args": {
+                    key: value
+                    for key, value in record.items()
+                    if key not in ["stage", "start_s", "pid", "thread"]
+                },
+            }
+        )
+    with open(path, "w") as file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+
+if os.environ.get("BIKE_COUNTERS_PROFILE"):
+    _stages = os.environ["BIKE_COUNTERS_PROFILE"]
+    enable("all" if _stages.lower() in ["1", "all"] else _stages.split(","))
@@ -0,0 +1,146 @@
+"""Python script designed to train one model per counter (or per site).
+
+In this script, we define a ShardedRegressor estimator which partitions the rows
+by shard (the 'counter_id' by default, or the site of the counter), fits a clone
+of a base estimator on each shard in parallel processes, and routes each row to
+the model of its shard at prediction time. A single shard can be refitted alone
+(e.g. after the data of one counter changed), without refitting the others.
+"""
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import BaseEstimator, RegressorMixin, clone
+
+
+def site_of_counter(dataset):
+    """Return the site of each row, the first part of its 'counter_id'.
+
+    Meant to be given as shard_by to ShardedRegressor, to fit one model per site.
+    """
+    return dataset["counter_id"].astype(str).str.split("-").str[0].to_numpy()
+
+
+def _fit_shard(estimator, X, y):
+    """Fit an estimator on the rows of a shard."""
+    return estimator.fit(X, y)
+
+
+class ShardedRegressor(RegressorMixin, BaseEstimator):
+    """One clone of a regressor per shard, with predictions routed by shard.
+
+    Parameters
+    ----------
+    estimator : sklearn regressor
+        The base estimator (e.g. a Pipeline of the preprocessor and a
+    HistGradientBoostingRegressor), cloned for each shard.
+
+    shard_by : str or callable, optional
+        The column holding the shard of each row, or a function returning the
+    shards of the rows of a dataframe (e.g. site_of_counter). 'counter_id' by
+    default.
+
+    n_jobs : int, optional
+        Number of processes fitting shards in parallel. -1 (one per CPU) by
+    default.
+    """
+
+    def __init__(self, estimator, shard_by="counter_id", n_jobs=-1):
+        self.estimator = estimator
+        self.shard_by = shard_by
+        self.n_jobs = n_jobs
+
+    def shards_of(self, X):
+        """Return the shard of each row of a dataframe."""
+        if callable(self.shard_by):
+            return np.asarray(self.shard_by(X))
+        return np.asarray(X[self.shard_by], dtype=object)
+
+    def _shard_rows(self, X):
+        """Return the positions of the rows of each shard, in one pass."""
+        codes, shards = pd.factorize(self.shards_of(X))
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(shards.shape[0] + 1))
+        return {
+            shard: order[bounds[i] : bounds[i + 1]] for i, shard in enumerate(shards)
+        }
+
+    def fit(self, X, y):
+        """Fit a clone of the estimator on the rows of each shard.
+
+        Parameters
+        ----------
+        X : pd.dataframe
+            The features, with the shard column (or what shard_by needs).
+
+        y : array-like
+            The target.
+
+        Returns
+        -------
+        self : ShardedRegressor
+            The fitted estimator, with the models of the shards in estimators_.
+        """
+        y = np.asarray(y)
+        shard_rows = self._shard_rows(X)
+
+        models = Parallel(n_jobs=self.n_jobs)(
+            delayed(_fit_shard)(clone(self.estimator), X.iloc[rows], y[rows])
+            for rows in shard_rows.values()
+        )
+        self.estimators_ = dict(zip(shard_rows, models))
+        return self
+
+    def refit_shard(self, X, y, shard=None):
+        """Refit the model of one shard only, the other models being kept.
+
+        Parameters
+        ----------
+        X : pd.dataframe
+            The features of the shard (rows of other shards are ignored).
+
+        y : array-like
+            The target.
+
+        shard : optional
+            The shard to refit. By default, the only shard of the rows of X.
+
+        Returns
+        -------
+        self : ShardedRegressor
+            The estimator, with the model of the shard replaced.
+        """
+        shard_rows = self._shard_rows(X)
+        if shard is None:
+            if len(shard_rows) != 1:
+                raise ValueError("X holds several shards: give the one to refit")
+            shard = next(iter(shard_rows))
+
+        rows = shard_rows[shard]
+        self.estimators_[shard] = clone(self.estimator).fit(
+            X.iloc[rows], np.asarray(y)[rows]
+        )
+        return self
+
+    def predict(self, X):
+        """Predict each row with the model of its shard.
+
+        Parameters
+        ----------
+        X : pd.dataframe
+            The features, with the shard column (or what shard_by needs).
+
+        Returns
+        -------
+        y_pred : np.ndarray
+            The predictions, in the order of the rows.
+        """
+        shard_rows = self._shard_rows(X)
+        unknown = [shard for shard in shard_rows if shard not in self.estimators_]
+        if unknown:
+            raise ValueError(f"No model for the shards {unknown}")
+
+        y_pred = np.empty(X.shape[0])
+        for shard, rows in shard_rows.items():
+            y_pred[rows] = self.estimators_[shard].predict(X.iloc[rows])
+        return y_pred
@@ -0,0 +1,221 @@
+"""Python script designed to generate synthetic data with the schemas of the real one.
+
+In this script, we define functions generating bike counts with the schema of the
+competition 'train.parquet' and 'final_test.parquet' files, and hourly weather
+observations with the schema of the Météo-France CSV file. They are used to run
+the pipeline (e.g. in benchmark.py) at any scale, without the Kaggle data nor a
+network access.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from load_data import GLOBAL_STATION, WEATHER_COLUMNS
+
+# 75114007, 75107005 and 75116008 are excluded by load_data, they are generated
+# so that the filtering is exercised as on the real data.
+DEFAULT_STATIONS = [GLOBAL_STATION, 75114007, 75107005, 75116008]
+
+# Météo-France codes of the measurements available at every station (the others
+# are only measured by the global station, see load_data.LOCAL_WEATHER_COLUMNS).
+LOCAL_CODES = ["RR1", "T", "TN", "HTN", "TX", "HTX", "DG"]
+
+PARIS_LATITUDE, PARIS_LONGITUDE = 48.8566, 2.3522
+
+
+def make_weather(n_stations=5, start="2020-09-01", end="2021-09-01", seed=0):
+    """Generate hourly weather observations with the Météo-France CSV schema.
+
+    Parameters
+    ----------
+    n_stations : int, optional
+        Number of weather stations (at least 4, the first ones being the
+    DEFAULT_STATIONS). 5 by default.
+
+    start, end : str, optional
+        First and last hours of the observations.
+
+    seed : int, optional
+        Seed of the random generator. 0 by default.
+
+    Returns
+    -------
+    weather_data : pd.dataframe
+        One row per station and hour, with the raw Météo-France columns.
+    """
+    rng = np.random.default_rng(seed)
+    hours = pd.date_range(start, end, freq="h")
+    n_hours = hours.shape[0]
+
+    stations = DEFAULT_STATIONS + [
+        75100001 + 1000 * i for i in range(max(n_stations - 4, 0))
+    ]
+    day_cycle = np.sin(2 * np.pi * (hours.hour.to_numpy() - 9) / 24)
+    year_cycle = np.sin(2 * np.pi * (hours.dayofyear.to_numpy() - 110) / 365)
+
+    weather = []
+    for station in stations[: max(n_stations, 4)]:
+        temperature = 12 + 8 * year_cycle + 4 * day_cycle + rng.normal(0, 2, n_hours)
+        rain = np.where(rng.random(n_hours) < 0.1, rng.exponential(1.5, n_hours), 0)
+
+        station_weather = pd.DataFrame(
+            {
+                "NUM_POSTE": station,
+                "NOM_USUEL": f"PARIS-{station}",
+                "LAT": PARIS_LATITUDE + rng.normal(0, 0.03),
+                "LON": PARIS_LONGITUDE + rng.normal(0, 0.05),
+                "ALTI": rng.integers(30, 130),
+                "AAAAMMJJHH": hours.strftime("%Y%m%d%H").astype(int),
+            }
+        )
+        for code in list(WEATHER_COLUMNS)[6:]:
+            if station != GLOBAL_STATION and code not in LOCAL_CODES:
+                values = np.full(n_hours, np.nan)
+            elif code == "RR1":
+                values = rain.round(1)
+            elif code in ["T", "TN", "TX", "TCHAUSSEE", "TD", "TNSOL", "TN50"]:
+                values = (temperature + rng.normal(0, 1, n_hours)).round(1)
+            elif code.startswith("H"):
+                values = rng.integers(0, 24, n_hours).astype(float) * 100
+            else:
+                values = rng.gamma(2, 10, n_hours).round(1)
+            values[rng.random(n_hours) < 0.02] = np.nan  # sparse missing values
+            station_weather[code] = values
+        weather.append(station_weather)
+
+    weather_data = pd.concat(weather, ignore_index=True)
+    weather_data["EMPTY"] = np.nan  # all-NaN column, dropped by load_data
+    return weather_data
+
+
+def make_counts(n_counters=30, start="2020-09-01", end="2021-09-01", seed=0):
+    """Generate hourly bike counts with the competition parquet schema.
+
+    Parameters
+    ----------
+    n_counters : int, optional
+        Number of counters. 30 by default.
+
+    start, end : str, optional
+        First and last hours of the counts.
+
+    seed : int, optional
+        Seed of the random generator. 0 by default.
+
+    Returns
+    -------
+    counts : pd.dataframe
+        One row per counter and hour, with the columns of 'train.parquet'.
+    """
+    rng = np.random.default_rng(seed)
+    hours = pd.date_range(start, end, freq="h").astype("datetime64[us]")
+    n_hours = hours.shape[0]
+
+    hour = hours.hour.to_numpy()
+    weekend = hours.weekday.to_numpy() >= 5
+    profile = np.where(
+        weekend,
+        np.exp(-((hour - 15) ** 2) / 18),
+        np.exp(-((hour - 8) ** 2) / 2) + np.exp(-((hour - 18) ** 2) / 3),
+    )
+
+    n_sites = max(n_counters // 2, 1)
+    site_of_counter = np.arange(n_counters) % n_sites
+    latitudes = PARIS_LATITUDE + rng.normal(0, 0.03, n_sites)
+    longitudes = PARIS_LONGITUDE + rng.normal(0, 0.05, n_sites)
+
+    counts = []
+    for counter in range(n_counters):
+        site = site_of_counter[counter]
+        level = rng.lognormal(4, 0.8)
+        bike_count = rng.poisson(level * (0.05 + profile)).astype(float)
+
+        counts.append(
+            pd.DataFrame(
+                {
+                    "counter_id": f"{100000 + site}-{counter}",
+                    "counter_name": f"Counter {counter} of site {site}",
+                    "site_id": 100000 + site,
+                    "site_name": f"Site {site}",
+                    "bike_count": bike_count,
+                    "date": hours,
+                    "counter_installation_date": pd.Timestamp("2019-01-01"),
+                    "coordinates": f"{latitudes[site]},{longitudes[site]}",
+                    "counter_technical_id": f"Y{counter:07d}",
+                    "latitude": latitudes[site],
+                    "longitude": longitudes[site],
+                    "log_bike_count": np.log1p(bike_count),
+                }
+            )
+        )
+
+    counts = pd.concat(counts, ignore_index=True)
+    for col in [
+        "counter_id",
+        "counter_name",
+        "site_name",
+        "coordinates",
+        "counter_technical_id",
+    ]:
+        counts[col] = counts[col].astype("category")
+    counts["counter_installation_date"] = counts["counter_installation_date"].astype(
+        "datetime64[us]"
+    )
+    return counts
+
+
+def write_dataset(
+    directory, n_counters=30, n_stations=5, years=1, test_fraction=0.1, seed=0
+):
+    """Write a synthetic train set, test set and weather file in a directory.
+
+    Parameters
+    ----------
+    directory : str or Path
+        The output directory.
+
+    n_counters : int, optional
+        Number of counters. 30 by default.
+
+    n_stations : int, optional
+        Number of weather stations. 5 by default.
+
+    years : float, optional
+        Number of years of hourly history. 1 by default.
+
+    test_fraction : float, optional
+        Fraction of the period (the last one) used as test set. 0.1 by default.
+
+    seed : int, optional
+        Seed of the random generators. 0 by default.
+
+    Returns
+    -------
+    data_paths : tuple of three paths
+        Paths of the train, test and weather files, to give to load_data.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    start = pd.Timestamp("2020-09-01")
+    end = start + pd.Timedelta(hours=int(years * 365 * 24) - 1)
+
+    weather_path = directory / "H_75_synthetic.csv.gz"
+    make_weather(n_stations, start, end, seed).to_csv(
+        weather_path, sep=";", index=False
+    )
+
+    counts = make_counts(n_counters, start, end, seed)
+    split = start + (end - start) * (1 - test_fraction)
+
+    train_path = directory / "train.parquet"
+    counts[counts["date"] < split].to_parquet(train_path, index=False)
+
+    test_path = directory / "final_test.parquet"
+    counts[counts["date"] >= split].drop(
+        columns=["bike_count", "log_bike_count"]
+    ).to_parquet(test_path, index=False)
+
+    return train_path, test_path, weather_path
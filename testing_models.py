@@ -7,81 +7,171 @@ Score and execution time are printed at the end.
 
 """
 
+import tempfile
 import time
 import numpy as np
-from sklearn.ensemble import HistGradientBoostingRegressor
 from sklearn.model_selection import TimeSeriesSplit
-from sklearn.metrics import mean_squared_error
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import FunctionTransformer
 
 from load_data import load_data
-from feature_selector import feature_selection
-from feature_engineering import feature_transformer
+from feature_selector import feature_selection, load_selected_columns
+from feature_engineering import HistoryState, feature_transformer
 from preprocessor import preprocessor_generator
 from null_manager import null_imputer
-
-# Starting the timer
-
-start_time = time.time()
-
-# Applying a time series cross validation split
-
-tscv = TimeSeriesSplit(n_splits=5)
-
-# Running all the scripts to prepare data
-
-train, test = load_data()
-train = null_imputer(train)
-train = feature_selection(train)
-train = feature_transformer(train)
-x_train = train.drop(columns=["log_bike_count"])
-y_train = train["log_bike_count"]
-preprocessor = preprocessor_generator(x_train)
-
-# Defining our regressor and our pipeline
-
-regressor = HistGradientBoostingRegressor(
-    max_iter=1855,
-    max_depth=14,
-    learning_rate=0.07364924738942269,
-    random_state=8,  # fixing a random state to avoid random variations
-)
-
-
-pipeline = Pipeline(
-    steps=[
-        ("preprocessor", preprocessor),
-        (
-            "to_dense",
-            FunctionTransformer(lambda x: x.toarray() if hasattr(x, "toarray") else x),
-        ),  # to avoid "sparse matrix" issues
-        ("model", regressor),
-    ]
-)
-
-# Setting the cross validation system
-
-rmse_scores = []
-
-for train_index, val_index in tscv.split(x_train):
-    X_train_fold, X_val_fold = x_train.iloc[train_index], x_train.iloc[val_index]
-    y_train_fold, y_val_fold = y_train.iloc[train_index], y_train.iloc[val_index]
-
-    pipeline.fit(X_train_fold, y_train_fold)
-
-    y_pred = pipeline.predict(X_val_fold)
-
-    rmse = np.sqrt(mean_squared_error(y_val_fold, y_pred))
-    rmse_scores.append(rmse)
-
-# Ending timer
-end_time = time.time()
-running_time = end_time - start_time
-
-# Displaying results
-
-print(f"Average RMSE over 5 timer series fold : {np.mean(rmse_scores):.5f}")
-print(
-    f"Execution time : {int(running_time / 60)} minutes and {running_time % 60:.2f} seconds."
-)
+from parallel_cv import cross_validate_folds
+from fold_cache import build_fold_cache, load_fold_cache
+from model import make_regressor
+import profiling
+
+
+def main(
+    n_splits=5,
+    kaggle=False,
+    data_paths=None,
+    compact=False,
+    native_categorical=False,
+    history_features=None,
+    store_dir=None,
+):
+    """Run the time series cross-validation of the model and print its scores.
+
+    Parameters
+    ----------
+    n_splits : int, optional
+        Number of time series folds. 5 by default.
+
+    kaggle : boolean, optional
+        Whether to use Kaggle paths for accessing the data. False by default.
+
+    data_paths : tuple, optional
+        Paths of the train, test and weather files (see load_data).
+
+    compact : boolean, optional
+        Whether to use compact dtypes (float32 measurements, categorical IDs and
+    int8/int16 encoded features) to reduce the memory used. False by default.
+
+    native_categorical : boolean, optional
+        Whether to ordinal-encode the categorical features and let the model
+    handle them natively, instead of one-hot encoding them and scaling the
+    numerical ones. The hyperparameters were tuned for the one-hot encoding,
+    so False by default.
+
+    history_features : str, optional
+        'weather' to add the rolling rain and temperature trend features, 'all'
+    to add the lags of the target too (see feature_engineering.history_features).
+    None (no history features) by default.
+
+    store_dir : str or Path, optional
+        An incremental store to read the train set from (see load_data).
+    None by default.
+
+    Returns
+    -------
+    fold_results : list of dicts
+        The result of each fold (see parallel_cv.fit_fold).
+    """
+    # Starting the timer
+
+    start_time = time.time()
+
+    # Applying a time series cross validation split
+
+    tscv = TimeSeriesSplit(n_splits=n_splits)
+
+    # Running all the scripts to prepare data
+
+    train, _ = load_data(
+        kaggle=kaggle,
+        data_paths=data_paths,
+        columns=load_selected_columns() + ["log_bike_count"],
+        compact=compact,
+        store_dir=store_dir,
+    )
+    train = null_imputer(train)
+    train = feature_selection(train)
+    history = (
+        HistoryState(target_lags=history_features == "all")
+        if history_features
+        else None
+    )
+    train = feature_transformer(train, compact=compact, history=history)
+    x_train = train.drop(columns=["log_bike_count"])
+    y_train = train["log_bike_count"]
+    preprocessor = preprocessor_generator(
+        x_train, compact=compact, native_categorical=native_categorical
+    )
+
+    # Defining our regressor (with the hyperparameters saved by opt_hg.py, if
+    # tuned for the same encoding, see model.py)
+    # (with native_categorical, categorical features are ordinal-encoded and
+    # handled natively by the model, so no one-hot encoding, scaling nor
+    # densification is needed)
+
+    regressor = make_regressor(x_train, native_categorical)
+
+    # Preprocessing each fold with a preprocessor fitted on its train part only,
+    # as a pipeline would be (see fold_cache.py), and setting the cross
+    # validation system: the folds are fitted in parallel processes sharing the
+    # memory-mapped matrices (see parallel_cv.py)
+
+    with tempfile.TemporaryDirectory() as directory:
+        with profiling.stage("preprocess", x_train):
+            fold_dir = build_fold_cache(
+                preprocessor, x_train, y_train, tscv, cache_dir=directory
+            )
+
+        with profiling.stage("cross_validation", x_train):
+            fold_results = cross_validate_folds(regressor, load_fold_cache(fold_dir))
+
+    # Recording the fit and predict of each fold, timed in the worker processes
+
+    for result in fold_results:
+        profiling.record_stage(
+            "fit",
+            result["start_time"],
+            result["fit_s"],
+            pid=result["pid"],
+            fold=result["fold"],
+            rows_in=result["train_rows"],
+        )
+        profiling.record_stage(
+            "predict",
+            result["start_time"] + result["fit_s"],
+            result["predict_s"],
+            pid=result["pid"],
+            fold=result["fold"],
+            rows_in=result["val_rows"],
+            rows_out=result["val_rows"],
+        )
+
+    rmse_scores = [result["rmse"] for result in fold_results]
+
+    # Ending timer
+    end_time = time.time()
+    running_time = end_time - start_time
+
+    # Displaying results
+
+    for result in fold_results:
+        print(
+            f"Fold {result['fold']} : RMSE {result['rmse']:.5f}, fit {result['fit_s']:.1f} s,"
+            f" predict {result['predict_s']:.1f} s ({result['train_rows']} train rows)"
+        )
+    print(
+        f"Average RMSE over {n_splits} timer series fold : {np.mean(rmse_scores):.5f}"
+    )
+    print(
+        f"Execution time : {int(running_time / 60)} minutes and {running_time % 60:.2f} seconds."
+    )
+
+    # Exporting the profile of each stage (when BIKE_COUNTERS_PROFILE is set)
+
+    if profiling.is_enabled():
+        profiling.export_json("profile.json")
+        profiling.export_chrome_trace("profile_trace.json")
+        print("Stage profile written in profile.json and profile_trace.json.")
+
+    return fold_results
+
+
+if __name__ == "__main__":
+    main()
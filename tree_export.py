@@ -0,0 +1,449 @@
+"""Python script designed to export the fitted model as flat arrays for low latency scoring.
+
+In this script, we define an export_ensemble function that flattens all the
+trees of a fitted HistGradientBoostingRegressor into contiguous NumPy arrays
+(one entry per node: feature, threshold, children, missing value direction,
+categorical bitset and leaf value), and a FlatEnsemble class which evaluates
+them on small batches of rows.
+
+It is a latency tool: the regressor pays a fixed cost of tens of milliseconds
+per predict call, whatever the number of rows, while the flat ensemble answers
+a few rows in about a millisecond. Its cost grows faster with the number of
+rows, so the regressor is faster on batches beyond a few hundred rows: the
+prediction service uses it for its micro-batches only (see FLAT_MAX_ROWS in
+prediction_service.py), and the test set is scored with the regressor.
+
+Two vectorized evaluators are used:
+- when every tree has at most 64 leaves (31 with the default max_leaf_nodes),
+the leaves of each tree are numbered from left to right, and each split gives
+the mask of the leaves that a row going right cannot reach. As a split only
+depends on the interval of its feature between two consecutive thresholds (or
+on the category), the masks are combined by feature beforehand in tables of
+(feature value interval, tree) leaf masks. Evaluating a row is then one table
+lookup and one AND per feature for all the trees at once, and the exit leaf of
+each tree is the first leaf left in its mask;
+- otherwise, all the (row, tree) pairs go down their trees together, one level
+per step, the pairs which reached a leaf being dropped after each level.
+
+The predictions are exactly the ones of the regressor: the comparisons are the
+ones of scikit-learn (on float64 thresholds, with the same handling of missing
+values and of unknown categories), and the leaf values are summed tree by tree,
+in the order of the iterations.
+
+The arrays are saved as .npy files (with a JSON file of metadata) which are
+memory-mapped when loaded, so that several processes scoring with the same
+model share its pages:
+
+    flat = export_ensemble(pipeline[-1])
+    flat.save("flat_model")
+    flat = FlatEnsemble.load("flat_model")
+    y_pred = flat.predict(pipeline[:-1].transform(x_test))
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+MAX_MASK_LEAVES = 64  # leaves of a tree fitting in the uint64 leaf masks
+N_CATEGORY_BINS = 256  # codes of the categorical features (then the missing bin)
+
+
+def _categorical_go_right(arrays, node, x):
+    """Return whether rows go right at categorical splits (as scikit-learn does)."""
+    code = np.where(x < 0, 0, x).astype(np.uint8)
+    word, bit = code // 32, code % 32
+
+    in_left = (arrays["left_cat_bitsets"][arrays["bitset_row"][node], word] >> bit) & 1
+    known_row = arrays["known_cat_row"][arrays["feature"][node]]
+    is_known = (arrays["known_cat_bitsets"][known_row, word] >> bit) & 1
+
+    # negative and unknown categories are treated as missing values
+    missing = (x < 0) | ((in_left == 0) & (is_known == 0))
+    return np.where(missing, ~arrays["missing_left"][node], in_left == 0)
+
+
+def _leaf_order(children, roots, is_leaf):
+    """Number the leaves of each tree from left to right.
+
+    Returns the tree of each node, the number of each leaf in its tree (-1 for
+    the splits) and the mask of the leaves of the left subtree of each split.
+    """
+    n_nodes = children.shape[0]
+    tree = np.empty(n_nodes, dtype=np.int64)
+    leaf_bit = np.full(n_nodes, -1, dtype=np.int64)
+    left_mask = np.zeros(n_nodes, dtype=np.uint64)
+    subtree_mask = [0] * n_nodes
+
+    for tree_idx, root in enumerate(roots.tolist()):
+        # depth-first, left subtree first: the leaves come from left to right
+        order, stack = [], [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            if not is_leaf[node]:
+                stack.extend((children[node, 1], children[node, 0]))
+
+        n_leaves = 0
+        for node in order:
+            if is_leaf[node]:
+                leaf_bit[node] = n_leaves
+                subtree_mask[node] = 1 << n_leaves
+                n_leaves += 1
+        for node in reversed(order):
+            if not is_leaf[node]:
+                left, right = children[node]
+                subtree_mask[node] = subtree_mask[left] | subtree_mask[right]
+                left_mask[node] = subtree_mask[left]
+        tree[order] = tree_idx
+
+    return tree, leaf_bit, left_mask
+
+
+def _leaf_mask_tables(arrays, n_features, n_categorical):
+    """Build the tables of leaf masks of every feature (see the module docstring).
+
+    Returns
+    -------
+    tables : dict
+        - 'split_features' : the features used by at least one split
+        - 'bin_thresholds', 'threshold_offsets' : the sorted thresholds of each
+    numerical feature, delimiting its intervals
+        - 'leaf_masks', 'mask_offsets' : for each feature, one row per interval
+    (or category) and then one for missing values, one column per tree, with
+    the leaves reachable by the rows of this interval
+        - 'leaf_values' : the value of each leaf, by tree and leaf number
+    """
+    children, threshold = arrays["children"], arrays["threshold"]
+    n_nodes, n_trees = threshold.shape[0], arrays["roots"].shape[0]
+    is_leaf = children[:, 0] == np.arange(n_nodes)
+
+    tree, leaf_bit, left_mask = _leaf_order(children, arrays["roots"], is_leaf)
+    max_leaves = int(leaf_bit.max()) + 1
+
+    leaf_values = np.zeros((n_trees, max_leaves))
+    leaf_values[tree[is_leaf], leaf_bit[is_leaf]] = arrays["value"][is_leaf]
+
+    splits = np.flatnonzero(~is_leaf)
+    split_feature = arrays["feature"][splits]
+    thresholds, masks = [], []
+
+    for feature in range(n_features):
+        nodes = splits[split_feature == feature]
+        if feature < n_categorical:
+            codes = np.arange(N_CATEGORY_BINS, dtype=np.float64)
+            go_right = _categorical_go_right(
+                arrays, np.repeat(nodes, codes.shape[0]), np.tile(codes, nodes.shape[0])
+            ).reshape(nodes.shape[0], codes.shape[0])
+            thresholds.append(np.empty(0))
+        else:
+            # interval i holds the values in (thresholds[i - 1], thresholds[i]]
+            feature_thresholds = np.unique(threshold[nodes])
+            upper_bounds = np.append(feature_thresholds, np.inf)
+            go_right = ~(upper_bounds[None, :] <= threshold[nodes][:, None])
+            thresholds.append(feature_thresholds)
+        go_right = np.column_stack([go_right, ~arrays["missing_left"][nodes]])
+
+        table = np.full((go_right.shape[1], n_trees), np.iinfo(np.uint64).max)
+        split, interval = np.nonzero(go_right)
+        np.bitwise_and.at(
+            table, (interval, tree[nodes[split]]), ~left_mask[nodes[split]]
+        )
+        masks.append(table)
+
+    return {
+        "split_features": np.unique(split_feature).astype(np.int32),
+        "bin_thresholds": np.concatenate(thresholds),
+        "threshold_offsets": np.cumsum([0] + [t.shape[0] for t in thresholds]),
+        "leaf_masks": np.concatenate(masks),
+        "mask_offsets": np.cumsum([0] + [table.shape[0] for table in masks]),
+        "leaf_values": leaf_values,
+    }
+
+
+def export_ensemble(regressor):
+    """Flatten the trees of a fitted HistGradientBoostingRegressor.
+
+    Parameters
+    ----------
+    regressor : HistGradientBoostingRegressor
+        The fitted regressor, with one tree per iteration and an identity or
+    log link (e.g. the squared error or the poisson loss).
+
+    Returns
+    -------
+    ensemble : FlatEnsemble
+        The flat model, predicting exactly as the regressor.
+    """
+    link = type(regressor._loss.link).__name__
+    if link not in ("IdentityLink", "LogLink") or regressor.n_trees_per_iteration_ != 1:
+        raise ValueError(f"Unsupported regressor ({link}, one tree per iteration)")
+
+    predictors = [predictor for (predictor,) in regressor._predictors]
+    offsets = np.cumsum([0] + [predictor.nodes.shape[0] for predictor in predictors])
+    bitset_offsets = np.cumsum(
+        [0] + [predictor.raw_left_cat_bitsets.shape[0] for predictor in predictors]
+    )
+    nodes = np.concatenate([predictor.nodes for predictor in predictors])
+    tree_offset = np.repeat(offsets[:-1], np.diff(offsets))
+    is_leaf = nodes["is_leaf"].astype(bool)
+
+    # the children are numbered across all the trees, and the leaves are their
+    # own children, so that a leaf is recognized by its first child
+
+    node_ids = np.arange(nodes.shape[0])
+    children = np.empty((nodes.shape[0], 2), dtype=np.int32)
+    children[:, 0] = np.where(is_leaf, node_ids, nodes["left"] + tree_offset)
+    children[:, 1] = np.where(is_leaf, node_ids, nodes["right"] + tree_offset)
+
+    bitset_row = nodes["bitset_idx"] + np.repeat(bitset_offsets[:-1], np.diff(offsets))
+
+    # the regressor re-encodes the categorical features (as codes of the sorted
+    # categories seen at fit time) and puts them first
+
+    known_cat_bitsets, known_cat_row = (
+        regressor._bin_mapper.make_known_categories_bitsets()
+    )
+    n_features = regressor.n_features_in_
+    if regressor._preprocessor is None:
+        input_columns = np.arange(n_features)
+        categories = []
+    else:
+        is_categorical = regressor.is_categorical_
+        input_columns = np.concatenate(
+            [np.flatnonzero(is_categorical), np.flatnonzero(~is_categorical)]
+        )
+        encoder = regressor._preprocessor.named_transformers_["encoder"]
+        categories = [
+            np.asarray(column_categories, dtype="float64")
+            for column_categories in encoder.categories_
+        ]
+        categories = [column[~np.isnan(column)] for column in categories]
+
+    arrays = {
+        "feature": nodes["feature_idx"].astype(np.int32),
+        "threshold": nodes["num_threshold"].astype(np.float64),
+        "children": children,
+        "missing_left": nodes["missing_go_to_left"].astype(bool),
+        "is_categorical": nodes["is_categorical"].astype(bool) & ~is_leaf,
+        "bitset_row": bitset_row.astype(np.int32),
+        "value": nodes["value"].astype(np.float64),
+        "roots": offsets[:-1].astype(np.int32),
+        "left_cat_bitsets": np.concatenate(
+            [predictor.raw_left_cat_bitsets for predictor in predictors]
+        ),
+        "known_cat_bitsets": known_cat_bitsets,
+        "known_cat_row": known_cat_row.astype(np.int32),
+        "input_columns": input_columns.astype(np.int32),
+        "categories": np.concatenate(categories or [np.empty(0)]),
+        "category_offsets": np.cumsum([0] + [column.shape[0] for column in categories]),
+    }
+    max_leaves = max(predictor.get_n_leaf_nodes() for predictor in predictors)
+    if max_leaves <= MAX_MASK_LEAVES:
+        arrays.update(_leaf_mask_tables(arrays, n_features, len(categories)))
+
+    metadata = {
+        "baseline": float(regressor._baseline_prediction.ravel()[0]),
+        "link": link,
+        "n_features": int(n_features),
+        "max_depth": int(nodes["depth"].max()),
+        "max_leaves": int(max_leaves),
+    }
+    return FlatEnsemble(arrays, metadata)
+
+
+class FlatEnsemble:
+    """A tree ensemble stored as flat node arrays (see export_ensemble).
+
+    Parameters
+    ----------
+    arrays : dict
+        The node, leaf mask and encoding arrays, by name.
+
+    metadata : dict
+        The baseline prediction, the link function, the number of input features,
+    the depth of the deepest leaf and the largest number of leaves of a tree.
+    """
+
+    def __init__(self, arrays, metadata):
+        self.arrays = arrays
+        self.metadata = metadata
+
+    @property
+    def n_trees(self):
+        """Number of trees of the ensemble."""
+        return self.arrays["roots"].shape[0]
+
+    def _encode(self, X):
+        """Order and encode the columns of X as the regressor does before its trees."""
+        X = np.asarray(X, dtype="float64")[:, self.arrays["input_columns"]]
+        offsets = self.arrays["category_offsets"]
+
+        for j in range(offsets.shape[0] - 1):
+            categories = self.arrays["categories"][offsets[j] : offsets[j + 1]]
+            codes = np.searchsorted(categories, X[:, j])
+            found = (codes < categories.shape[0]) & (
+                categories[np.minimum(codes, categories.shape[0] - 1)] == X[:, j]
+            )
+            X[:, j] = np.where(found, codes, np.nan)  # unknown categories are missing
+
+        return X
+
+    def _intervals(self, x, feature):
+        """Return the row of the leaf mask table of each value of a feature."""
+        arrays = self.arrays
+        missing = np.isnan(x)
+        if feature < arrays["category_offsets"].shape[0] - 1:
+            missing |= x < 0
+            intervals = np.where(missing, 0, x).astype(np.intp)
+            n_intervals = N_CATEGORY_BINS
+        else:
+            offsets = arrays["threshold_offsets"]
+            thresholds = arrays["bin_thresholds"][
+                offsets[feature] : offsets[feature + 1]
+            ]
+            intervals = np.searchsorted(thresholds, x)
+            n_intervals = thresholds.shape[0] + 1
+        intervals[missing] = n_intervals  # the last row is the one of missing values
+        return intervals
+
+    def _leaf_values_by_masks(self, X):
+        """Return the leaf value of each (row, tree) of encoded rows, by leaf masks."""
+        arrays = self.arrays
+        mask_offsets = arrays["mask_offsets"]
+        n_rows, n_trees = X.shape[0], self.n_trees
+
+        reachable = np.full((n_rows, n_trees), np.iinfo(np.uint64).max)
+        masks = np.empty_like(reachable)
+        for feature in arrays["split_features"].tolist():
+            table = arrays["leaf_masks"][
+                mask_offsets[feature] : mask_offsets[feature + 1]
+            ]
+            np.take(table, self._intervals(X[:, feature], feature), axis=0, out=masks)
+            reachable &= masks
+
+        # the exit leaf of each tree is its first reachable leaf (lowest set bit)
+        lowest = reachable & (~reachable + np.uint64(1))
+        leaf = np.frexp(lowest.astype(np.float64))[1] - 1
+        leaf += np.arange(n_trees) * arrays["leaf_values"].shape[1]
+        return arrays["leaf_values"].ravel()[leaf]
+
+    def _leaf_values_by_traversal(self, X):
+        """Return the leaf value of each (row, tree) of encoded rows, level by level.
+
+        The (tree, row) pairs which reached a leaf are dropped after each level,
+        so that each step only works on the pairs still going down.
+        """
+        arrays = self.arrays
+        feature, threshold = arrays["feature"], arrays["threshold"]
+        children, missing_left = arrays["children"].ravel(), arrays["missing_left"]
+        is_categorical = arrays["is_categorical"]
+        has_categorical = bool(is_categorical.any())
+        is_leaf = children[::2] == np.arange(threshold.shape[0])
+
+        # pair p is the row p % n_rows in the tree p // n_rows
+        n_rows, n_features = X.shape
+        X = np.ascontiguousarray(X).ravel()
+        leaf = np.repeat(arrays["roots"], n_rows)
+        pairs = np.flatnonzero(~is_leaf[leaf])
+        node = leaf[pairs]
+        row_start = (pairs % n_rows) * n_features
+
+        for _ in range(self.metadata["max_depth"]):
+            if not pairs.shape[0]:
+                break
+            x = X[row_start + feature[node]]
+            go_right = ~(x <= threshold[node])
+
+            missing = np.isnan(x)
+            if missing.any():
+                go_right[missing] = ~missing_left[node[missing]]
+
+            if has_categorical:
+                categorical = is_categorical[node] & ~missing
+                if categorical.any():
+                    go_right[categorical] = _categorical_go_right(
+                        arrays, node[categorical], x[categorical]
+                    )
+
+            node = children[2 * node + go_right]
+            done = is_leaf[node]
+            leaf[pairs[done]] = node[done]
+            going = ~done
+            pairs, node, row_start = pairs[going], node[going], row_start[going]
+
+        return arrays["value"][leaf].reshape(-1, n_rows).T
+
+    def _predict_chunk(self, X):
+        """Predict a chunk of encoded rows."""
+        if "leaf_masks" in self.arrays:
+            leaf_values = self._leaf_values_by_masks(X)
+        else:
+            leaf_values = self._leaf_values_by_traversal(X)
+
+        # summed in the order of the iterations, after the baseline
+        leaf_values[:, 0] += self.metadata["baseline"]
+        raw = np.cumsum(leaf_values, axis=1)[:, -1]
+        return np.exp(raw) if self.metadata["link"] == "LogLink" else raw
+
+    def predict(self, X, chunk_rows=None, n_threads=None):
+        """Predict rows with the flat ensemble (meant for small batches).
+
+        Parameters
+        ----------
+        X : array-like of shape (n_rows, n_features)
+            The input of the regressor (e.g. the output of the preprocessor).
+
+        chunk_rows : int, optional
+            Number of rows evaluated together. By default, so that a chunk has
+        about a million (row, tree) pairs.
+
+        n_threads : int, optional
+            Number of threads evaluating chunks, when there are several. The
+        number of CPUs by default.
+
+        Returns
+        -------
+        y_pred : np.ndarray
+            The predictions, equal to the ones of the regressor.
+        """
+        X = np.asarray(X)
+        if X.ndim != 2 or X.shape[1] != self.metadata["n_features"]:
+            raise ValueError(
+                f"X has shape {X.shape}, expected {self.metadata['n_features']} features"
+            )
+        X = self._encode(X)
+        chunk_rows = chunk_rows or max(2**20 // self.n_trees, 1)
+        if X.shape[0] <= chunk_rows:  # no thread pool for a single chunk
+            return self._predict_chunk(X)
+        chunks = [
+            X[start : start + chunk_rows] for start in range(0, X.shape[0], chunk_rows)
+        ]
+
+        with ThreadPoolExecutor(n_threads or os.cpu_count()) as pool:
+            return np.concatenate(
+                [np.empty(0)] + list(pool.map(self._predict_chunk, chunks))
+            )
+
+    def save(self, directory):
+        """Save the arrays as .npy files and the metadata as JSON in a directory."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(directory / f"{name}.npy", np.ascontiguousarray(array))
+        with open(directory / "metadata.json", "w") as file:
+            json.dump(self.metadata, file, indent=2)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Load a flat ensemble saved with save, its arrays being memory-mapped."""
+        directory = Path(directory)
+        arrays = {
+            path.stem: np.load(path, mmap_mode=mmap_mode)
+            for path in sorted(directory.glob("*.npy"))
+        }
+        with open(directory / "metadata.json") as file:
+            metadata = json.load(file)
+        return cls(arrays, metadata)
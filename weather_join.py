@@ -0,0 +1,230 @@
+"""Python script designed to join the weather data to the bike counts without merges.
+
+In this script, we define a build_weather_index function that stores the weather
+data as dense (station x hour) NumPy blocks, and a join_weather function that
+enriches a dataframe by integer gather in these blocks. It replaces the chained
+pd.merge calls on 'counter_id', 'date' and ('date', 'id_poste'), which build hash
+tables and copy the whole wide dataframe at each step.
+
+The weather data is expected to have at most one row per (station, hour).
+"""
+
+import numpy as np
+import pandas as pd
+
+from profiling import profiled
+
+HOUR_US = 3_600_000_000  # one hour in microseconds
+
+
+def _to_microseconds(dates):
+    """Convert datetime values into int64 microseconds since epoch (NaT is kept as int64 min)."""
+    return np.asarray(dates, dtype="datetime64[us]").view("int64")
+
+
+@profiled("build_weather_index")
+def build_weather_index(weather_local, weather_global):
+    """Store the local and global weather data as dense arrays indexed by hour.
+
+    Parameters
+    ----------
+    weather_local : pd.dataframe
+        Weather attributes taken from the nearest station of each counter, with
+    'id_poste' and 'date' columns.
+
+    weather_global : pd.dataframe
+        Weather attributes only available from a single station, with a 'date'
+    column.
+
+    Returns
+    -------
+    weather_index : dict
+        - 'start' : microseconds of the first hour covered
+        - 'n_hours' : number of hours covered
+        - 'stations' : sorted array of the station ids
+        - 'local' : dict of (n_stations, n_hours) arrays, one per local attribute
+        - 'local_present' : (n_stations, n_hours) boolean array of observed cells
+        - 'global' : dict of (n_hours,) arrays, one per global attribute
+        - 'global_present' : (n_hours,) boolean array of observed hours
+        - 'categories' : the categories of the categorical attributes, whose
+    blocks hold the category codes
+    """
+    local_dates = _to_microseconds(weather_local["date"])
+    global_dates = _to_microseconds(weather_global["date"])
+    all_dates = np.concatenate([local_dates, global_dates])
+    start = all_dates.min() - all_dates.min() % HOUR_US
+    n_hours = int((all_dates.max() - start) // HOUR_US) + 1
+
+    stations = np.unique(weather_local["id_poste"].to_numpy())
+
+    # local attributes: one row per station, one column per hour
+
+    local_station = np.searchsorted(stations, weather_local["id_poste"].to_numpy())
+    local_hour, local_valid = _hour_positions(local_dates, start, n_hours)
+    local_station, local_hour = local_station[local_valid], local_hour[local_valid]
+
+    local_present = np.zeros((stations.shape[0], n_hours), dtype=bool)
+    local_present[local_station, local_hour] = True
+
+    categories = {}
+
+    def block_values(column):
+        """Return the values of a column, as codes for a categorical column."""
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            categories[column.name] = column.cat.categories
+            return column.cat.codes.to_numpy()
+        return column.to_numpy()
+
+    local = {}
+    for col in weather_local.columns.drop(["id_poste", "date"]):
+        values = block_values(weather_local[col])[local_valid]
+        block = np.zeros((stations.shape[0], n_hours), dtype=values.dtype)
+        block[local_station, local_hour] = values
+        local[col] = block
+
+    # global attributes: one value per hour
+
+    global_hour, global_valid = _hour_positions(global_dates, start, n_hours)
+    global_hour = global_hour[global_valid]
+
+    global_present = np.zeros(n_hours, dtype=bool)
+    global_present[global_hour] = True
+
+    global_ = {}
+    for col in weather_global.columns.drop("date"):
+        values = block_values(weather_global[col])[global_valid]
+        block = np.zeros(n_hours, dtype=values.dtype)
+        block[global_hour] = values
+        global_[col] = block
+
+    return {
+        "start": start,
+        "n_hours": n_hours,
+        "stations": stations,
+        "local": local,
+        "local_present": local_present,
+        "global": global_,
+        "global_present": global_present,
+        "categories": categories,
+    }
+
+
+def _hour_positions(dates, start, n_hours):
+    """Return the hour position of each date and whether it falls exactly on a covered hour."""
+    offset = dates - start
+    hours = offset // HOUR_US
+    valid = (
+        (dates != np.iinfo("int64").min)
+        & (offset % HOUR_US == 0)
+        & (hours >= 0)
+        & (hours < n_hours)
+    )
+    return np.where(valid, hours, 0), valid
+
+
+def _gather(block, positions, present, categories=None):
+    """Take values from a weather block, with NaN where the weather is missing.
+
+    The dtype of the block is kept when nothing is missing (like a left merge).
+    Otherwise integers become the smallest float holding them exactly, and the
+    codes of a categorical attribute (given its categories) become a categorical
+    column with missing values.
+    """
+    values = block[positions]
+    if categories is not None:
+        return pd.Categorical.from_codes(np.where(present, values, -1), categories)
+    if present.all():
+        return values
+    if values.dtype.kind in "iub":
+        values = values.astype("float32" if values.dtype.itemsize <= 2 else "float64")
+    else:
+        values = values.copy()
+    values[~present] = np.nan
+    return values
+
+
+@profiled("join_weather")
+def join_weather(dataset, weather_index, nearest_station_by_counter, columns=None):
+    """Enrich a dataframe with its nearest station id and the weather at its date.
+
+    The result is the same as merging successively the nearest station, the
+    global weather (with suffixes '_counter' and '_poste' for the common columns)
+    and the local weather, as left joins.
+
+    Parameters
+    ----------
+    dataset : pd.dataframe
+        The input dataframe, with 'counter_id' and 'date' columns.
+
+    weather_index : dict
+        The weather blocks built by build_weather_index.
+
+    nearest_station_by_counter : pd.dataframe
+        The station id ('id_poste') associated to each 'counter_id'.
+
+    columns : list, optional
+        Names of the weather columns to add (after suffixing). All of them by
+    default. The 'id_poste' column is always added.
+
+    Returns
+    -------
+    dataset : pd.dataframe
+        The dataset enriched with the weather data, in the same row order.
+    """
+    # counter -> station id -> station position
+
+    counter_pos = pd.Index(nearest_station_by_counter["counter_id"]).get_indexer(
+        np.asarray(dataset["counter_id"], dtype=object)
+    )
+    counter_found = counter_pos >= 0
+    id_poste = _gather(
+        nearest_station_by_counter["id_poste"].to_numpy(),
+        np.where(counter_found, counter_pos, 0),
+        counter_found,
+    )
+
+    stations = weather_index["stations"]
+    station_pos = np.searchsorted(stations, np.where(counter_found, id_poste, 0))
+    station_pos = np.minimum(station_pos, stations.shape[0] - 1)
+    station_found = counter_found & (stations[station_pos] == id_poste)
+
+    # date -> hour position
+
+    hour_pos, hour_found = _hour_positions(
+        _to_microseconds(dataset["date"]),
+        weather_index["start"],
+        weather_index["n_hours"],
+    )
+
+    # gathering the requested columns
+
+    # (weather indexes built before the categorical attributes were stored as
+    # codes, e.g. in older artifacts, have no categories)
+    categories = weather_index.get("categories", {})
+    overlapping = [col for col in weather_index["global"] if col in dataset.columns]
+    dataset = dataset.rename(columns={col: f"{col}_counter" for col in overlapping})
+
+    new_columns = {"id_poste": id_poste}
+
+    global_present = hour_found & weather_index["global_present"][hour_pos]
+    for col, block in weather_index["global"].items():
+        name = f"{col}_poste" if col in overlapping else col
+        if columns is None or name in columns:
+            new_columns[name] = _gather(
+                block, hour_pos, global_present, categories.get(col)
+            )
+
+    local_positions = (station_pos, hour_pos)
+    local_present = (
+        station_found & hour_found & weather_index["local_present"][local_positions]
+    )
+    for col, block in weather_index["local"].items():
+        if columns is None or col in columns:
+            new_columns[col] = _gather(
+                block,
+                local_positions,
+                local_present,
+                categories.get(col),
+            )
+
+    return pd.concat([dataset, pd.DataFrame(new_columns, index=dataset.index)], axis=1)